@@ -0,0 +1,187 @@
+import hashlib
+import mmap
+import os
+import struct
+import ujson
+import numpy as np
+
+MAGIC = b"WLARRAY1"
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_arrays(path, arrays, meta=None):
+    # Layout: MAGIC, u64 header length, JSON header, then each array aligned.
+    # Written to a temp path and renamed so readers never see a partial file.
+    path = str(path)
+    entries = {}
+    offset = 0
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    for name, arr in arrays.items():
+        offset = _aligned(offset)
+        entries[name] = {
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "offset": offset,
+        }
+        offset += arr.nbytes
+
+    header = ujson.dumps({"meta": meta or {}, "arrays": entries}).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (data_start + entries[name]["offset"] - f.tell()))
+            arr.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_arrays(path):
+    # Arrays are read-only views over the mapping, shared between processes
+    with open(str(path), "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError(f"{path} is not an array store")
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = ujson.loads(f.read(header_len).decode("utf-8"))
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = _aligned(len(MAGIC) + 8 + header_len)
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.frombuffer(
+                mm, dtype=dtype, count=count, offset=data_start + entry["offset"]
+            ).reshape(shape)
+
+    return arrays, header["meta"]
+
+
+def encode_strings(strings):
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, data
+
+
+class StringTable:
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        return cls(*encode_strings(strings))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def stable_hash64(key):
+    # hash() is salted per process; workers need the same hash as the builder
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class FrozenKeyIndex:
+    # Open-addressing is awkward to mmap, so keys are kept sorted by a 64-bit
+    # hash and looked up with a binary search plus a key comparison
+    def __init__(self, hashes, keys):
+        self.hashes = hashes
+        self.keys = keys
+
+    @staticmethod
+    def sort_order(keys):
+        hashes = np.array([stable_hash64(k) for k in keys], dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        return order, hashes[order]
+
+    def position(self, key):
+        h = np.uint64(stable_hash64(key))
+        pos = int(np.searchsorted(self.hashes, h))
+        while pos < len(self.hashes) and self.hashes[pos] == h:
+            if self.keys[pos] == key:
+                return pos
+            pos += 1
+        return -1
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+class FrozenStringMap:
+    FORMAT = "frozen-string-map-v1"
+
+    def __init__(self, path):
+        arrays, meta = read_arrays(path)
+        if meta.get("format") != self.FORMAT:
+            raise RuntimeError(f"{path} is not a frozen string map")
+
+        self.path = str(path)
+        self.index = FrozenKeyIndex(
+            arrays["hashes"], StringTable(arrays["key_offsets"], arrays["key_data"])
+        )
+        self.values = StringTable(arrays["value_offsets"], arrays["value_data"])
+
+    @classmethod
+    def write(cls, items, path):
+        keys, values = [], []
+        for key, value in dict(items).items():
+            keys.append(key)
+            values.append(value)
+
+        order, hashes = FrozenKeyIndex.sort_order(keys)
+        key_offsets, key_data = encode_strings([keys[i] for i in order])
+        value_offsets, value_data = encode_strings([values[i] for i in order])
+        write_arrays(
+            path,
+            {
+                "hashes": hashes,
+                "key_offsets": key_offsets,
+                "key_data": key_data,
+                "value_offsets": value_offsets,
+                "value_data": value_data,
+            },
+            meta={"format": cls.FORMAT},
+        )
+
+    def __reduce__(self):
+        # Workers re-map the file rather than receiving a pickled copy
+        return (self.__class__, (self.path,))
+
+    def get(self, key, default=None):
+        pos = self.index.position(key)
+        return self.values[pos] if pos >= 0 else default
+
+    def __getitem__(self, key):
+        pos = self.index.position(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self.values[pos]
+
+    def __contains__(self, key):
+        return self.index.position(key) >= 0
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,292 @@
+import argparse
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import ujson
+import pipelines
+import synthetic_dumps
+from pagerank import pagerank_with_percentiles
+from wikidata_parser import CompactInheritanceGraph, WikiDataParser, load_dump_line
+from wikipedia_parser import (
+    ArticleSummaries,
+    ParsedRawPage,
+    WikipediaCanonicalPage,
+    WikipediaCanonicalPageResolver,
+    WikipediaDumpParser,
+)
+
+logger = logging.getLogger(__name__)
+
+# Runs each pipeline stage against synthetic dumps, one fresh process per
+# run so peak RSS is the stage's own (pool workers included), and compares
+# throughput against a saved report to catch regressions offline.
+
+CONTEXT_NAME = "context.json"
+
+
+def prepare(work_dir, wikis, wiki_spec, spec):
+    # Writes the dumps plus every intermediate a benchmark reads, so each
+    # benchmark times one stage only
+    paths = synthetic_dumps.write_dumps(
+        os.path.join(work_dir, "dumps"), wikis=wikis, wiki_spec=wiki_spec, spec=spec
+    )
+    context = {
+        "wikis": list(wikis),
+        "dumps": paths,
+        "spec": {"wikipedia": wiki_spec.__dict__, "wikidata": spec.__dict__},
+        "parsed": {},
+        "canonical": {},
+        "summaries": {},
+    }
+    for wiki in wikis:
+        context["parsed"][wiki] = os.path.join(work_dir, f"{wiki}.parsed.msgpack")
+        context["canonical"][wiki] = os.path.join(work_dir, f"{wiki}.canonical.msgpack")
+        context["summaries"][wiki] = os.path.join(work_dir, f"{wiki}.wlsum")
+        pipelines.store_parsed_pages(paths[wiki], context["parsed"][wiki])
+        pipelines.store_resolved_pages(
+            context["parsed"][wiki], context["canonical"][wiki]
+        )
+        ArticleSummaries.write(
+            pipelines.augment_with_pagerank(context["canonical"][wiki]),
+            context["summaries"][wiki],
+        )
+
+    context["inheritance"] = os.path.join(work_dir, "inheritance.wlgraph")
+    pipelines.wikidata_inheritance_graph(paths["wikidata"]).dump_compact(
+        context["inheritance"]
+    )
+    with pipelines.buffered_stream(paths["wikidata"]) as f:
+        context["wikidata_lines"] = sum(1 for _ in f)
+
+    context["output_dir"] = os.path.join(work_dir, "output")
+    with open(os.path.join(work_dir, CONTEXT_NAME), "w") as f:
+        ujson.dump(context, f, indent=2)
+    return context
+
+
+# Each benchmark returns the number of items it processed
+
+
+def bench_parsed_wikipedia_pages(context, concurrency):
+    wiki = context["wikis"][0]
+    with pipelines.buffered_stream(context["dumps"][wiki]) as f:
+        pages = WikipediaDumpParser.parsed_wikipedia_pages(f, concurrency=concurrency)
+    return len(pages)
+
+
+def bench_resolve_parsed_pages(context, concurrency):
+    wiki = context["wikis"][0]
+    pages = list(ParsedRawPage.read_collection(context["parsed"][wiki]))
+    return len(list(WikipediaCanonicalPageResolver.resolve_parsed_pages(pages)))
+
+
+def bench_pagerank(context, concurrency):
+    wiki = context["wikis"][0]
+    pages = list(WikipediaCanonicalPage.read_collection(context["canonical"][wiki]))
+    return sum(1 for _ in pagerank_with_percentiles(lambda: pages))
+
+
+def bench_inheritance_graph(context, concurrency):
+    stream = pipelines.buffered_lines_with_progress(context["dumps"]["wikidata"])
+    WikiDataParser.inheritance_graph(stream)
+    return context["wikidata_lines"]
+
+
+def bench_read_lines_text(context, concurrency):
+    # The old reader, for comparison: readline on a TextIOWrapper, str to ujson
+    num_lines = 0
+    with pipelines.buffered_stream(context["dumps"]["wikidata"]) as f:
+        for line in f:
+            load_dump_line(line)
+            num_lines += 1
+    return num_lines
+
+
+def bench_read_lines_blocks(context, concurrency):
+    num_lines = 0
+    for line in pipelines.buffered_lines_with_progress(context["dumps"]["wikidata"]):
+        load_dump_line(line)
+        num_lines += 1
+    return num_lines
+
+
+def bench_write_csv(context, concurrency):
+    os.makedirs(context["output_dir"], exist_ok=True)
+    pipelines.write_csv(
+        context["dumps"]["wikidata"],
+        os.path.join(context["output_dir"], "wikilanguage.tsv"),
+        {
+            wiki: ArticleSummaries(context["summaries"][wiki])
+            for wiki in context["wikis"]
+        },
+        None,
+        CompactInheritanceGraph.load(context["inheritance"]).parent_finder(),
+        concurrency=concurrency,
+    )
+    return context["wikidata_lines"]
+
+
+BENCHMARKS = {
+    "parsed_wikipedia_pages": bench_parsed_wikipedia_pages,
+    "resolve_parsed_pages": bench_resolve_parsed_pages,
+    "pagerank": bench_pagerank,
+    "inheritance_graph": bench_inheritance_graph,
+    "read_lines_text": bench_read_lines_text,
+    "read_lines_blocks": bench_read_lines_blocks,
+    "write_csv": bench_write_csv,
+}
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in KB on Linux
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_one(name, work_dir, concurrency):
+    with open(os.path.join(work_dir, CONTEXT_NAME)) as f:
+        context = ujson.load(f)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    items = BENCHMARKS[name](context, concurrency)
+    seconds = time.perf_counter() - start
+    return {
+        "name": name,
+        "items": items,
+        "seconds": seconds,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "items_per_second": items / seconds if seconds else None,
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+
+
+def run_isolated(name, work_dir, concurrency):
+    with tempfile.NamedTemporaryFile(suffix=".json") as result:
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--run-one",
+                name,
+                "--work-dir",
+                work_dir,
+                "--concurrency",
+                str(concurrency),
+                "--result",
+                result.name,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(result.name) as f:
+            return ujson.load(f)
+
+
+def summarize(name, runs):
+    seconds = [r["seconds"] for r in runs]
+    return {
+        "name": name,
+        "items": runs[0]["items"],
+        "runs": len(runs),
+        "seconds_min": min(seconds),
+        "seconds_median": statistics.median(seconds),
+        "items_per_second": runs[0]["items"] / min(seconds) if min(seconds) else None,
+        "peak_rss_bytes": max(r["peak_rss_bytes"] for r in runs),
+        "cpu_seconds_median": statistics.median(r["cpu_seconds"] for r in runs),
+    }
+
+
+def compare(report, baseline, tolerance):
+    # A benchmark regresses when its best throughput drops, or its peak
+    # memory grows, by more than tolerance relative to the baseline
+    baseline_by_name = {b["name"]: b for b in baseline["benchmarks"]}
+    regressions = []
+    for b in report["benchmarks"]:
+        base = baseline_by_name.get(b["name"])
+        if base is None or base["items"] != b["items"]:
+            continue
+        if b["items_per_second"] < base["items_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{b['name']}: {b['items_per_second']:.0f} items/s vs "
+                f"{base['items_per_second']:.0f} in baseline"
+            )
+        if b["peak_rss_bytes"] > base["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(
+                f"{b['name']}: peak RSS {b['peak_rss_bytes'] / 1e6:.0f}MB vs "
+                f"{base['peak_rss_bytes'] / 1e6:.0f}MB in baseline"
+            )
+    return regressions
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages")
+    parser.add_argument("--only", help="comma separated benchmarks to run")
+    parser.add_argument("--pages", type=int, default=20000)
+    parser.add_argument("--items", type=int, default=40000)
+    parser.add_argument("--wikis", default="enwiki,jawiki")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count())
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", help="reuse prepared dumps in this directory")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        with open(args.result, "w") as f:
+            ujson.dump(run_one(args.run_one, args.work_dir, args.concurrency), f)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wikilanguage-bench-")
+    try:
+        if not os.path.exists(os.path.join(work_dir, CONTEXT_NAME)):
+            logger.info(f"Preparing synthetic dumps in {work_dir}")
+            prepare(
+                work_dir,
+                args.wikis.split(","),
+                synthetic_dumps.WikipediaDumpSpec(num_pages=args.pages),
+                synthetic_dumps.WikidataDumpSpec(num_items=args.items),
+            )
+
+        names = args.only.split(",") if args.only else list(BENCHMARKS)
+        report = {"concurrency": args.concurrency, "benchmarks": []}
+        for name in names:
+            runs = []
+            for i in range(args.repeat):
+                runs.append(run_isolated(name, work_dir, args.concurrency))
+                logger.info(
+                    f"{name} run {i + 1}: {runs[-1]['seconds']:.2f}s, "
+                    f"peak RSS {runs[-1]['peak_rss_bytes'] / 1e6:.0f}MB"
+                )
+            report["benchmarks"].append(summarize(name, runs))
+
+        with open(args.output, "w") as f:
+            ujson.dump(report, f, indent=2)
+        logger.info(f"Wrote {args.output}")
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(report, ujson.load(f), args.tolerance)
+            for regression in regressions:
+                logger.error(f"Regression: {regression}")
+            if regressions:
+                sys.exit(1)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import bz2
+import gzip
+import logging
+import os
+import time
+import ujson
+from pathlib import Path
+from tqdm.auto import tqdm
+from line_reader import DEFAULT_BLOCK_SIZE, line_blocks
+
+try:
+    # Optional: keeps zlib access points so a resumed run seeks straight to
+    # its checkpoint instead of decompressing everything before it
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT = "wikilanguage-checkpoint-v1"
+CHECKPOINT_NAME = "checkpoint.json"
+GZIP_INDEX_NAME = "input.gzidx"
+DEFAULT_CHECKPOINT_INTERVAL = 300
+
+
+def input_key(input_path):
+    stat = os.stat(input_path)
+    return {
+        "path": os.path.abspath(input_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+class CheckpointedLines:
+    # Iterates over the bytes lines of a (possibly compressed) dump starting
+    # at an uncompressed byte offset, tracking the offset after each line read
+    def __init__(
+        self,
+        input_path,
+        offset=0,
+        lines_read=0,
+        index_path=None,
+        bufsize_mb=100,
+        block_size=DEFAULT_BLOCK_SIZE,
+    ):
+        self.input_path = str(input_path)
+        self.offset = offset
+        self.lines_read = lines_read
+        self.index_path = index_path
+        self.block_size = block_size
+        bufsize = bufsize_mb * 1024 * 1024
+
+        if self.input_path.endswith(".gz") and indexed_gzip is not None:
+            self.raw = indexed_gzip.IndexedGzipFile(self.input_path)
+            if index_path and os.path.exists(index_path):
+                self.raw.import_index(index_path)
+        elif self.input_path.endswith(".gz"):
+            self.raw = gzip.GzipFile(self.input_path, mode="rb")
+        elif self.input_path.endswith(".bz2"):
+            self.raw = bz2.BZ2File(self.input_path, mode="rb")
+        else:
+            self.raw = open(self.input_path, mode="rb", buffering=bufsize)
+
+        if offset:
+            # Without an index, gzip and bz2 seeks decompress and discard up
+            # to the offset, which still skips parsing and writing
+            logger.info(f"Seeking {self.input_path} to byte {offset}")
+            self.raw.seek(offset)
+
+    def save_index(self):
+        if self.index_path and indexed_gzip is not None and self.input_path.endswith(".gz"):
+            tmp_path = f"{self.index_path}.tmp"
+            self.raw.export_index(tmp_path)
+            os.replace(tmp_path, self.index_path)
+
+    def __iter__(self):
+        pbar = tqdm(unit="b", unit_scale=True, initial=self.offset)
+        try:
+            for lines in line_blocks(self.raw, self.block_size):
+                for line in lines:
+                    # An unterminated last line overcounts by one, which
+                    # still seeks to the end of the input
+                    self.offset += len(line) + 1
+                    self.lines_read += 1
+                    yield line
+                pbar.update(self.offset - pbar.n)
+        finally:
+            pbar.close()
+
+    def close(self):
+        self.raw.close()
+
+
+class Checkpointer:
+    # Periodically records how far into the input a writer has got, along
+    # with output offsets and counters. Outputs must be flushed and synced by
+    # the caller before save, so a checkpoint never points past durable data.
+    def __init__(self, checkpoint_dir, input_path, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.dir = Path(checkpoint_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.path = self.dir / CHECKPOINT_NAME
+        self.index_path = str(self.dir / GZIP_INDEX_NAME)
+        self.input_key = input_key(input_path)
+        self.interval = interval
+        self.last_save = time.time()
+
+    def load(self, **params):
+        # params must match the checkpointed run, otherwise we start over
+        if not self.path.exists():
+            return None
+        with open(self.path) as f:
+            state = ujson.load(f)
+        if (
+            state.get("format") != FORMAT
+            or state.get("input") != self.input_key
+            or state.get("params") != ujson.loads(ujson.dumps(params))
+        ):
+            logger.warning(f"Ignoring stale checkpoint {self.path}")
+            return None
+        logger.info(
+            f"Resuming from {self.path}: {state['lines_read']} lines, byte {state['input_offset']}"
+        )
+        return state
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, lines, params, input_offset, lines_read, **state):
+        # input_offset and lines_read are those of the last line whose output
+        # has been written; lines itself may have read further ahead
+        lines.save_index()
+        tmp_path = self.dir / f"{CHECKPOINT_NAME}.tmp"
+        with open(tmp_path, "w") as f:
+            ujson.dump(
+                {
+                    "format": FORMAT,
+                    "input": self.input_key,
+                    "params": params,
+                    "input_offset": input_offset,
+                    "lines_read": lines_read,
+                    **state,
+                },
+                f,
+                indent=2,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_save = time.time()
+
+    def clear(self):
+        for path in (self.path, Path(self.index_path)):
+            if path.exists():
+                os.remove(path)
+        if not any(self.dir.iterdir()):
+            self.dir.rmdir()
+
+
+def sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+
+def truncate(path, size):
+    with open(path, "r+b") as f:
+        f.truncate(size)
@@ -0,0 +1,374 @@
+import array
+import os
+import ujson
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.json"
+FORMAT = "wikilanguage-columnar-v1"
+
+# Column kinds:
+#   float64  - raw little-endian float64, NaN for missing
+#   string   - UTF-8 strings joined by NUL, plus a uint8 null mask
+#   category - int32 codes (-1 for missing) plus NUL-joined categories;
+#              with "strings" set, read back as plain strings rather than a
+#              Categorical (dictionary-encoded strings)
+#   datetime64 - raw little-endian int64 nanoseconds, NaT for missing
+FLOAT64 = "float64"
+STRING = "string"
+CATEGORY = "category"
+DATETIME64 = "datetime64"
+
+
+def is_columnar(path):
+    manifest_path = Path(path) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return False
+    with open(manifest_path) as f:
+        return ujson.load(f).get("format") == FORMAT
+
+
+def _as_text(value):
+    # Mirrors what csv.DictWriter writes and pd.read_csv reads back as NaN
+    if value is None:
+        return None
+    value = value if isinstance(value, str) else str(value)
+    return value if value else None
+
+
+class _FloatColumn:
+    def __init__(self, path):
+        self.f = open(f"{path}.f8", "wb")
+        self.buffer = array.array("d")
+
+    def append(self, value):
+        self.buffer.append(np.nan if value is None or value == "" else float(value))
+
+    def flush(self):
+        self.buffer.tofile(self.f)
+        del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        return {}
+
+
+class _StringColumn:
+    def __init__(self, path):
+        self.f = open(f"{path}.txt", "wb")
+        self.null_f = open(f"{path}.null.u1", "wb")
+        self.buffer = []
+        self.nulls = array.array("B")
+        self.first = True
+
+    def append(self, value):
+        text = _as_text(value)
+        self.nulls.append(text is None)
+        self.buffer.append(text or "")
+
+    def flush(self):
+        if self.buffer:
+            if not self.first:
+                self.f.write(b"\0")
+            self.f.write("\0".join(self.buffer).encode("utf-8"))
+            self.first = False
+        self.nulls.tofile(self.null_f)
+        self.buffer = []
+        del self.nulls[:]
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        self.null_f.close()
+        return {}
+
+
+class _CategoryColumn:
+    def __init__(self, path):
+        self.path = path
+        self.f = open(f"{path}.codes.i4", "wb")
+        self.codes = array.array("i")
+        self.categories = {}
+
+    def append(self, value):
+        text = _as_text(value)
+        self.codes.append(
+            -1 if text is None else self.categories.setdefault(text, len(self.categories))
+        )
+
+    def flush(self):
+        self.codes.tofile(self.f)
+        del self.codes[:]
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        with open(f"{self.path}.categories.txt", "wb") as f:
+            f.write("\0".join(self.categories).encode("utf-8"))
+        return {"num_categories": len(self.categories)}
+
+
+_COLUMN_CLASSES = {FLOAT64: _FloatColumn, STRING: _StringColumn, CATEGORY: _CategoryColumn}
+
+
+class ColumnarWriter:
+    def __init__(self, path, columns, flush_rows=65536):
+        # columns is a list of (name, kind) pairs
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.path / MANIFEST_NAME
+        if manifest_path.exists():
+            os.remove(manifest_path)
+
+        self.kinds = dict(columns)
+        self.columns = {
+            name: _COLUMN_CLASSES[kind](self.path / name) for name, kind in columns
+        }
+        self.flush_rows = flush_rows
+        self.num_rows = 0
+
+    def append(self, row_dict):
+        for name, column in self.columns.items():
+            column.append(row_dict.get(name))
+
+        self.num_rows += 1
+        if self.num_rows % self.flush_rows == 0:
+            for column in self.columns.values():
+                column.flush()
+
+    def close(self):
+        manifest = {"format": FORMAT, "rows": self.num_rows, "columns": {}}
+        for name, column in self.columns.items():
+            manifest["columns"][name] = {"kind": self.kinds[name], **column.close()}
+
+        # The manifest is written last, so a directory without one is partial
+        tmp_path = self.path / f"{MANIFEST_NAME}.tmp"
+        with open(tmp_path, "w") as f:
+            ujson.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path / MANIFEST_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def _write_categories(base, categories):
+    with open(f"{base}.categories.txt", "wb") as f:
+        f.write("\0".join(categories).encode("utf-8"))
+
+
+def _write_frame_column(base, values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values.cat.codes.values.astype("<i4").tofile(f"{base}.codes.i4")
+        categories = [str(c) for c in values.cat.categories]
+        _write_categories(base, categories)
+        return {"kind": CATEGORY, "num_categories": len(categories)}
+    elif pd.api.types.is_float_dtype(values):
+        np.asarray(values, dtype="<f8").tofile(f"{base}.f8")
+        return {"kind": FLOAT64}
+    elif pd.api.types.is_datetime64_dtype(values):
+        np.asarray(values, dtype="datetime64[ns]").view("<i8").tofile(f"{base}.m8")
+        return {"kind": DATETIME64}
+    elif pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+        codes, uniques = pd.factorize(values)
+        codes.astype("<i4").tofile(f"{base}.codes.i4")
+        _write_categories(base, [str(u) for u in uniques])
+        return {"kind": CATEGORY, "num_categories": len(uniques), "strings": True}
+    raise RuntimeError(f"Cannot write column of dtype {values.dtype}")
+
+
+def write_frame(path, df, index_col="concept_id", extra=None):
+    # Writes a whole typed frame at once, unlike ColumnarWriter which is fed
+    # rows. extra is stored in the manifest.
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    manifest_path = path / MANIFEST_NAME
+    if manifest_path.exists():
+        os.remove(manifest_path)
+
+    manifest = {"format": FORMAT, "rows": len(df), "columns": {}, **(extra or {})}
+    columns = [(index_col, df.index.to_series())] + list(df.items())
+    for name, values in columns:
+        manifest["columns"][name] = _write_frame_column(path / name, values)
+
+    tmp_path = path / f"{MANIFEST_NAME}.tmp"
+    with open(tmp_path, "w") as f:
+        ujson.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def read_manifest(path):
+    with open(Path(path) / MANIFEST_NAME) as f:
+        manifest = ujson.load(f)
+
+    if manifest.get("format") != FORMAT:
+        raise RuntimeError(f"{path} is not a columnar wikilanguage dataset")
+
+    return manifest
+
+
+def _read_strings(path, num_strings):
+    with open(path, "rb") as f:
+        text = f.read().decode("utf-8")
+    strings = text.split("\0") if num_strings else []
+    if len(strings) != num_strings:
+        raise RuntimeError(f"Expected {num_strings} strings in {path}")
+    return strings
+
+
+class _StringTable:
+    # NUL-joined strings, memory-mapped with each one's byte range, so a
+    # few strings decode without reading the others
+    SCAN_BYTES = 1 << 24
+
+    def __init__(self, path, num_strings):
+        if num_strings == 0 or os.path.getsize(path) == 0:
+            self.data = np.empty(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        nuls = np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [
+                np.flatnonzero(self.data[start : start + self.SCAN_BYTES] == 0)
+                + start
+                for start in range(0, len(self.data), self.SCAN_BYTES)
+            ]
+        )
+        if num_strings and len(nuls) + 1 != num_strings:
+            raise RuntimeError(f"Expected {num_strings} strings in {path}")
+        self.starts = np.concatenate([[0], nuls + 1])[:num_strings]
+        self.ends = np.concatenate([nuls, [len(self.data)]])[:num_strings]
+
+    def get(self, positions):
+        return np.array(
+            [
+                self.data[start:end].tobytes().decode("utf-8")
+                for start, end in zip(self.starts[positions], self.ends[positions])
+            ],
+            dtype=object,
+        )
+
+
+class _ColumnSlices:
+    # Reads a column a slice of rows at a time: numeric values and category
+    # codes are memory-mapped, and strings are decoded only for the rows or
+    # categories in the slice
+    def __init__(self, path, name, manifest):
+        num_rows = manifest["rows"]
+        column = manifest["columns"][name]
+        base = Path(path) / name
+        self.kind = column["kind"]
+        self.strings = column.get("strings", False)
+        if self.kind in (FLOAT64, DATETIME64):
+            self.values = read_column(path, name, manifest)
+        elif self.kind == STRING:
+            self.table = _StringTable(f"{base}.txt", num_rows)
+            self.nulls = np.memmap(f"{base}.null.u1", dtype=np.uint8, mode="r")
+        elif self.kind == CATEGORY:
+            self.codes = np.memmap(
+                f"{base}.codes.i4", dtype=np.int32, mode="r", shape=(num_rows,)
+            )
+            if self.strings:
+                self.table = _StringTable(
+                    f"{base}.categories.txt", column["num_categories"]
+                )
+            else:
+                self.categories = _read_strings(
+                    f"{base}.categories.txt", column["num_categories"]
+                )
+        else:
+            raise RuntimeError(f"Unknown column kind {self.kind} for {name}")
+
+    def read(self, start, stop):
+        if self.kind in (FLOAT64, DATETIME64):
+            return np.array(self.values[start:stop])
+        elif self.kind == STRING:
+            values = self.table.get(np.arange(start, stop))
+            values[self.nulls[start:stop].astype(bool)] = np.nan
+            return values
+        codes = np.array(self.codes[start:stop])
+        if not self.strings:
+            return pd.Categorical.from_codes(codes, categories=self.categories)
+        used, inverse = np.unique(codes, return_inverse=True)
+        values = np.full(len(used), np.nan, dtype=object)
+        values[used >= 0] = self.table.get(used[used >= 0])
+        return values[inverse]
+
+
+def iter_columnar_frames(path, chunksize, usecols=None, index_col="concept_id"):
+    # Frames of at most chunksize rows, holding only that slice of each
+    # column in memory
+    manifest = read_manifest(path)
+    names = [
+        name
+        for name in manifest["columns"]
+        if usecols is None or name in usecols or name == index_col
+    ]
+    if manifest["rows"] == 0:
+        return
+    slices = {name: _ColumnSlices(path, name, manifest) for name in names}
+    for start in range(0, manifest["rows"], chunksize):
+        stop = min(start + chunksize, manifest["rows"])
+        columns = {name: column.read(start, stop) for name, column in slices.items()}
+        index = pd.Index(columns.pop(index_col), name=index_col)
+        yield pd.DataFrame(columns, index=index)
+
+
+def read_column(path, name, manifest=None, mmap_mode="r"):
+    # mmap_mode "c" maps numeric columns copy-on-write, so they can be
+    # modified in memory
+    manifest = manifest or read_manifest(path)
+    num_rows = manifest["rows"]
+    column = manifest["columns"][name]
+    base = Path(path) / name
+
+    if column["kind"] == FLOAT64:
+        if num_rows == 0:
+            return np.empty(0, dtype=np.float64)
+        return np.memmap(
+            f"{base}.f8", dtype=np.float64, mode=mmap_mode, shape=(num_rows,)
+        )
+    elif column["kind"] == DATETIME64:
+        if num_rows == 0:
+            return np.empty(0, dtype="datetime64[ns]")
+        return np.memmap(
+            f"{base}.m8", dtype="<M8[ns]", mode=mmap_mode, shape=(num_rows,)
+        )
+    elif column["kind"] == STRING:
+        values = np.array(_read_strings(f"{base}.txt", num_rows), dtype=object)
+        nulls = np.fromfile(f"{base}.null.u1", dtype=np.uint8).astype(bool)
+        values[nulls] = np.nan
+        return values
+    elif column["kind"] == CATEGORY:
+        if num_rows == 0:
+            codes = np.empty(0, dtype=np.int32)
+        else:
+            codes = np.memmap(
+                f"{base}.codes.i4", dtype=np.int32, mode=mmap_mode, shape=(num_rows,)
+            )
+        categories = _read_strings(
+            f"{base}.categories.txt", column["num_categories"]
+        )
+        if column.get("strings"):
+            # Code -1 picks the trailing NaN
+            return np.array(categories + [np.nan], dtype=object)[codes]
+        return pd.Categorical.from_codes(codes, categories=categories)
+    else:
+        raise RuntimeError(f"Unknown column kind {column['kind']} for {name}")
+
+
+def load_columnar_frame(path, usecols=None, index_col="concept_id", mmap_mode="r"):
+    manifest = read_manifest(path)
+    names = [
+        name
+        for name in manifest["columns"]
+        if usecols is None or name in usecols or name == index_col
+    ]
+    columns = {name: read_column(path, name, manifest, mmap_mode) for name in names}
+    index = pd.Index(columns.pop(index_col), name=index_col)
+    return pd.DataFrame(columns, index=index, copy=False)
@@ -0,0 +1,36 @@
+import bz2
+import gzip
+
+# Dump lines are split out of large decompressed blocks with bytes operations
+# and handed to ujson as bytes, skipping a readline call and a utf-8 decode
+# per line
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def open_binary(input_path, bufsize):
+    # Returns (raw file, decompressed stream); raw.tell() is the compressed
+    # position, for progress
+    input_path = str(input_path)
+    raw = open(input_path, mode="rb", buffering=bufsize)
+    if input_path.endswith(".gz"):
+        return raw, gzip.GzipFile(fileobj=raw)
+    elif input_path.endswith(".bz2"):
+        return raw, bz2.BZ2File(raw)
+    return raw, raw
+
+
+def line_blocks(f, block_size=DEFAULT_BLOCK_SIZE):
+    # Yields the complete lines of each block as a list of bytes without the
+    # trailing newline; a line cut by the block boundary is carried over
+    tail = b""
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        lines = block.split(b"\n")
+        lines[0] = tail + lines[0]
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
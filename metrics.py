@@ -0,0 +1,255 @@
+import glob
+import logging
+import os
+import resource
+import signal
+import time
+import ujson
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing import util
+
+logger = logging.getLogger(__name__)
+
+# Process-local counters, gauges and timers. Names are "<stage>.<metric>";
+# a few suffixes get derived values in reports:
+#   <stage>.seconds            stage wall time, turns <stage>.<x> counters
+#                              into <stage>.<x>_per_second rates
+#   <name>.busy                worker busy time, reported as a share of the
+#                              process's uptime
+#   <name>.hits / .misses      reported as <name>.hit_rate
+# Once enable() has been called, every process (forked pool workers too)
+# writes its own snapshot file to the metrics directory, which merge()
+# combines into one report.
+
+PROCESS_GLOB = "process.*.json"
+SNAPSHOTS_NAME = "snapshots.jsonl"
+
+
+class _Registry:
+    def __init__(self):
+        self.metrics_dir = None
+        self.interval = None
+        self.snapshots = False
+        self.pid = os.getpid()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.last_flush = time.monotonic()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.gauge_max = {}
+        self.timers = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def inc(self, name, n=1):
+        self.counters[name] += n
+        self._maybe_flush()
+
+    def add(self, counts, prefix=""):
+        for name, n in counts.items():
+            self.counters[prefix + name] += n
+        self._maybe_flush()
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        self.gauge_max[name] = max(value, self.gauge_max.get(name, value))
+        self._maybe_flush()
+
+    def observe(self, name, seconds):
+        timer = self.timers[name]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        self._maybe_flush()
+
+    def snapshot(self):
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "uptime_seconds": time.time() - self.started,
+            "peak_rss_bytes": 1024
+            * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "gauge_max": dict(self.gauge_max),
+            "timers": {
+                name: {"count": c, "seconds": s, "max_seconds": m}
+                for name, (c, s, m) in self.timers.items()
+            },
+        }
+
+    def _maybe_flush(self):
+        if self.metrics_dir is None:
+            return
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.metrics_dir is None:
+            return
+        self.last_flush = time.monotonic()
+        path = os.path.join(self.metrics_dir, f"process.{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            ujson.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+
+        if self.snapshots and self.pid == os.getpid():
+            # The main process also appends a merged snapshot, for watching
+            # a run under load
+            merged = merge(self.metrics_dir)
+            with open(os.path.join(self.metrics_dir, SNAPSHOTS_NAME), "a") as f:
+                f.write(ujson.dumps(merged) + "\n")
+            _log_progress(merged)
+
+    def _after_fork(self):
+        self.reset()
+        if self.metrics_dir is None:
+            return
+        util.Finalize(self, self.flush, exitpriority=100)
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def on_sigterm(signum, frame):
+            # Pools terminate their workers on exit
+            self.flush()
+            if callable(previous):
+                previous(signum, frame)
+            os._exit(0)
+
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+
+_registry = _Registry()
+util.register_after_fork(_registry, _Registry._after_fork)
+
+inc = _registry.inc
+add = _registry.add
+gauge = _registry.gauge
+observe = _registry.observe
+flush = _registry.flush
+snapshot = _registry.snapshot
+
+
+def enable(metrics_dir, interval=30.0, snapshots=False):
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, PROCESS_GLOB)):
+        os.remove(path)
+    _registry.metrics_dir = metrics_dir
+    _registry.interval = interval
+    _registry.snapshots = snapshots
+    _registry.pid = os.getpid()
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def stage(name):
+    with timer(f"{name}.seconds"):
+        yield
+    flush()
+
+
+def _derived(totals, uptime):
+    counters = totals["counters"]
+    timers = totals["timers"]
+    derived = {}
+    for name, value in counters.items():
+        stage_name = name.split(".", 1)[0]
+        seconds = timers.get(f"{stage_name}.seconds", {}).get("seconds")
+        if seconds:
+            derived[f"{name}_per_second"] = value / seconds
+        if name.endswith(".hits"):
+            base = name[: -len(".hits")]
+            lookups = value + counters.get(f"{base}.misses", 0)
+            if lookups:
+                derived[f"{base}.hit_rate"] = value / lookups
+    for name, timer in timers.items():
+        if name.endswith(".busy") and uptime:
+            derived[f"{name}_ratio"] = timer["seconds"] / uptime
+    return derived
+
+
+def merge(metrics_dir):
+    processes = []
+    for path in glob.glob(os.path.join(metrics_dir, PROCESS_GLOB)):
+        try:
+            with open(path) as f:
+                processes.append(ujson.load(f))
+        except (OSError, ValueError):
+            continue
+    if os.getpid() not in {p["pid"] for p in processes}:
+        processes.append(snapshot())
+
+    totals = {"counters": defaultdict(float), "gauge_max": {}, "timers": {}}
+    for p in processes:
+        for name, value in p["counters"].items():
+            totals["counters"][name] += value
+        for name, value in p["gauge_max"].items():
+            totals["gauge_max"][name] = max(value, totals["gauge_max"].get(name, value))
+        for name, t in p["timers"].items():
+            total = totals["timers"].setdefault(
+                name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            total["count"] += t["count"]
+            total["seconds"] += t["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], t["max_seconds"])
+        p["derived"] = _derived(p, p["uptime_seconds"])
+
+    totals["counters"] = dict(totals["counters"])
+    main = next((p for p in processes if p["pid"] == _registry.pid), snapshot())
+    totals["derived"] = _derived(totals, None)
+    return {
+        "time": time.time(),
+        "elapsed_seconds": main["uptime_seconds"],
+        "peak_rss_bytes": max(p["peak_rss_bytes"] for p in processes),
+        "total_peak_rss_bytes": sum(p["peak_rss_bytes"] for p in processes),
+        "totals": totals,
+        "processes": sorted(processes, key=lambda p: p["pid"]),
+    }
+
+
+def _log_progress(merged):
+    rates = {
+        name: round(value)
+        for name, value in merged["totals"]["derived"].items()
+        if name.endswith("_per_second")
+    }
+    logger.info(
+        f"Metrics: {merged['elapsed_seconds']:.0f}s, "
+        f"peak RSS {merged['peak_rss_bytes'] / 1e9:.1f}GB, rates {rates}"
+    )
+
+
+def write_report(path, metrics_dir=None):
+    flush()
+    metrics_dir = metrics_dir or _registry.metrics_dir
+    report = merge(metrics_dir) if metrics_dir else merge_local()
+    with open(path, "w") as f:
+        ujson.dump(report, f, indent=2)
+    logger.info(f"Wrote metrics report to {path}")
+    return report
+
+
+def merge_local():
+    # Without enable() only this process's metrics are known
+    current = snapshot()
+    current["derived"] = _derived(current, current["uptime_seconds"])
+    return {
+        "time": current["time"],
+        "elapsed_seconds": current["uptime_seconds"],
+        "peak_rss_bytes": current["peak_rss_bytes"],
+        "totals": {
+            "counters": current["counters"],
+            "gauge_max": current["gauge_max"],
+            "timers": current["timers"],
+            "derived": _derived(current, None),
+        },
+        "processes": [current],
+    }
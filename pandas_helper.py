@@ -1,9 +1,24 @@
 import pandas as pd
 import numpy as np
 import functools
+import hashlib
+import logging
+import os
+import shutil
+import ujson
+import unicodedata
+import warnings
+import weakref
 from numpy import cos, sin, arcsin, sqrt
 from math import radians
+import scipy.sparse
+from scipy.spatial import cKDTree
 from pipelines import buffered_stream
+import columnar
+import sharding
+import multiprocessing
+
+logger = logging.getLogger(__name__)
 
 
 class Concepts:
@@ -31,59 +46,736 @@ class Countries:
     ITALY = "Q38"
 
 
-def load_wikis(datapath):
+EARTH_RADIUS_KM = 6367
+
+
+def _unit_vectors(lat, lng):
+    lat, lng = np.radians(lat), np.radians(lng)
+    return np.column_stack((cos(lat) * cos(lng), cos(lat) * sin(lng), sin(lat)))
+
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * arcsin(np.minimum(chord / 2, 1.0))
+
+
+def _km_to_chord(km):
+    return 2 * sin(np.minimum(km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+
+def _finite_points(lats, lngs):
+    # Points without coordinates match nothing; returns the positions of the
+    # others and their unit vectors
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lngs))
+    return valid, _unit_vectors(lats[valid], lngs[valid])
+
+
+class SpatialIndex:
+    # A k-d tree over unit-sphere vectors of the rows with coordinates, so
+    # radius and nearest queries for many centers share one build. Chord
+    # distances are converted to great-circle km.
+    def __init__(self, lat, lng, index):
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        self.positions = np.flatnonzero(np.isfinite(lat) & np.isfinite(lng))
+        self.index = index
+        self.tree = cKDTree(_unit_vectors(lat[self.positions], lng[self.positions]))
+
+    def _grouped(self, centers, center_idx, positions, km):
+        return pd.DataFrame(
+            {"distance_km": km},
+            index=pd.MultiIndex.from_arrays(
+                [centers[center_idx], self.index[self.positions[positions]]],
+                names=["center", self.index.name or "concept_id"],
+            ),
+        )
+
+    def _empty(self, centers):
+        none = np.empty(0, dtype=np.int64)
+        return self._grouped(centers, none, none, np.empty(0))
+
+    def within_radius(self, lats, lngs, centers, radius_km=50):
+        # Rows within radius_km of each center, nearest first per center
+        valid, points = _finite_points(lats, lngs)
+        if len(valid) == 0 or len(self.positions) == 0:
+            return self._empty(centers)
+        matches = self.tree.query_ball_point(points, _km_to_chord(radius_km))
+        point_idx = np.repeat(np.arange(len(points)), [len(m) for m in matches])
+        positions = np.fromiter(
+            (p for m in matches for p in m), dtype=np.int64, count=len(point_idx)
+        )
+        chord = np.linalg.norm(self.tree.data[positions] - points[point_idx], axis=1)
+        center_idx = valid[point_idx]
+        order = np.lexsort((chord, center_idx))
+        return self._grouped(
+            centers, center_idx[order], positions[order], _chord_to_km(chord[order])
+        )
+
+    def nearest(self, lats, lngs, centers, k=10):
+        valid, points = _finite_points(lats, lngs)
+        k = min(k, len(self.positions))
+        if len(valid) == 0 or k <= 0:
+            return self._empty(centers)
+        chord, positions = self.tree.query(points, k=k)
+        chord = np.asarray(chord).reshape(len(points), k)
+        positions = np.asarray(positions).reshape(len(points), k)
+        return self._grouped(
+            centers,
+            np.repeat(valid, k),
+            positions.ravel(),
+            _chord_to_km(chord.ravel()),
+        )
+
+
+def fold_label(label):
+    # Compatibility-decomposed and casefolded with combining marks dropped,
+    # so "Musée du Louvre" and "musee du louvre" match
+    if not isinstance(label, str):
+        return label
+    decomposed = unicodedata.normalize("NFKD", label)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class LabelIndex:
+    # Row positions by label, sorted so each label's rows are one slice of
+    # order. Labels are factorized once, so a lookup is a hash probe and a
+    # batch of labels one get_indexer. Folded indexes fold the distinct
+    # labels, not every row.
+    def __init__(self, values, index, folded=False):
+        codes, uniques = pd.factorize(values)
+        if folded:
+            folded_codes, uniques = pd.factorize(
+                np.array([fold_label(u) for u in uniques], dtype=object)
+            )
+            codes = np.where(codes >= 0, folded_codes[codes], -1)
+        self.keys = pd.Index(uniques)
+        self.index = index
+        self.folded = folded
+        self.counts = np.bincount(codes[codes >= 0], minlength=len(self.keys))
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        # Missing labels (code -1) sort first and are dropped
+        self.order = np.argsort(codes, kind="stable")[len(codes) - self.offsets[-1] :]
+
+    def _codes(self, labels):
+        if self.folded:
+            labels = [fold_label(label) for label in labels]
+        return self.keys.get_indexer(labels)
+
+    def positions(self, label):
+        code = self._codes([label])[0]
+        if code < 0:
+            return self.order[:0]
+        return self.order[self.offsets[code] : self.offsets[code + 1]]
+
+    def concept_ids(self, label):
+        return self.index[self.positions(label)]
+
+    def resolve(self, labels):
+        # For each label, how many rows match and the concept_id when
+        # exactly one does
+        labels = list(labels)
+        codes = self._codes(labels)
+        found = codes >= 0
+        matches = np.zeros(len(codes), dtype=np.int64)
+        matches[found] = self.counts[codes[found]]
+        unique = matches == 1
+        concept_ids = np.full(len(codes), None, dtype=object)
+        concept_ids[unique] = self.index.values[self.order[self.offsets[codes[unique]]]]
+        return pd.DataFrame(
+            {"concept_id": concept_ids, "matches": matches},
+            index=pd.Index(labels, dtype=object, name="label"),
+        )
+
+
+# Per-frame caches keyed by id(frame), holding (fingerprint, value). Entries
+# go away with their frame; a changed fingerprint rebuilds the value.
+_spatial_indexes = {}
+_class_matrices = {}
+# Holding a dict of (fingerprint, LabelIndex) by (column, folded)
+_label_indexes = {}
+
+
+def _column_token(values):
+    # Changes when a column is replaced: its buffer address, or for
+    # extension arrays the array itself
+    if isinstance(values, np.ndarray):
+        return values.__array_interface__["data"][0]
+    return id(values)
+
+
+def _cached_for_frame(cache, df, fingerprint, build):
+    entry = cache.get(id(df))
+    if entry is None or entry[0] != fingerprint:
+        if entry is None:
+            weakref.finalize(df, cache.pop, id(df), None)
+        entry = cache[id(df)] = (fingerprint, build())
+    return entry[1]
+
+
+def parse_class_lists(series):
+    # Comma-joined Q-id strings to a CSR list (indptr, integer Q-ids). The
+    # lists are joined and parsed by numpy in one go; anything unexpected,
+    # like empty entries, falls back to splitting each list.
+    values = [v if isinstance(v, str) else "" for v in series.values]
+    counts = np.fromiter(
+        (v.count(",") + 1 if v else 0 for v in values),
+        dtype=np.int64,
+        count=len(values),
+    )
+    text = ",".join(v for v in values if v).replace("Q", "")
+    try:
+        with warnings.catch_warnings():
+            # Older numpy stops at the first bad entry with a warning
+            warnings.simplefilter("error", DeprecationWarning)
+            qids = np.fromstring(text, dtype=np.int64, sep=",")
+    except (ValueError, DeprecationWarning):
+        qids = None
+    if qids is None or len(qids) != counts.sum():
+        exploded = series.reset_index(drop=True).fillna("").str.split(",").explode()
+        exploded = exploded[exploded.str.len() > 0]
+        counts = np.bincount(
+            exploded.index.values.astype(np.int64), minlength=len(series)
+        )
+        qids = exploded.str[1:].values
+    indptr = np.zeros(len(series) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, qids.astype(np.int64)
+
+
+class ClassMatrix:
+    # A rows x classes CSR matrix of class membership, with the sorted
+    # integer Q-ids of its columns as the vocabulary. Class filters become
+    # column lookups and per-class sums a sparse matrix-vector product.
+    def __init__(self, matrix, class_qids):
+        self.matrix = matrix
+        self.class_qids = class_qids
+        self._csc = None
+
+    @classmethod
+    def from_series(cls, series):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Each distinct class list is parsed once; code -1 (missing)
+            # picks the trailing empty row
+            categories = pd.Series(list(series.cat.categories) + [np.nan], dtype=object)
+            parsed = cls.from_series(categories)
+            return cls(parsed.matrix[series.cat.codes.values], parsed.class_qids)
+        indptr, qids = parse_class_lists(series)
+        class_qids, columns = np.unique(qids, return_inverse=True)
+        matrix = scipy.sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.float32), columns, indptr),
+            shape=(len(series), len(class_qids)),
+        )
+        # Repeated classes in a row count once
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+        return cls(matrix, class_qids)
+
+    def column(self, class_id):
+        q = int(class_id[1:])
+        pos = np.searchsorted(self.class_qids, q)
+        if pos < len(self.class_qids) and self.class_qids[pos] == q:
+            return pos
+        return -1
+
+    def column_index(self):
+        # The CSC copy has_class reads columns from, built on first use
+        if self._csc is None:
+            self._csc = self.matrix.tocsc()
+        return self._csc
+
+    def has_class(self, class_id):
+        mask = np.zeros(self.matrix.shape[0], dtype=bool)
+        col = self.column(class_id)
+        if col >= 0:
+            csc = self.column_index()
+            start, end = csc.indptr[col], csc.indptr[col + 1]
+            mask[csc.indices[start:end]] = True
+        return mask
+
+    def has_any(self, class_mask):
+        # Rows with any class where class_mask (over the vocabulary) is set
+        return self.matrix.dot(class_mask.astype(np.float32)) > 0
+
+    def class_sums(self, weights, rows=None):
+        # Per-class sums of row weights (a vector, or rows x k for k sums at
+        # once), optionally over a subset of rows
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        return matrix.T.dot(np.nan_to_num(np.asarray(weights, dtype=np.float64)))
+
+
+def load_headers(datapath):
     datapath = str(datapath)
+    if columnar.is_columnar(datapath):
+        return list(columnar.read_manifest(datapath)["columns"])
+    elif sharding.is_sharded(datapath):
+        return [c["name"] for c in sharding.read_manifest(datapath)["columns"]]
     with buffered_stream(datapath, bufsize_mb=1) as f:
-        headers = next(f).split()
-    return set(e.split("_")[0] for e in headers if "wiki_" in e)
+        return next(f).split()
+
+
+def load_wikis(datapath):
+    return set(e.split("_")[0] for e in load_headers(datapath) if "wiki_" in e)
+
+
+def _read_frame(datapath, wikis, usecols=None, limit=None):
+    if columnar.is_columnar(datapath):
+        df = columnar.load_columnar_frame(datapath, usecols=usecols)
+        return df.iloc[:limit] if limit is not None else df
+    elif sharding.is_sharded(datapath):
+        if limit is None:
+            return load_shards(datapath, usecols=usecols)
+        frames = []
+        for shard in iter_shards(datapath, usecols=usecols):
+            frames.append(shard)
+            if sum(len(f) for f in frames) >= limit:
+                break
+        return pd.concat(frames).iloc[:limit]
+
+    return _read_tsv(datapath, wikis, usecols=usecols, limit=limit)
+
+
+def _read_tsv_shard(args):
+    return _read_tsv(*args)
+
+
+def iter_shards(datapath, usecols=None):
+    # Shards are yielded as typed but unnormalized frames, since pagerank
+    # normalization needs sums over the whole dataset
+    datapath = str(datapath)
+    wikis = load_wikis(datapath)
+    for path in sharding.shard_paths(datapath):
+        yield _read_tsv(path, wikis, usecols=usecols)
 
 
-def load_data(datapath, usecols=None, limit=None):
+def load_shards(datapath, usecols=None, processes=None):
     datapath = str(datapath)
     wikis = load_wikis(datapath)
-    df = pd.read_csv(
+    with multiprocessing.Pool(processes) as pool:
+        frames = pool.map(
+            _read_tsv_shard,
+            [(path, wikis, usecols) for path in sharding.shard_paths(datapath)],
+            chunksize=1,
+        )
+    return pd.concat(frames)
+
+
+CLASS_COLUMNS = (
+    "instance_of",
+    "direct_instance_of",
+    "recursive_instance_of",
+    "direct_subclass_of",
+    "recursive_subclass_of",
+)
+
+
+ATTRIBUTE_GROUPS = {
+    "coords": [
+        "coord_latitude",
+        "coord_longitude",
+        "coord_altitude",
+        "coord_precision",
+    ],
+    "dates": ["publication_date"],
+    "classes": list(CLASS_COLUMNS),
+    "countries": ["country_of_origin"],
+}
+
+
+def select_columns(headers, wikis=None, attributes=None):
+    # The columns of the given wikis and ATTRIBUTE_GROUPS, in file order;
+    # None for either selects all of them
+    available = set(e.split("_")[0] for e in headers if "wiki_" in e)
+    wanted = {"concept_id", "sample_label"}
+    for wiki in sorted(available) if wikis is None else wikis:
+        if wiki not in available:
+            raise RuntimeError(f"No {wiki} columns, only {sorted(available)}")
+        wanted |= {f"{wiki}_title", f"{wiki}_pagerank"}
+    for group in ATTRIBUTE_GROUPS if attributes is None else attributes:
+        if group not in ATTRIBUTE_GROUPS:
+            raise RuntimeError(f"Unknown attribute group {group}")
+        wanted |= set(ATTRIBUTE_GROUPS[group])
+    return [h for h in headers if h in wanted]
+
+
+def _tsv_dtypes(wikis, downcast=False):
+    # Downcast for streaming: float32 pageranks, and class lists and
+    # countries as categoricals, since few distinct values repeat a lot
+    text = "category" if downcast else "str"
+    return {
+        "concept_id": "str",
+        "sample_label": "str",
+        "country_of_origin": text,
+        "publication_date": "float",
+        **{column: text for column in CLASS_COLUMNS},
+        **{f"{wiki}_title": "unicode" for wiki in wikis},
+        **{f"{wiki}_pagerank": "float32" if downcast else "float64" for wiki in wikis},
+    }
+
+
+def _read_tsv(datapath, wikis, usecols=None, limit=None):
+    return pd.read_csv(
         datapath,
         sep="\t",
         index_col="concept_id",
         usecols=usecols,
         nrows=limit,
-        dtype={
-            "concept_id": "str",
-            "instance_of": "str",
-            "direct_instance_of": "str",
-            "sample_label": "str",
-            "country_of_origin": "str",
-            "publication_date": "float",
-            **{f"{wiki}_title": "unicode" for wiki in wikis},
-            **{f"{wiki}_pagerank": "float64" for wiki in wikis},
-        },
+        dtype=_tsv_dtypes(wikis),
     )
 
-    df["publication_date"] = pd.to_datetime(
-        df["publication_date"], unit="s", errors="coerce"
-    )
+
+def _load_frame(datapath, usecols=None, limit=None):
+    wikis = load_wikis(datapath)
+    df = _read_frame(datapath, wikis, usecols=usecols, limit=limit)
+
+    if "publication_date" in df.columns:
+        df["publication_date"] = pd.to_datetime(
+            df["publication_date"], unit="s", errors="coerce"
+        )
 
     for wiki in wikis:
-        if usecols is None or f"{wiki}_pagerank" in usecols:
+        if f"{wiki}_pagerank" in df.columns:
             df[f"{wiki}_pagerank"] /= df[f"{wiki}_pagerank"].sum()
 
     return df
 
 
+LOAD_CACHE_DIR = ".load_data_cache"
+# Bumped whenever _load_frame's output changes, to drop old snapshots
+LOAD_CACHE_VERSION = 1
+
+
+def _source_stat(datapath):
+    if sharding.is_sharded(datapath):
+        paths = [os.path.join(datapath, sharding.MANIFEST_NAME)]
+        paths += list(sharding.shard_paths(datapath))
+    else:
+        paths = [datapath]
+    stats = [os.stat(path) for path in paths]
+    return sum(s.st_size for s in stats), max(s.st_mtime_ns for s in stats)
+
+
+def _load_cache_entry(datapath, usecols, cache_dir):
+    source = os.path.abspath(datapath)
+    size, mtime_ns = _source_stat(datapath)
+    key = {
+        "source": source,
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "usecols": sorted(usecols) if usecols is not None else None,
+        "version": LOAD_CACHE_VERSION,
+    }
+    digest = hashlib.sha256(ujson.dumps(key, sort_keys=True).encode("utf-8"))
+    cache_dir = cache_dir or os.path.join(os.path.dirname(source), LOAD_CACHE_DIR)
+    name = f"{os.path.basename(source)}.{digest.hexdigest()[:16]}"
+    return os.path.join(cache_dir, name), key
+
+
+def _prune_load_cache(path, key):
+    # Snapshots of earlier versions of the same source are stale
+    cache_dir, name = os.path.split(path)
+    prefix = name.rsplit(".", 1)[0] + "."
+    for other in os.listdir(cache_dir):
+        other_path = os.path.join(cache_dir, other)
+        if other == name or not other.startswith(prefix):
+            continue
+        if not columnar.is_columnar(other_path):
+            continue
+        other_key = columnar.read_manifest(other_path).get("load_data", {})
+        if other_key.get("source") == key["source"] and (
+            other_key.get("usecols") == key["usecols"]
+        ):
+            shutil.rmtree(other_path, ignore_errors=True)
+
+
+def _write_load_cache(df, path, key):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        columnar.write_frame(tmp_path, df, extra={"load_data": key})
+        os.rename(tmp_path, path)
+        _prune_load_cache(path, key)
+        logger.info(f"Cached {key['source']} in {path}")
+    except OSError as e:
+        # e.g. a read-only data directory, or another process got there first
+        logger.warning(f"Could not cache {key['source']}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Frames from load_data by id(frame), holding where the frame was loaded
+# from, for loading further columns on first use
+_frame_sources = {}
+
+
+def load_data(
+    datapath,
+    usecols=None,
+    limit=None,
+    class_matrix=False,
+    cache=True,
+    cache_dir=None,
+    wikis=None,
+    attributes=None,
+    top_views=None,
+):
+    # datapath is either a TSV from write_csv or a columnar dataset directory.
+    # A full load of a TSV is snapshotted, typed and normalized, as a columnar
+    # dataset in cache_dir (by default .load_data_cache next to the data),
+    # keyed on the source's path, size and mtime and on usecols. Later loads
+    # memory-map the snapshot instead of parsing the TSV.
+    # wikis and attributes (names of ATTRIBUTE_GROUPS) select columns on top
+    # of usecols; the accessor loads other wikis' and attributes' columns
+    # when it first needs them.
+    # class_matrix parses the instance-of columns into ClassMatrix up front,
+    # rather than on the first class filter. top_views is a saved TopViews
+    # for top_ranked to answer from.
+    datapath = str(datapath)
+    if wikis is not None or attributes is not None:
+        selected = select_columns(load_headers(datapath), wikis, attributes)
+        usecols = selected + [c for c in usecols or [] if c not in selected]
+    source = (datapath, limit, cache, cache_dir)
+    cache = cache and limit is None and not columnar.is_columnar(datapath)
+
+    if cache:
+        path, key = _load_cache_entry(datapath, usecols, cache_dir)
+    if cache and columnar.is_columnar(path):
+        # Copy-on-write, so the frame can be modified like a parsed one
+        df = columnar.load_columnar_frame(path, mmap_mode="c")
+    else:
+        df = _load_frame(datapath, usecols=usecols, limit=limit)
+        if cache:
+            _write_load_cache(df, path, key)
+
+    _frame_sources[id(df)] = source
+    weakref.finalize(df, _frame_sources.pop, id(df), None)
+
+    if class_matrix:
+        for direct in (True, False):
+            if _instance_key(df.columns, direct) in df.columns:
+                df.wl.class_matrix(direct=direct)
+    if top_views is not None:
+        df.wl.use_top_views(top_views)
+
+    return df
+
+
+def _load_missing(df, columns):
+    # Adds the columns df lacks from the dataset it was loaded from, if it
+    # came from load_data; derived frames are left alone
+    source = _frame_sources.get(id(df))
+    missing = [c for c in columns if c not in df.columns]
+    if source is None or not missing:
+        return
+    datapath, limit, cache, cache_dir = source
+    missing = [c for c in missing if c in load_headers(datapath)]
+    if not missing:
+        return
+    logger.info(f"Loading {', '.join(missing)} from {datapath}")
+    snapshot = None
+    if cache and limit is None and not columnar.is_columnar(datapath):
+        snapshot, _ = _load_cache_entry(datapath, None, cache_dir)
+    if snapshot is not None and columnar.is_columnar(snapshot):
+        # A full snapshot already has every column
+        loaded = columnar.load_columnar_frame(snapshot, usecols=missing, mmap_mode="c")
+    else:
+        # Not cached, or each set of lazily loaded columns would leave a
+        # snapshot of its own
+        loaded = load_data(
+            datapath, usecols=["concept_id"] + missing, limit=limit, cache=False
+        )
+    for column in missing:
+        df[column] = loaded[column].reindex(df.index)
+
+
+def _instance_key(columns, direct):
+    if direct:
+        return "direct_instance_of"
+    # Older datasets name the recursive column instance_of
+    return "instance_of" if "instance_of" in columns else "recursive_instance_of"
+
+
+def _named_ids(constants):
+    return [v for k, v in vars(constants).items() if not k.startswith("_")]
+
+
+def _heads_by_code(positions, codes, wanted, k):
+    # The first k positions of each wanted code, keeping their order
+    by_code = np.argsort(codes, kind="stable")
+    sorted_codes = codes[by_code]
+    heads = {}
+    for code in wanted:
+        start = np.searchsorted(sorted_codes, code)
+        end = min(start + k, np.searchsorted(sorted_codes, code, side="right"))
+        if end > start:
+            heads[code] = positions[by_code[start:end]]
+    return heads
+
+
+class TopViews:
+    # Precomputed top_ranked(wiki) concept lists, overall and restricted to
+    # popular classes, popular countries of origin and their intersections.
+    # Lists hold integer Q-ids, concatenated with offsets by key
+    # "wiki|class|country". Classes are matched like is_instance_of.
+    def __init__(self, keys, offsets, qids, classes, countries, k, rows):
+        self.keys = {key: i for i, key in enumerate(keys)}
+        self.offsets = offsets
+        self.qids = qids
+        self.classes = set(classes)
+        self.countries = set(countries)
+        self.k = k
+        self.rows = rows
+
+    @classmethod
+    def build(cls, df, k=200, num_classes=500, num_countries=100, wikis=None):
+        # Popular classes and countries are those with the most rows, plus
+        # the ones named in Concepts and Countries
+        wikis = wikis or _pagerank_wikis(df.columns)
+        matrix = df.wl.class_matrix()
+        sizes = np.diff(matrix.matrix.tocsc().indptr)
+        columns = np.argsort(-sizes, kind="stable")[:num_classes]
+        named = [matrix.column(c) for c in _named_ids(Concepts)]
+        columns = np.unique(np.concatenate((columns, [c for c in named if c >= 0])))
+        classes = [f"Q{q}" for q in matrix.class_qids[columns]]
+        class_rows = matrix.matrix[:, columns]
+
+        df.wl._load_missing(ATTRIBUTE_GROUPS["countries"])
+        codes, countries = pd.factorize(df["country_of_origin"].values)
+        codes = codes.astype(np.int64)
+        country_sizes = np.bincount(codes[codes >= 0], minlength=len(countries))
+        popular = list(np.argsort(-country_sizes, kind="stable")[:num_countries])
+        popular += [
+            i for i, c in enumerate(countries) if c in _named_ids(Countries)
+        ]
+        popular = sorted(set(popular))
+
+        qids = df.index.str[1:].astype(np.int64).values
+        lists = {}
+        for wiki in wikis:
+            df.wl._load_wikis([wiki])
+            pagerank = df[f"{wiki}_pagerank"].values
+            ranked = np.flatnonzero(df[f"{wiki}_title"].notna().values & ~np.isnan(pagerank))
+            ranked = ranked[np.argsort(-pagerank[ranked], kind="stable")]
+            ranked_codes = codes[ranked]
+
+            lists[f"{wiki}||"] = ranked[:k]
+            for code, rows in _heads_by_code(ranked, ranked_codes, popular, k).items():
+                lists[f"{wiki}||{countries[code]}"] = rows
+            # Class columns of the rows in rank order list each class's rows
+            # best first
+            by_rank = class_rows[ranked].tocsc()
+            for j, class_id in enumerate(classes):
+                positions = by_rank.indices[by_rank.indptr[j] : by_rank.indptr[j + 1]]
+                lists[f"{wiki}|{class_id}|"] = ranked[positions[:k]]
+                heads = _heads_by_code(
+                    ranked[positions], ranked_codes[positions], popular, k
+                )
+                for code, rows in heads.items():
+                    lists[f"{wiki}|{class_id}|{countries[code]}"] = rows
+
+        keys = sorted(lists)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(lists[key]) for key in keys], out=offsets[1:])
+        logger.info(f"Built {len(keys)} top-{k} views over {len(wikis)} wikis")
+        return cls(
+            keys,
+            offsets,
+            np.concatenate([qids[lists[key]] for key in keys] + [np.empty(0, np.int64)]),
+            classes,
+            [countries[code] for code in popular],
+            k,
+            len(df),
+        )
+
+    def save(self, path):
+        # An open file, so numpy doesn't append .npz to the name
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                keys=np.array(sorted(self.keys, key=self.keys.get)),
+                offsets=self.offsets,
+                qids=self.qids,
+                classes=np.array(sorted(self.classes)),
+                countries=np.array(sorted(self.countries)),
+                shape=np.array([self.k, self.rows]),
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            k, rows = f["shape"]
+            return cls(
+                list(f["keys"]),
+                f["offsets"],
+                f["qids"],
+                list(f["classes"]),
+                list(f["countries"]),
+                int(k),
+                int(rows),
+            )
+
+    def lookup(self, wiki, n, instance_of=None, country=None):
+        # Concept ids best first, or None if the views don't cover the query
+        if n > self.k:
+            return None
+        key = f"{wiki}|{instance_of or ''}|{country or ''}"
+        i = self.keys.get(key)
+        if i is None:
+            covered = (
+                f"{wiki}||" in self.keys
+                and (instance_of is None or instance_of in self.classes)
+                and (country is None or country in self.countries)
+            )
+            # Popular restrictions without rows aren't stored
+            return [] if covered else None
+        start = self.offsets[i]
+        end = min(self.offsets[i + 1], start + n)
+        return [f"Q{q}" for q in self.qids[start:end]]
+
+
+# Frames by id(frame), holding the TopViews top_ranked answers from
+_top_views = {}
+
+
+DIVERGENCE_BLOCK_ROWS = 1_000_000
+
+
 @pd.api.extensions.register_dataframe_accessor("wl")
 class WikilanguageAccessor:
     def __init__(self, pandas_obj):
-        self._validate(pandas_obj)
         self._df = pandas_obj
         self.concepts = Concepts
 
-    @staticmethod
-    def _validate(obj):
-        # verify there is a column latitude and a column longitude
-        if "coord_latitude" not in obj.columns or "coord_longitude" not in obj.columns:
-            raise AttributeError("Must have 'latitude' and 'longitude'.")
+    def _require_coordinates(self):
+        # Frames from a partial load_data, or derived from one, may lack them
+        _load_missing(self._df, ATTRIBUTE_GROUPS["coords"])
+        missing = [
+            c for c in ("coord_latitude", "coord_longitude") if c not in self._df.columns
+        ]
+        if missing:
+            raise RuntimeError(
+                f"Need coordinates, but the frame has no {' or '.join(missing)}"
+            )
+
+    def _load_missing(self, columns):
+        _load_missing(self._df, columns)
+
+    def _load_wikis(self, wikis):
+        _load_missing(
+            self._df, [f"{wiki}_{c}" for wiki in wikis for c in ("title", "pagerank")]
+        )
+
+    def use_top_views(self, views):
+        # views is a TopViews or the path of a saved one
+        if not isinstance(views, TopViews):
+            views = TopViews.load(views)
+        if views.rows != len(self._df):
+            raise RuntimeError(
+                f"Views of {views.rows} rows don't match a frame of {len(self._df)}"
+            )
+        _top_views[id(self._df)] = views
+        weakref.finalize(self._df, _top_views.pop, id(self._df), None)
 
     def haversine(self, src_lat, src_lng):
+        self._require_coordinates()
         target_lat = self._df["coord_latitude"]
         target_lng = self._df["coord_longitude"]
         src_lng, src_lat, target_lng, target_lat = map(
@@ -96,32 +788,145 @@ class WikilanguageAccessor:
         km = 6367 * c
         return km
 
-    def resolve_label(self, label_name, col="sample_label"):
-        vals = self._df.loc[self._df[col] == label_name]
-        assert len(vals) == 1, f"Too many or few rows found ({len(vals)})"
-        return vals.index.values[0]
+    def _coordinates_fingerprint(self):
+        self._require_coordinates()
+        # The index must notice when rows or coordinates change under it:
+        # replaced columns move their buffers, and in-place edits change the
+        # sums
+        lat = self._df["coord_latitude"].values
+        lng = self._df["coord_longitude"].values
+        return (
+            len(self._df),
+            id(self._df.index),
+            _column_token(lat),
+            _column_token(lng),
+            float(np.nansum(lat)),
+            float(np.nansum(lng)),
+        )
+
+    def spatial_index(self):
+        return _cached_for_frame(
+            _spatial_indexes,
+            self._df,
+            self._coordinates_fingerprint(),
+            lambda: SpatialIndex(
+                self._df["coord_latitude"].values,
+                self._df["coord_longitude"].values,
+                self._df.index,
+            ),
+        )
 
-    def resolve(self, label_name, col="sample_label"):
-        return self._df.loc[[self.resolve_label(label_name, col)]]
+    @staticmethod
+    def _centers(centers):
+        # A frame with coordinates, or a sequence of (lat, lng) pairs
+        if isinstance(centers, pd.DataFrame):
+            centers.wl._require_coordinates()
+            return (
+                centers["coord_latitude"].values,
+                centers["coord_longitude"].values,
+                centers.index.values,
+            )
+        points = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        return points[:, 0], points[:, 1], np.arange(len(points))
+
+    def near_each(self, centers, radius_km=50):
+        # For each center, the rows within radius_km, indexed by
+        # (center, concept_id) with a distance_km column
+        lats, lngs, labels = self._centers(centers)
+        return self.spatial_index().within_radius(lats, lngs, labels, radius_km)
+
+    def nearest_each(self, centers, k=10):
+        # For each center, its k nearest rows, indexed like near_each
+        lats, lngs, labels = self._centers(centers)
+        return self.spatial_index().nearest(lats, lngs, labels, k)
+
+    def label_index(self, col="sample_label", folded=False):
+        # Built once per frame and column, e.g. sample_label or enwiki_title,
+        # and again if the column is replaced. Folded indexes ignore case
+        # and diacritics.
+        _load_missing(self._df, [col])
+        indexes = _cached_for_frame(
+            _label_indexes, self._df, (len(self._df), id(self._df.index)), dict
+        )
+        values = self._df[col].values
+        entry = indexes.get((col, folded))
+        if entry is None or entry[0] != _column_token(values):
+            entry = indexes[(col, folded)] = (
+                _column_token(values),
+                LabelIndex(values, self._df.index, folded),
+            )
+        return entry[1]
+
+    def resolve_label(self, label_name, col="sample_label", folded=False):
+        concept_ids = self.label_index(col, folded).concept_ids(label_name)
+        # Ambiguous labels name (some of) their rows
+        found = ", ".join(map(str, concept_ids[:10]))
+        assert len(concept_ids) == 1, (
+            f"Too many or few rows found ({len(concept_ids)}) {found}"
+        )
+        return concept_ids[0]
+
+    def resolve(self, label_name, col="sample_label", folded=False):
+        return self._df.loc[[self.resolve_label(label_name, col, folded)]]
+
+    def resolve_labels(self, labels, col="sample_label", folded=False):
+        # Many labels at once: concept_id (None unless exactly one row
+        # matches) and matches, indexed by label
+        return self.label_index(col, folded).resolve(labels)
+
+    def class_matrix(self, direct=False):
+        # Parsed once per frame, and again only if the column is replaced
+        # Older datasets name the recursive column instance_of
+        _load_missing(
+            self._df,
+            ["direct_instance_of"] if direct else ["instance_of", "recursive_instance_of"],
+        )
+        key = _instance_key(self._df.columns, direct)
+        values = self._df[key].values
+        fingerprint = (len(self._df), id(self._df.index), _column_token(values))
+        return _cached_for_frame(
+            _class_matrices.setdefault(key, {}),
+            self._df,
+            fingerprint,
+            lambda: ClassMatrix.from_series(self._df[key]),
+        )
 
     # Boolean indexers
-    def is_instance_of(self, instance_of_id, direct=False):
-        key = "direct_instance_of" if direct else "instance_of"
-        return self._df[key].str.contains(f"{instance_of_id}[,$]", na=False)
+    def is_instance_of(self, instance_of_id, direct=False, reachability=None):
+        if reachability is not None and not direct:
+            # Any direct class that is a subclass, checked once per class
+            matrix = self.class_matrix(direct=True)
+            mask = matrix.has_any(
+                reachability.is_subclass_of(matrix.class_qids, instance_of_id)
+            )
+        else:
+            mask = self.class_matrix(direct=direct).has_class(instance_of_id)
+        return pd.Series(mask, index=self._df.index)
 
-    def instance_of(self, instance_of_id, direct=False):
-        return self._df[self.is_instance_of(instance_of_id, direct=direct)]
+    def instance_of(self, instance_of_id, direct=False, reachability=None):
+        return self._df[
+            self.is_instance_of(instance_of_id, direct=direct, reachability=reachability)
+        ]
 
     def is_country_of_origin(self, concept_id):
+        _load_missing(self._df, ATTRIBUTE_GROUPS["countries"])
         return self._df["country_of_origin"] == concept_id
 
     def country_of_origin(self, concept_id):
         return self._df[self.is_country_of_origin(concept_id)]
 
     def is_within_radius(self, lat, lng, radius_km=50):
-        return self.haversine(lat, lng) < radius_km
+        index = self.spatial_index()
+        mask = np.zeros(len(self._df), dtype=bool)
+        valid, points = _finite_points([lat], [lng])
+        if len(valid) and len(index.positions):
+            matches = index.tree.query_ball_point(points[0], _km_to_chord(radius_km))
+            mask[index.positions[np.asarray(matches, dtype=np.int64)]] = True
+        return pd.Series(mask, index=self._df.index)
 
     def within_radius(self, other, radius_km=50):
+        self._require_coordinates()
+        other.wl._require_coordinates()
         if len(self._df) == 1:
             lat, lng = (
                 self._df.iloc[0]["coord_latitude"],
@@ -129,42 +934,75 @@ class WikilanguageAccessor:
             )
             return other[other.wl.is_within_radius(lat, lng, radius_km)]
         elif len(other) == 1:
-            lat, lng = other.iloc[0]["coord_latitude"], other["coord_longitude"]
+            lat, lng = other.iloc[0]["coord_latitude"], other.iloc[0]["coord_longitude"]
             return self._df[self._df.wl.is_within_radius(lat, lng, radius_km)]
         else:
             raise RuntimeError(f"Need exactly one row for nearby")
 
     def is_publication_year(self, year):
+        _load_missing(self._df, ATTRIBUTE_GROUPS["dates"])
         return self._df["publication_date"].dt.to_period("A") == str(year)
 
     def publication_year(self, year):
         return self._df[self._is_publication_year(year)]
 
     # Outputs
-    def best_concepts(self, sample=0.1, n=200, direct=False):
-        key = "direct_instance_of" if direct else "instance_of"
-        instances_of = self._df[key].sample(frac=sample).str.split(",").explode()
-        prob_mass = (
-            pd.concat(
-                (instances_of, self._df.loc[instances_of.index]["enwiki_pagerank"]),
-                axis=1,
-                copy=False,
-            )
-            .groupby([key])
-            .sum()
-            .nlargest(n, "enwiki_pagerank")
+    def best_concepts(self, sample=None, n=200, direct=False, wikis="enwiki"):
+        # Pagerank mass per class, exact over all rows unless a share of
+        # rows to sample is given. wikis is a wiki, a list of wikis or None
+        # for all of them; classes are ranked by the first.
+        if wikis is not None:
+            self._load_wikis(_wiki_list(wikis, self._df.columns))
+        wikis = _wiki_list(wikis, self._df.columns)
+        matrix = self.class_matrix(direct=direct)
+        key = _instance_key(self._df.columns, direct)
+        weights = np.column_stack(
+            [self._df[f"{wiki}_pagerank"].values for wiki in wikis]
         )
+        rows = None
+        if sample is not None:
+            rows = np.sort(
+                np.random.choice(
+                    len(self._df), int(round(sample * len(self._df))), replace=False
+                )
+            )
+            weights = weights[rows]
+        prob_mass = _top_classes(
+            matrix.class_sums(weights, rows=rows), matrix.class_qids, wikis, key, n
+        )
+        # Classes without a row of their own have no label and are dropped
         ret = pd.concat(
-            (self._df.loc[prob_mass.index]["sample_label"], prob_mass),
+            (self._df["sample_label"].reindex(prob_mass.index), prob_mass),
             axis=1,
             copy=False,
         ).dropna()
         return ret
 
-    def top_ranked(self, wiki, n=200, desc=True):
-        ret = self._df[self._df[f"{wiki}_title"].notna()][
-            ["sample_label", f"{wiki}_pagerank"]
-        ]
+    def top_ranked(self, wiki, n=200, desc=True, instance_of=None, country=None):
+        # Optionally among instances of a class and/or concepts from a
+        # country of origin; answered from top views when they cover it
+        self._load_wikis([wiki])
+        views = _top_views.get(id(self._df))
+        ids = None
+        if views is not None and desc and views.rows == len(self._df):
+            ids = views.lookup(wiki, n, instance_of, country)
+        if ids is not None:
+            ret = self._df.loc[ids, ["sample_label", f"{wiki}_pagerank"]]
+            # The best row of the restriction is the max
+            ret[f"{wiki}_relative_to_max"] = (
+                ret[f"{wiki}_pagerank"] / ret[f"{wiki}_pagerank"].max()
+            )
+            return ret
+
+        df = self._df
+        if instance_of is not None or country is not None:
+            mask = np.ones(len(df), dtype=bool)
+            if instance_of is not None:
+                mask &= self.is_instance_of(instance_of).values
+            if country is not None:
+                mask &= self.is_country_of_origin(country).values
+            df = df[mask]
+        ret = df[df[f"{wiki}_title"].notna()][["sample_label", f"{wiki}_pagerank"]]
         ret[f"{wiki}_relative_to_max"] = (
             ret[f"{wiki}_pagerank"] / ret[f"{wiki}_pagerank"].max()
         )
@@ -176,6 +1014,7 @@ class WikilanguageAccessor:
     def top_by_year(
         self, top_col="enwiki_pagerank", date_col="publication_date", n=200
     ):
+        _load_missing(self._df, [top_col, date_col])
         by_year = (
             self._df.groupby(self._df[date_col].dt.to_period("A"))[top_col]
             .idxmax()
@@ -186,29 +1025,462 @@ class WikilanguageAccessor:
     def kl_divergence(
         self, base_wiki, target_wiki, n=200, marginals=True, importance_weight=1
     ):
-        matching_rows = self._df.loc[
-            self._df[f"{base_wiki}_title"].notna()
-            & self._df[f"{target_wiki}_title"].notna()
-        ].copy()
+        self._load_wikis([base_wiki, target_wiki])
+        matching_rows = self._df.loc[_matching(self._df, base_wiki, target_wiki)].copy()
         if marginals:
-            matching_rows[f"{base_wiki}_pagerank"] /= matching_rows[
-                f"{base_wiki}_pagerank"
-            ].sum()
-            matching_rows[f"{target_wiki}_pagerank"] /= matching_rows[
-                f"{target_wiki}_pagerank"
-            ].sum()
-        matching_rows["kl_divergence"] = (
-            matching_rows[f"{target_wiki}_pagerank"] ** importance_weight
-        ) * (
-            np.log(matching_rows[f"{target_wiki}_pagerank"])
-            - np.log(matching_rows[f"{base_wiki}_pagerank"])
-        )
-        matching_rows["odds_ratio"] = (
-            matching_rows[f"{target_wiki}_pagerank"]
-            / matching_rows[f"{base_wiki}_pagerank"]
-        )
+            _add_kl_columns(
+                matching_rows,
+                base_wiki,
+                target_wiki,
+                importance_weight,
+                matching_rows[f"{base_wiki}_pagerank"].sum(),
+                matching_rows[f"{target_wiki}_pagerank"].sum(),
+            )
+        else:
+            _add_kl_columns(matching_rows, base_wiki, target_wiki, importance_weight)
 
         matching_rows["kl_relative_to_max"] = (
             matching_rows["kl_divergence"] / matching_rows["kl_divergence"].max()
         )
         return matching_rows
+
+    def _divergence(self, wikis, importance_weight, block_rows):
+        if wikis is not None:
+            self._load_wikis(wikis)
+        divergence = PairwiseDivergence(
+            wikis or _pagerank_wikis(self._df.columns), importance_weight
+        )
+        for start in range(0, len(self._df), block_rows):
+            divergence.add(self._df.iloc[start : start + block_rows])
+        return divergence
+
+    def divergence_matrix(
+        self, wikis=None, importance_weight=1, block_rows=DIVERGENCE_BLOCK_ROWS
+    ):
+        # kl_divergence with marginals, summed, for every pair of wikis
+        return self._divergence(wikis, importance_weight, block_rows).matrix()
+
+    def top_divergent(
+        self, wikis=None, k=20, importance_weight=1, block_rows=DIVERGENCE_BLOCK_ROWS
+    ):
+        # The k rows kl_divergence with marginals ranks highest, for every
+        # pair of wikis
+        divergence = self._divergence(wikis, importance_weight, block_rows)
+        for start in range(0, len(self._df), block_rows):
+            divergence.add_top(self._df.iloc[start : start + block_rows], k)
+        return divergence.top()
+
+
+def _wiki_list(wikis, columns):
+    if wikis is None:
+        return _pagerank_wikis(columns)
+    return [wikis] if isinstance(wikis, str) else list(wikis)
+
+
+def _top_classes(sums, class_qids, wikis, key, n):
+    # sums is classes x wikis; the n classes with the most mass in the
+    # first wiki, largest first
+    sums = np.asarray(sums).reshape(len(class_qids), len(wikis))
+    top = np.arange(len(class_qids))
+    if len(top) > n:
+        top = np.argpartition(-sums[:, 0], n - 1)[:n]
+    top = top[np.argsort(-sums[top, 0], kind="stable")]
+    return pd.DataFrame(
+        sums[top],
+        columns=[f"{wiki}_pagerank" for wiki in wikis],
+        index=pd.Index([f"Q{q}" for q in class_qids[top]], name=key),
+    )
+
+
+def _matching(df, base_wiki, target_wiki):
+    return df[f"{base_wiki}_title"].notna() & df[f"{target_wiki}_title"].notna()
+
+
+def _add_kl_columns(
+    rows, base_wiki, target_wiki, importance_weight, base_sum=1.0, target_sum=1.0
+):
+    # Pageranks are renormalized by the given sums first, e.g. over the
+    # matching rows for marginals
+    base, target = f"{base_wiki}_pagerank", f"{target_wiki}_pagerank"
+    rows[base] /= float(base_sum)
+    rows[target] /= float(target_sum)
+    rows["kl_divergence"] = (rows[target] ** importance_weight) * (
+        np.log(rows[target]) - np.log(rows[base])
+    )
+    rows["odds_ratio"] = rows[target] / rows[base]
+
+
+def _pagerank_wikis(columns):
+    return sorted(
+        c[: -len("_pagerank")]
+        for c in columns
+        if c.endswith("_pagerank") and f"{c[: -len('_pagerank')]}_title" in columns
+    )
+
+
+class PairwiseDivergence:
+    # kl_divergence with marginals for every (base, target) pair of wikis at
+    # once. Each block of rows is stacked into a rows x wikis pagerank array,
+    # and the per-pair sums the divergences need are wikis x wikis matrix
+    # products, accumulated over blocks. With those known, a second pass
+    # over the blocks (add_top) keeps every pair's top k rows.
+    def __init__(self, wikis, importance_weight=1):
+        self.wikis = list(wikis)
+        self.importance_weight = importance_weight
+        shape = (len(self.wikis), len(self.wikis))
+        # [b, t] entries are sums over the rows both wikis have titles for,
+        # with missing pageranks as 0, like kl_divergence's marginals:
+        self.matching = np.zeros(shape)  # 1
+        self.base_sums = np.zeros(shape)  # B
+        self.target_sums = np.zeros(shape)  # T
+        # and over those where both pageranks are also positive, the rows
+        # kl_divergence has a divergence for:
+        self.ranked = np.zeros(shape)  # 1
+        self.weighted_sums = np.zeros(shape)  # T^w
+        self.weighted_target_logs = np.zeros(shape)  # T^w log T
+        self.weighted_base_logs = np.zeros(shape)  # T^w log B
+        self.target_logs = np.zeros(shape)  # log T
+        self.base_logs = np.zeros(shape)  # log B
+        self._top = None
+
+    def _stack(self, frame):
+        # titled masks the rows with a title, and mask those that also have a
+        # positive pagerank. Pageranks are 0 outside titled, and logs and
+        # weights 0 outside mask.
+        pageranks = np.column_stack(
+            [frame[f"{wiki}_pagerank"].values for wiki in self.wikis]
+        ).astype(np.float64)
+        titled = np.column_stack(
+            [frame[f"{wiki}_title"].notna().values for wiki in self.wikis]
+        )
+        with np.errstate(invalid="ignore"):
+            mask = titled & (pageranks > 0)
+        pageranks[~titled | np.isnan(pageranks)] = 0.0
+        logs = np.log(pageranks, out=np.zeros_like(pageranks), where=mask)
+        weighted = np.where(mask, pageranks ** self.importance_weight, 0.0)
+        return pageranks, titled, mask, logs, weighted
+
+    def add(self, frame):
+        pageranks, titled, mask, logs, weighted = self._stack(frame)
+        titled = titled.astype(np.float64)
+        ones = mask.astype(np.float64)
+        self.matching += titled.T @ titled
+        self.base_sums += pageranks.T @ titled
+        self.target_sums += titled.T @ pageranks
+        self.ranked += ones.T @ ones
+        self.weighted_sums += ones.T @ weighted
+        self.weighted_target_logs += ones.T @ (weighted * logs)
+        self.weighted_base_logs += logs.T @ weighted
+        self.target_logs += ones.T @ logs
+        self.base_logs += logs.T @ ones
+
+    def _log_sum_ratio(self):
+        # log of the marginal normalization, log(sum B) - log(sum T)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.log(self.base_sums) - np.log(self.target_sums)
+
+    def matrix(self):
+        # (base_wiki, target_wiki) rows of the summed divergence and the
+        # geometric mean odds ratio; ["kl_divergence"].unstack() is the
+        # wikis x wikis matrix
+        log_ratio = self._log_sum_ratio()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            kl = (
+                self.weighted_target_logs
+                - self.weighted_base_logs
+                + log_ratio * self.weighted_sums
+            ) / self.target_sums ** self.importance_weight
+            odds_ratio = np.exp(
+                (self.target_logs - self.base_logs) / self.ranked + log_ratio
+            )
+        index = pd.MultiIndex.from_product(
+            [self.wikis, self.wikis], names=["base_wiki", "target_wiki"]
+        )
+        return pd.DataFrame(
+            {
+                "matching_rows": self.matching.ravel().astype(np.int64),
+                "kl_divergence": kl.ravel(),
+                "odds_ratio": odds_ratio.ravel(),
+            },
+            index=index,
+        )
+
+    def add_top(self, frame, k=20):
+        # Per target, every base's contributions for this block as one
+        # wikis x rows array; each pair keeps its k largest so far
+        _, _, mask, logs, weighted = self._stack(frame)
+        # Bases x rows, so partitions run along contiguous rows
+        mask, logs = mask.T.copy(), logs.T.copy()
+        log_ratio = self._log_sum_ratio()
+        labels = frame.index.values
+        if self._top is None:
+            empty = np.empty((len(self.wikis), 0))
+            self._top = [(empty, empty, empty.astype(object)) for _ in self.wikis]
+
+        for t in range(len(self.wikis)):
+            rows = np.flatnonzero(mask[t])
+            if len(rows) == 0:
+                continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                # log(p_t / p_b) for every base
+                log_odds = logs[t, rows] - logs[:, rows] + log_ratio[:, t, None]
+                contributions = (
+                    weighted[rows, t]
+                    * log_odds
+                    / self.target_sums[:, t, None] ** self.importance_weight
+                )
+            contributions[~mask[:, rows]] = -np.inf
+            if len(rows) > k:
+                keep = np.argpartition(-contributions, k - 1, axis=1)[:, :k]
+            else:
+                keep = np.broadcast_to(np.arange(len(rows)), log_odds.shape)
+
+            values, odds_ratios, row_labels = self._top[t]
+            values = np.hstack((values, np.take_along_axis(contributions, keep, 1)))
+            odds_ratios = np.hstack(
+                (odds_ratios, np.exp(np.take_along_axis(log_odds, keep, 1)))
+            )
+            row_labels = np.hstack((row_labels, labels[rows][keep]))
+            if values.shape[1] > k:
+                keep = np.argpartition(-values, k - 1, axis=1)[:, :k]
+                values = np.take_along_axis(values, keep, axis=1)
+                odds_ratios = np.take_along_axis(odds_ratios, keep, axis=1)
+                row_labels = np.take_along_axis(row_labels, keep, axis=1)
+            self._top[t] = (values, odds_ratios, row_labels)
+
+    def top(self):
+        # (base_wiki, target_wiki, concept_id) rows with each row's
+        # kl_divergence, odds_ratio and kl_relative_to_max, as
+        # kl_divergence() returns them, largest first per pair
+        frames = []
+        for t, (values, odds_ratios, row_labels) in enumerate(self._top or []):
+            for b in range(len(self.wikis)):
+                found = np.flatnonzero(np.isfinite(values[b]))
+                if b == t or len(found) == 0:
+                    continue
+                found = found[np.argsort(-values[b, found], kind="stable")]
+                kl = values[b, found]
+                frames.append(
+                    pd.DataFrame(
+                        {
+                            "base_wiki": self.wikis[b],
+                            "target_wiki": self.wikis[t],
+                            "concept_id": row_labels[b, found],
+                            "kl_divergence": kl,
+                            "odds_ratio": odds_ratios[b, found],
+                            "kl_relative_to_max": kl / kl[0],
+                        }
+                    )
+                )
+        if not frames:
+            return pd.DataFrame(
+                columns=["kl_divergence", "odds_ratio", "kl_relative_to_max"]
+            )
+        return pd.concat(frames, ignore_index=True).set_index(
+            ["base_wiki", "target_wiki", "concept_id"]
+        )
+
+
+STREAM_CHUNKSIZE = 250_000
+
+
+def _downcast(chunk, wikis):
+    for column in chunk.columns:
+        if column in CLASS_COLUMNS or column == "country_of_origin":
+            if not isinstance(chunk[column].dtype, pd.CategoricalDtype):
+                chunk[column] = chunk[column].astype("category")
+        elif column.split("_")[0] in wikis and column.endswith("_pagerank"):
+            chunk[column] = chunk[column].astype(np.float32)
+    return chunk
+
+
+def iter_chunks(datapath, usecols=None, chunksize=STREAM_CHUNKSIZE):
+    # Typed chunks of at most chunksize rows with downcast dtypes (see
+    # _tsv_dtypes). Pageranks are not normalized, which needs a pass over
+    # the whole dataset; ChunkedDataset.chunks does that.
+    datapath = str(datapath)
+    wikis = load_wikis(datapath)
+    if usecols is not None and "concept_id" not in usecols:
+        usecols = ["concept_id"] + list(usecols)
+
+    if columnar.is_columnar(datapath):
+        chunks = (
+            _downcast(chunk, wikis)
+            for chunk in columnar.iter_columnar_frames(
+                datapath, chunksize, usecols=usecols
+            )
+        )
+    else:
+        paths = (
+            sharding.shard_paths(datapath)
+            if sharding.is_sharded(datapath)
+            else [datapath]
+        )
+        chunks = (
+            chunk
+            for path in paths
+            for chunk in pd.read_csv(
+                path,
+                sep="\t",
+                index_col="concept_id",
+                usecols=usecols,
+                chunksize=chunksize,
+                dtype=_tsv_dtypes(wikis, downcast=True),
+            )
+        )
+
+    for chunk in chunks:
+        if "publication_date" in chunk.columns:
+            chunk["publication_date"] = pd.to_datetime(
+                chunk["publication_date"], unit="s", errors="coerce"
+            )
+        yield chunk
+
+
+class ChunkedDataset:
+    # The accessor's aggregations over a dataset streamed in chunks, for
+    # datasets too large to load whole. Each aggregation reads only the
+    # columns it needs and combines partial results across chunks, so memory
+    # is bounded by the chunk size and the result size.
+    def __init__(self, datapath, chunksize=STREAM_CHUNKSIZE):
+        self.datapath = str(datapath)
+        self.chunksize = chunksize
+        self.headers = load_headers(self.datapath)
+        self.wikis = load_wikis(self.datapath)
+        self._pagerank_sums = None
+
+    def pagerank_sums(self):
+        # One pass over the pagerank columns, for normalizing like load_data
+        if self._pagerank_sums is None:
+            columns = [f"{wiki}_pagerank" for wiki in sorted(self.wikis)]
+            sums = dict.fromkeys(columns, 0.0)
+            for chunk in iter_chunks(self.datapath, columns, self.chunksize):
+                for column in columns:
+                    sums[column] += np.nansum(chunk[column].values, dtype=np.float64)
+            self._pagerank_sums = sums
+        return self._pagerank_sums
+
+    def chunks(self, usecols=None):
+        # Chunks with pageranks normalized over the whole dataset
+        sums = self.pagerank_sums()
+        for chunk in iter_chunks(self.datapath, usecols, self.chunksize):
+            for column, total in sums.items():
+                if column in chunk.columns:
+                    chunk[column] /= float(total)
+            yield chunk
+
+    def labels(self, concept_ids):
+        found = [
+            chunk.loc[chunk.index.isin(concept_ids), "sample_label"]
+            for chunk in self.chunks(["sample_label"])
+        ]
+        return pd.concat(found).reindex(concept_ids)
+
+    def top_ranked(self, wiki, n=200, desc=True):
+        title, pagerank = f"{wiki}_title", f"{wiki}_pagerank"
+        parts = []
+        max_pagerank = np.nan
+        for chunk in self.chunks(["sample_label", title, pagerank]):
+            ranked = chunk[chunk[title].notna()][["sample_label", pagerank]]
+            max_pagerank = np.fmax(max_pagerank, ranked[pagerank].max())
+            parts.append(
+                ranked.nlargest(n, pagerank) if desc else ranked.nsmallest(n, pagerank)
+            )
+        ret = pd.concat(parts)
+        ret = ret.nlargest(n, pagerank) if desc else ret.nsmallest(n, pagerank)
+        ret[f"{wiki}_relative_to_max"] = ret[pagerank] / max_pagerank
+        return ret
+
+    def best_concepts(self, sample=None, n=200, direct=False, wikis="enwiki"):
+        # Sampled rows are sampled per chunk, at the same rate
+        key = _instance_key(self.headers, direct)
+        wikis = _wiki_list(wikis, self.headers)
+        columns = [f"{wiki}_pagerank" for wiki in wikis]
+        totals = None
+        for chunk in self.chunks([key] + columns):
+            matrix = ClassMatrix.from_series(chunk[key])
+            weights = chunk[columns].values
+            rows = None
+            if sample is not None:
+                rows = np.sort(
+                    np.random.choice(
+                        len(chunk), int(round(sample * len(chunk))), replace=False
+                    )
+                )
+                weights = weights[rows]
+            sums = pd.DataFrame(
+                matrix.class_sums(weights, rows=rows).reshape(-1, len(wikis)),
+                index=matrix.class_qids,
+            )
+            totals = sums if totals is None else totals.add(sums, fill_value=0)
+
+        prob_mass = _top_classes(totals.values, totals.index.values, wikis, key, n)
+        return pd.concat(
+            (self.labels(prob_mass.index), prob_mass), axis=1, copy=False
+        ).dropna()
+
+    def top_by_year(
+        self, top_col="enwiki_pagerank", date_col="publication_date", n=200
+    ):
+        # Each chunk's best row per year is a candidate for the overall best
+        candidates = []
+        for chunk in self.chunks(["sample_label", top_col, date_col]):
+            by_year = (
+                chunk.groupby(chunk[date_col].dt.to_period("A"))[top_col]
+                .idxmax()
+                .dropna()
+            )
+            candidates.append(chunk.loc[by_year])
+        return pd.concat(candidates).wl.top_by_year(top_col, date_col, n)
+
+    def kl_divergence(
+        self, base_wiki, target_wiki, n=200, marginals=True, importance_weight=1
+    ):
+        # Unlike the accessor, only the n rows with the largest divergence
+        # are returned, which takes a second pass when renormalizing over
+        # the matching rows
+        base, target = f"{base_wiki}_pagerank", f"{target_wiki}_pagerank"
+        columns = [f"{base_wiki}_title", f"{target_wiki}_title", base, target]
+        base_sum, target_sum = 1.0, 1.0
+        if marginals:
+            base_sum, target_sum = 0.0, 0.0
+            for chunk in self.chunks(columns):
+                matching_rows = chunk[_matching(chunk, base_wiki, target_wiki)]
+                base_sum += np.nansum(matching_rows[base].values, dtype=np.float64)
+                target_sum += np.nansum(matching_rows[target].values, dtype=np.float64)
+
+        parts = []
+        max_kl = np.nan
+        for chunk in self.chunks(["sample_label"] + columns):
+            matching_rows = chunk.loc[_matching(chunk, base_wiki, target_wiki)].copy()
+            _add_kl_columns(
+                matching_rows,
+                base_wiki,
+                target_wiki,
+                importance_weight,
+                base_sum,
+                target_sum,
+            )
+            max_kl = np.fmax(max_kl, matching_rows["kl_divergence"].max())
+            parts.append(matching_rows.nlargest(n, "kl_divergence"))
+
+        ret = pd.concat(parts).nlargest(n, "kl_divergence")
+        ret["kl_relative_to_max"] = ret["kl_divergence"] / max_kl
+        return ret
+
+    def _divergence(self, wikis, importance_weight):
+        wikis = wikis or _pagerank_wikis(self.headers)
+        columns = [f"{wiki}_{c}" for wiki in wikis for c in ("title", "pagerank")]
+        divergence = PairwiseDivergence(wikis, importance_weight)
+        for chunk in self.chunks(columns):
+            divergence.add(chunk)
+        return divergence, columns
+
+    def divergence_matrix(self, wikis=None, importance_weight=1):
+        return self._divergence(wikis, importance_weight)[0].matrix()
+
+    def top_divergent(self, wikis=None, k=20, importance_weight=1):
+        divergence, columns = self._divergence(wikis, importance_weight)
+        for chunk in self.chunks(columns):
+            divergence.add_top(chunk, k)
+        return divergence.top()
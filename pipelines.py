@@ -1,23 +1,52 @@
 import io
+import os
+import gc
+import shelve
+import array
 import bz2
 import logging
 import ujson
 import gzip
 import tempfile
 import itertools
+import time
+import numpy as np
+from collections import Counter, deque
 from pathlib import Path
 from tqdm.auto import tqdm
 import sys
 import csv
+import columnar
+import metrics
+from columnar import ColumnarWriter
+from line_reader import DEFAULT_BLOCK_SIZE, line_blocks, open_binary
+from checkpoint import (
+    Checkpointer,
+    CheckpointedLines,
+    DEFAULT_CHECKPOINT_INTERVAL,
+    sync,
+    truncate,
+)
 from pagerank import pagerank_with_percentiles
+from sampling import sample_lines
+from sharding import (
+    open_tsv_writer,
+    shard_for_concept,
+    SHARD_BY_HASH,
+    SHARD_BY_ORDER,
+)
 from wikidata_parser import WikiDataParser
+from array_store import FrozenStringMap
 from wikipedia_parser import (
+    ArticleSummaries,
+    ParsedRawPage,
     WikipediaDumpParser,
     WikipediaCanonicalPageResolver,
     WikipediaCanonicalPage,
 )
 from contextlib import contextmanager
 import multiprocessing
+import threading
 
 from typing import Iterable, Tuple
 
@@ -49,47 +78,31 @@ def buffered_stream(input_path, bufsize_mb=100):
             yield f
 
 
-def buffered_lines_with_progress(input_path, bufsize_mb=100, update_frequency=2000):
+def buffered_lines_with_progress(input_path, bufsize_mb=100, block_size=DEFAULT_BLOCK_SIZE):
+    # Yields bytes lines without their newline; progress is per block
     input_path = str(input_path)
     size = Path(input_path).stat().st_size
-    bufsize = bufsize_mb * 1024 * 1024
-    last_update = 0
-    pbar = tqdm(total=size, unit="b", unit_scale=(1.0 / 1024 * 1024))
-
-    if input_path.endswith(".gz"):
-        orig_f = open(input_path, mode="rb", buffering=bufsize)
-        f = gzip.GzipFile(fileobj=orig_f)
-        f = io.BufferedReader(f, buffer_size=bufsize)
-        f = io.TextIOWrapper(f)
-    elif input_path.endswith(".bz2"):
-        orig_f = open(input_path, mode="rb", buffering=bufsize)
-        f = bz2.BZ2File(orig_f)
-        f = io.BufferedReader(f, buffer_size=bufsize)
-        f = io.TextIOWrapper(f)
-    else:
-        orig_f = open(input_path, mode="r", buffering=bufsize)
-        f = orig_f
+    raw, f = open_binary(input_path, bufsize_mb * 1024 * 1024)
+    pbar = tqdm(total=size, unit="b", unit_scale=True)
 
     try:
-        i = 0
-        line = f.readline()
-        while line:
-            line = f.readline()
-            yield line
-            i += 1
-
-            if i % update_frequency == 1:
-                new_location = orig_f.tell()
-                pbar.update(new_location - last_update)
-                last_update = new_location
+        for lines in line_blocks(f, block_size):
+            yield from lines
+            pbar.update(raw.tell() - pbar.n)
     finally:
+        pbar.close()
         f.close()
+        raw.close()
 
 
-def store_wikipedia_pages(input_path, write_path, limit=None):
+def store_wikipedia_pages(
+    input_path, write_path, limit=None, concurrency=None, bufsize_mb=100, titles=None
+):
     logger.info("store_wikipedia_pages: Parsing raw pages")
-    with buffered_stream(input_path) as f:
-        raw_pages = WikipediaDumpParser.parsed_wikipedia_pages(f, limit=limit)
+    with buffered_stream(input_path, bufsize_mb=bufsize_mb) as f:
+        raw_pages = WikipediaDumpParser.parsed_wikipedia_pages(
+            f, limit=limit, concurrency=concurrency, titles=titles
+        )
     logger.info("store_wikipedia_pages: Parsed! Resolving links")
     wiki_pages = list(WikipediaCanonicalPageResolver.resolve_parsed_pages(raw_pages))
     wiki_pages.sort(key=lambda x: x.title)
@@ -97,6 +110,29 @@ def store_wikipedia_pages(input_path, write_path, limit=None):
     WikipediaCanonicalPage.dump_collection(wiki_pages, write_path)
 
 
+def store_parsed_pages(
+    input_path, write_path, limit=None, concurrency=None, bufsize_mb=100, titles=None
+):
+    # titles, if given, restricts parsing to those pages and redirects to them
+    logger.info("store_parsed_pages: Parsing raw pages")
+    with buffered_stream(input_path, bufsize_mb=bufsize_mb) as f:
+        raw_pages = WikipediaDumpParser.parsed_wikipedia_pages(
+            f, limit=limit, concurrency=concurrency, titles=titles
+        )
+    ParsedRawPage.dump_collection(raw_pages, write_path)
+
+
+def store_resolved_pages(parsed_path, write_path):
+    logger.info("store_resolved_pages: Resolving links")
+    wiki_pages = list(
+        WikipediaCanonicalPageResolver.resolve_parsed_pages(
+            ParsedRawPage.read_collection(parsed_path)
+        )
+    )
+    wiki_pages.sort(key=lambda x: x.title)
+    WikipediaCanonicalPage.dump_collection(wiki_pages, write_path)
+
+
 def augment_with_pagerank(canonical_file, in_memory=True):
     if in_memory:
         c = list(WikipediaCanonicalPage.read_collection(canonical_file))
@@ -123,15 +159,70 @@ def store_wiki_with_pagerank(input_path, write_path, limit=None, in_memory=True)
         )
 
 
-def write_articles_to_shelf(shelf, input_path, rank_in_memory=True, limit=None):
+def write_articles_to_shelf(
+    shelf, input_path, rank_in_memory=True, limit=None, concurrency=None
+):
     with tempfile.NamedTemporaryFile() as f:
         logger.info("write_articles_to_shelf: storing wikipedia pages")
-        store_wikipedia_pages(input_path, f.name, limit=limit)
+        store_wikipedia_pages(input_path, f.name, limit=limit, concurrency=concurrency)
         logger.info("write_articles_to_shelf: augmenting with page rank")
-        for i, page in enumerate(
-            tqdm(augment_with_pagerank(f.name, in_memory=rank_in_memory))
-        ):
-            shelf[page.title] = page
+        write_ranked_articles_to_shelf(shelf, f.name, rank_in_memory=rank_in_memory)
+
+
+def write_ranked_articles_to_shelf(shelf, canonical_path, rank_in_memory=True):
+    for page in tqdm(augment_with_pagerank(canonical_path, in_memory=rank_in_memory)):
+        shelf[page.title] = page
+
+
+class ReadOnlyShelf:
+    # Opens its own dbm handle in whichever process first reads from it, so
+    # pool workers never share a handle (or its file offset) after a fork
+    def __init__(self, path):
+        self.path = str(path)
+        self._shelf = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _handle(self):
+        if self._pid != os.getpid():
+            self._shelf = shelve.open(self.path, flag="r")
+            self._pid = os.getpid()
+        return self._shelf
+
+    def get(self, key, default=None):
+        return self._handle().get(key, default)
+
+    def __getitem__(self, key):
+        return self._handle()[key]
+
+    def items(self):
+        return self._handle().items()
+
+    def close(self):
+        if self._shelf is not None and self._pid == os.getpid():
+            self._shelf.close()
+        self._shelf = None
+        self._pid = None
+
+
+def write_article_summaries(shelf, path):
+    ArticleSummaries.write(tqdm(shelf.values()), path)
+
+
+def write_alias_map(article_shelf, path, limit=None):
+    FrozenStringMap.write(
+        (
+            (alias, article_name)
+            for article_name, article in itertools.islice(article_shelf.items(), limit)
+            for alias in article.aliases
+        ),
+        path,
+    )
 
 
 def write_aliases_to_shelf(articles: Iterable[Tuple[str, WikipediaCanonicalPage]], shelf):
@@ -144,16 +235,24 @@ def write_aliases_to_shelf(articles: Iterable[Tuple[str, WikipediaCanonicalPage]
 global _pool_shelf
 global _pool_alias_map
 global _pool_wiki_name
+global _pool_full_wiki_parent_finder
+global _pool_full_wiki_csv_format_params
 
 
-def _init_full_wiki_pool(shelf, alias_map, wiki_name):
+def _init_full_wiki_pool(
+    shelf, alias_map, wiki_name, parent_finder=None, csv_format_params=None
+):
     global _pool_shelf
     global _pool_alias_map
     global _pool_wiki_name
+    global _pool_full_wiki_parent_finder
+    global _pool_full_wiki_csv_format_params
 
     _pool_shelf = shelf
     _pool_alias_map = alias_map
     _pool_wiki_name = wiki_name
+    _pool_full_wiki_parent_finder = parent_finder
+    _pool_full_wiki_csv_format_params = csv_format_params
 
 
 def _parse_wd_with_shelf_func(line):
@@ -179,6 +278,61 @@ def _parse_wd_with_shelf_func(line):
     return (entry, wiki_title, article, aliased_from)
 
 
+def _full_wiki_row_func(line):
+    # Formats everything but the link columns in the worker; links go back
+    # title-keyed so the main process can intern them for the sidecar
+    entry, wiki_title, article, aliased_from = _parse_wd_with_shelf_func(line)
+    if not entry:
+        return ("empty", None, None, None, None, None)
+    if not wiki_title:
+        return ("no_title", None, None, None, None, None)
+    if not article:
+        return ("missing_article", None, None, None, None, None)
+
+    wiki_name = _pool_wiki_name
+    parent_finder = _pool_full_wiki_parent_finder
+    row_dict = {
+        "concept_id": entry.id,
+        f"{wiki_name}_title": wiki_title,
+        f"{wiki_name}_pagerank": article.pagerank,
+        f"{wiki_name}_pagerank_percentile": article.pagerank_percentile,
+        "coord_latitude": entry.sample_coord and entry.sample_coord.latitude,
+        "coord_longitude": entry.sample_coord and entry.sample_coord.longitude,
+        "coord_altitude": entry.sample_coord and entry.sample_coord.altitude,
+        "coord_precision": entry.sample_coord and entry.sample_coord.precision,
+        "country_of_origin": entry.country_of_origin,
+        "publication_date": entry.publication_date,
+        f"{wiki_name}_aliases": list(article.aliases),
+    }
+
+    recursive_instance_concepts = set()
+    for c in entry.direct_instance_of:
+        parent_finder.all_parents(c, recursive_instance_concepts)
+    row_dict["direct_instance_of"] = ujson.dumps(list(entry.direct_instance_of))
+    row_dict["recursive_instance_of"] = ujson.dumps(list(recursive_instance_concepts))
+
+    recursive_subclass_concepts = set()
+    for c in entry.direct_subclass_of:
+        parent_finder.all_parents(c, recursive_subclass_concepts)
+    row_dict["direct_subclass_of"] = ujson.dumps(list(entry.direct_subclass_of))
+    row_dict["recursive_subclass_of"] = ujson.dumps(list(recursive_subclass_concepts))
+
+    # The prefix ends in a delimiter so the link columns can be appended as-is
+    buf = io.StringIO()
+    csv.DictWriter(
+        buf, lineterminator="\t", **_pool_full_wiki_csv_format_params
+    ).writerow(row_dict)
+
+    return (
+        "aliased" if aliased_from else "ok",
+        entry.id,
+        wiki_title,
+        buf.getvalue(),
+        list(article.inlinks.items()),
+        list(article.links.items()),
+    )
+
+
 def build_alias_map(article_shelf, limit=None):
     return dict(itertools.chain.from_iterable(
         (
@@ -188,11 +342,127 @@ def build_alias_map(article_shelf, limit=None):
     ))
 
 
+def _quote_minimal(value):
+    if any(c in value for c in '\t"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _format_concept_links(concepts, counts):
+    keep = concepts >= 0
+    return _quote_minimal(
+        ujson.dumps(
+            [
+                [f"Q{c}", n]
+                for c, n in zip(concepts[keep].tolist(), counts[keep].tolist())
+            ]
+        )
+    )
+
+
+@contextmanager
+def _frozen_gc():
+    # Keep the collector from touching objects inherited by pool workers,
+    # and unfreeze even if the pool's work raises
+    gc.freeze()
+    try:
+        yield
+    finally:
+        gc.unfreeze()
+
+
+@contextmanager
+def _work_dir(path):
+    if path is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            yield Path(temp_dir)
+    else:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        yield Path(path)
+
+
+def _checkpointed_input(
+    wikidata_path,
+    checkpointer,
+    state,
+    limit,
+    mark_every=None,
+    bufsize_mb=100,
+    sample_rate=None,
+):
+    # Returns the line reader (None without checkpointing), the lines still
+    # to process, and a deque of (lines_yielded, lines_read, input_offset)
+    # marks recorded every mark_every input lines. With sample_rate only
+    # sampled lines are yielded, so fewer are yielded than read.
+    marks = deque()
+    if checkpointer is None:
+        lines = buffered_lines_with_progress(wikidata_path, bufsize_mb=bufsize_mb)
+        return None, sample_lines(itertools.islice(lines, limit), sample_rate), marks
+
+    lines = CheckpointedLines(
+        wikidata_path,
+        offset=state["input_offset"] if state else 0,
+        lines_read=state["lines_read"] if state else 0,
+        index_path=checkpointer.index_path,
+        bufsize_mb=bufsize_mb,
+    )
+    if limit is not None:
+        limit = max(0, limit - lines.lines_read)
+
+    def marked():
+        # A line's mark is recorded before the line is yielded, so it is
+        # queued by the time the line's result comes back from a pool
+        yielded = 0
+        next_mark = mark_every and (lines.lines_read // mark_every + 1) * mark_every
+        for line in sample_lines(itertools.islice(lines, limit), sample_rate):
+            yielded += 1
+            if mark_every and lines.lines_read >= next_mark:
+                marks.append((yielded, lines.lines_read, lines.offset))
+                next_mark = (lines.lines_read // mark_every + 1) * mark_every
+            yield line
+
+    return lines, marked(), marks
+
+
+_FULL_WIKI_PASS1_FILES = {
+    "prefixes": "prefixes.bin",
+    "rows": "rows.tsv",
+    "titles": "titles.txt",
+    "prefix_lengths": "prefix_lengths.i64",
+    "num_inlinks": "num_inlinks.i64",
+    "num_outlinks": "num_outlinks.i64",
+    "link_titles": "link_titles.i32",
+    "link_counts": "link_counts.i32",
+}
+
+
 def write_full_wiki_csv(
-    wikidata_path, output_path, article_shelf, parent_finder, wiki_name, alias_map, limit=None
+    wikidata_path,
+    output_path,
+    article_shelf,
+    parent_finder,
+    wiki_name,
+    alias_map,
+    limit=None,
+    concurrency=None,
+    num_shards=1,
+    shard_by=SHARD_BY_ORDER,
+    checkpoint_dir=None,
+    checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+    bufsize_mb=100,
+    sample_rate=None,
 ):
+    # With checkpoint_dir, pass 1 keeps its files there and checkpoints
+    # periodically, so a restarted run resumes from the last checkpoint.
+    # With sample_rate only concepts in the hash sample are written.
+    started = time.perf_counter()
     chunksize = 256
-    field_names = [
+    flush_size = 1 << 20
+    remap_block_rows = 1 << 16
+    shard_block_rows = 1 << 12
+    # Link columns come last so each row is a pre-formatted prefix followed by
+    # the remapped links
+    prefix_field_names = [
         "concept_id",
         f"{wiki_name}_title",
         f"{wiki_name}_pagerank",
@@ -207,132 +477,255 @@ def write_full_wiki_csv(
         "recursive_instance_of",
         "direct_subclass_of",
         "recursive_subclass_of",
+        f"{wiki_name}_aliases",
+    ]
+    field_names = prefix_field_names + [
         f"{wiki_name}_inlinks",
         f"{wiki_name}_outlinks",
-        f"{wiki_name}_aliases",
     ]
-    csv_format_params = dict(
-        delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=field_names
-    )
+    field_types = {
+        f"{wiki_name}_pagerank": "float64",
+        f"{wiki_name}_pagerank_percentile": "float64",
+        "coord_latitude": "float64",
+        "coord_longitude": "float64",
+        "coord_altitude": "float64",
+        "coord_precision": "float64",
+        "publication_date": "float64",
+        "direct_instance_of": "json",
+        "recursive_instance_of": "json",
+        "direct_subclass_of": "json",
+        "recursive_subclass_of": "json",
+        f"{wiki_name}_inlinks": "json",
+        f"{wiki_name}_outlinks": "json",
+    }
+    csv_format_params = dict(delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
     csv.field_size_limit(sys.maxsize)
-    num_considered = 0
-    num_empty = 0
-    num_no_title = 0
-    num_missing_article = 0
-    num_aliases = 0
 
-    logging.info("Writing TSV")
-    with multiprocessing.Pool(
-        initializer=_init_full_wiki_pool, initargs=[article_shelf, alias_map, wiki_name]
-    ) as pool, tempfile.TemporaryDirectory() as temp_dir:
-        tmp_intermediate_path = Path(temp_dir) / "intermediate.csv"
-        with open(tmp_intermediate_path, "w") as fw:
-            intermediate_writer = csv.DictWriter(fw, **csv_format_params)
-            intermediate_writer.writeheader()
-
-            name_to_id = {}
-            for entry, wiki_title, article, aliased_from in pool.imap(
-                _parse_wd_with_shelf_func,
-                itertools.islice(buffered_lines_with_progress(wikidata_path), limit),
-                chunksize=chunksize,
-            ):
-                num_considered += 1
-                if not entry:
-                    num_empty += 1
-                    continue
-
-                if not wiki_title:
-                    num_no_title += 1
-                    continue
-
-                if not article:
-                    num_missing_article += 1
-                    continue
-
-                if aliased_from:
-                    num_aliases += 1
-
-                name_to_id[wiki_title] = entry.id
-
-                row_dict = {
-                    "concept_id": entry.id,
-                    f"{wiki_name}_title": wiki_title,
-                    f"{wiki_name}_pagerank": article.pagerank,
-                    f"{wiki_name}_pagerank_percentile": article.pagerank_percentile,
-                    "coord_latitude": entry.sample_coord
-                    and entry.sample_coord.latitude,
-                    "coord_longitude": entry.sample_coord
-                    and entry.sample_coord.longitude,
-                    "coord_altitude": entry.sample_coord
-                    and entry.sample_coord.altitude,
-                    "coord_precision": entry.sample_coord
-                    and entry.sample_coord.precision,
-                    "country_of_origin": entry.country_of_origin,
-                    "publication_date": entry.publication_date,
-                }
-
-                row_dict[f"{wiki_name}_inlinks"] = ujson.dumps(
-                    list(article.inlinks.items())
-                )
-                row_dict[f"{wiki_name}_outlinks"] = ujson.dumps(
-                    list(article.links.items())
-                )
-                row_dict[f"{wiki_name}_aliases"] = list(article.aliases)
+    checkpointer = None
+    state = None
+    checkpoint_params = {
+        "wiki_name": wiki_name,
+        "limit": limit,
+        "sample_rate": sample_rate,
+    }
+    if checkpoint_dir is not None:
+        checkpointer = Checkpointer(
+            checkpoint_dir, wikidata_path, interval=checkpoint_interval
+        )
+        state = checkpointer.load(**checkpoint_params)
+    stats = Counter(state["stats"] if state else {})
 
-                recursive_instance_concepts = set()
-                for c in entry.direct_instance_of:
-                    parent_finder.all_parents(c, recursive_instance_concepts)
-                row_dict["direct_instance_of"] = ujson.dumps(
-                    list(entry.direct_instance_of)
-                )
-                row_dict["recursive_instance_of"] = ujson.dumps(
-                    list(recursive_instance_concepts)
-                )
+    # Paths are opened per worker: a shelf gets its own dbm handle and an
+    # alias map is memory-mapped, so nothing large is copied into workers
+    if isinstance(article_shelf, (str, Path)):
+        article_shelf = ReadOnlyShelf(article_shelf)
+    if isinstance(alias_map, (str, Path)):
+        alias_map = FrozenStringMap(alias_map)
 
-                recursive_subclass_concepts = set()
-                for c in entry.direct_subclass_of:
-                    parent_finder.all_parents(c, recursive_subclass_concepts)
-                row_dict["direct_subclass_of"] = ujson.dumps(
-                    list(entry.direct_subclass_of)
-                )
-                row_dict["recursive_subclass_of"] = ujson.dumps(
-                    list(recursive_subclass_concepts)
-                )
+    logging.info("Writing TSV")
+    with _frozen_gc(), multiprocessing.Pool(
+        concurrency,
+        initializer=_init_full_wiki_pool,
+        initargs=[
+            article_shelf,
+            alias_map,
+            wiki_name,
+            parent_finder,
+            dict(fieldnames=prefix_field_names, **csv_format_params),
+        ],
+    ) as pool, _work_dir(checkpoint_dir) as work_dir:
+        paths = {name: work_dir / f for name, f in _FULL_WIKI_PASS1_FILES.items()}
+
+        # Pass 1: rows are written as formatted prefixes, and their links as
+        # interned title ids plus counts in int32 sidecars. Everything goes to
+        # append-only files so a checkpoint is just their sizes.
+        title_ids = {}
+        if state:
+            for name, size in state["files"].items():
+                truncate(paths[name], size)
+            with open(paths["titles"], encoding="utf-8", newline="\n") as f:
+                for title in f:
+                    title_ids[title[:-1]] = len(title_ids)
+
+        if not state or state["pass"] == 1:
+            files = {
+                name: open(path, "ab" if state else "wb") for name, path in paths.items()
+            }
+            buffers = {
+                "prefix_lengths": array.array("q"),
+                "num_inlinks": array.array("q"),
+                "num_outlinks": array.array("q"),
+                "link_titles": array.array("i"),
+                "link_counts": array.array("i"),
+            }
+
+            def flush_buffers():
+                for name, buffer in buffers.items():
+                    buffer.tofile(files[name])
+                    del buffer[:]
+
+            reader, line_iter, marks = _checkpointed_input(
+                wikidata_path,
+                checkpointer,
+                state,
+                limit,
+                mark_every=chunksize * 16,
+                bufsize_mb=bufsize_mb,
+                sample_rate=sample_rate,
+            )
+            lines_done = 0
+            try:
+                for status, concept_id, wiki_title, prefix, inlinks, outlinks in pool.imap(
+                    _full_wiki_row_func, line_iter, chunksize=chunksize
+                ):
+                    lines_done += 1
+                    stats["considered"] += 1
+                    stats[status] += 1
+                    if status in ("ok", "aliased"):
+                        encoded = prefix.encode("utf-8")
+                        files["prefixes"].write(encoded)
+                        files["rows"].write(f"{concept_id}\t{wiki_title}\n".encode("utf-8"))
+                        buffers["prefix_lengths"].append(len(encoded))
+                        buffers["num_inlinks"].append(len(inlinks))
+                        buffers["num_outlinks"].append(len(outlinks))
+                        for title, count in itertools.chain(inlinks, outlinks):
+                            title_idx = title_ids.get(title)
+                            if title_idx is None:
+                                title_idx = title_ids[title] = len(title_ids)
+                                files["titles"].write(f"{title}\n".encode("utf-8"))
+                            buffers["link_titles"].append(title_idx)
+                            buffers["link_counts"].append(count)
+
+                        if len(buffers["link_titles"]) >= flush_size:
+                            flush_buffers()
+
+                    mark = None
+                    while marks and marks[0][0] <= lines_done:
+                        mark = marks.popleft()
+                    if mark is not None:
+                        _, lines_read, input_offset = mark
+                        if checkpointer.due():
+                            flush_buffers()
+                            checkpointer.save(
+                                reader,
+                                checkpoint_params,
+                                input_offset,
+                                lines_read,
+                                **{
+                                    "pass": 1,
+                                    "files": {n: sync(f) for n, f in files.items()},
+                                    "stats": dict(stats),
+                                },
+                            )
+
+                flush_buffers()
+                if checkpointer is not None:
+                    checkpointer.save(
+                        reader,
+                        checkpoint_params,
+                        reader.offset,
+                        reader.lines_read,
+                        **{
+                            "pass": 2,
+                            "files": {n: sync(f) for n, f in files.items()},
+                            "stats": dict(stats),
+                        },
+                    )
+            finally:
+                for f in files.values():
+                    f.close()
+
+        # Pass 2: one vectorized title id -> concept remap, then stream the
+        # prefixes straight through with the link columns appended
+        title_to_concept = np.full(len(title_ids), -1, dtype=np.int64)
+        row_concept_ids = []
+        with open(paths["rows"], encoding="utf-8", newline="\n") as f:
+            for row in f:
+                concept_id, title = row[:-1].split("\t", 1)
+                title_idx = title_ids.get(title)
+                if title_idx is not None:
+                    title_to_concept[title_idx] = int(concept_id[1:])
+                if shard_by == SHARD_BY_HASH:
+                    row_concept_ids.append(concept_id)
+        del title_ids
+
+        prefix_lengths = np.fromfile(paths["prefix_lengths"], dtype=np.int64)
+        num_inlinks = np.fromfile(paths["num_inlinks"], dtype=np.int64)
+        num_outlinks = np.fromfile(paths["num_outlinks"], dtype=np.int64)
+        link_offsets = np.zeros(len(num_inlinks) + 1, dtype=np.int64)
+        np.cumsum(num_inlinks + num_outlinks, out=link_offsets[1:])
+        all_link_titles = np.fromfile(paths["link_titles"], dtype=np.int32)
+        all_link_counts = np.fromfile(paths["link_counts"], dtype=np.int32)
+
+        with open(paths["prefixes"], "rb") as prefixes_f, open_tsv_writer(
+            output_path,
+            [(name, field_types.get(name, "string")) for name in field_names],
+            num_shards=num_shards,
+            shard_by=shard_by,
+            **csv_format_params,
+        ) as output:
+            for block_start in range(0, len(num_inlinks), remap_block_rows):
+                block_end = min(block_start + remap_block_rows, len(num_inlinks))
+                link_start = link_offsets[block_start]
+                link_end = link_offsets[block_end]
+                concepts = title_to_concept[all_link_titles[link_start:link_end]]
+                counts = all_link_counts[link_start:link_end]
+
+                lines = [[] for _ in range(num_shards)]
+                for i in range(block_start, block_end):
+                    start = link_offsets[i] - link_start
+                    middle = start + num_inlinks[i]
+                    end = link_offsets[i + 1] - link_start
+                    if shard_by == SHARD_BY_HASH:
+                        shard = shard_for_concept(row_concept_ids[i], num_shards)
+                    else:
+                        shard = (i // shard_block_rows) % num_shards
+                    lines[shard].append(
+                        prefixes_f.read(prefix_lengths[i]).decode("utf-8")
+                        + _format_concept_links(
+                            concepts[start:middle], counts[start:middle]
+                        )
+                        + "\t"
+                        + _format_concept_links(concepts[middle:end], counts[middle:end])
+                        + "\r\n"
+                    )
 
-                intermediate_writer.writerow(row_dict)
-
-        with open(tmp_intermediate_path, "r") as fr, open(output_path, "w") as fw:
-            reader = csv.DictReader(fr, **csv_format_params)
-            writer = csv.DictWriter(fw, **csv_format_params)
-            writer.writeheader()
-            for row in itertools.islice(reader, 1, None):
-                inlinks = ujson.loads(row[f"{wiki_name}_inlinks"])
-                outlinks = ujson.loads(row[f"{wiki_name}_outlinks"])
-
-                inlinks = [
-                    (name_to_id[k], cnt) for k, cnt in inlinks if k in name_to_id
-                ]
-                outlinks = [
-                    (name_to_id[k], cnt) for k, cnt in outlinks if k in name_to_id
-                ]
-
-                row[f"{wiki_name}_inlinks"] = ujson.dumps(inlinks)
-                row[f"{wiki_name}_outlinks"] = ujson.dumps(outlinks)
-                writer.writerow(row)
-    
-        print(f"""
-STATS:
-Considered: {num_considered}
-Empty: {(100 * num_empty / num_considered):.2f}%
-{wiki_name} Aliases: {100 * num_aliases / num_considered:.2f}%
-{wiki_name} Missing Title: {100 * num_no_title / num_considered:.2f}%
-{wiki_name} Missing Article: {100 * num_missing_article / num_considered:.2f}%
-    """.strip())
+                for shard, shard_lines in enumerate(lines):
+                    output.write(shard, "".join(shard_lines), len(shard_lines))
+
+        if checkpointer is not None:
+            for path in paths.values():
+                os.remove(path)
+            checkpointer.clear()
+
+        metrics.add(stats, prefix="full_wiki.")
+        metrics.add(
+            {
+                "article_lookup.hits": stats["ok"] + stats["aliased"],
+                "article_lookup.misses": stats["missing_article"],
+            },
+            prefix="full_wiki.",
+        )
+        metrics.observe("full_wiki.seconds", time.perf_counter() - started)
+        num_considered = max(stats["considered"], 1)
+        logger.info(
+            f"{wiki_name}: considered {stats['considered']}, "
+            f"empty {100 * stats['empty'] / num_considered:.2f}%, "
+            f"aliased {100 * stats['aliased'] / num_considered:.2f}%, "
+            f"missing title {100 * stats['no_title'] / num_considered:.2f}%, "
+            f"missing article {100 * stats['missing_article'] / num_considered:.2f}%"
+        )
 
 
 def _row_dict_from_line(
-    line, wiki_to_article_shelf, wiki_to_alias_shelf, parent_finder, whitelisted_wikis=None
+    line,
+    wiki_to_article_shelf,
+    wiki_to_alias_shelf,
+    parent_finder,
+    whitelisted_wikis=None,
+    lookups=None,
 ):
+    # lookups, if given, is a Counter of article and alias store hits/misses
     entry = WikiDataParser.parse_dump_line(line, whitelisted_wikis=whitelisted_wikis)
 
     if not entry:
@@ -353,10 +746,15 @@ def _row_dict_from_line(
         title = entry.titles_by_wiki.get(wiki)
         if title:
             article = shelf.get(title)
-            if not article:
-                alias = wiki_to_alias_shelf[wiki].get(title)
+            alias_shelf = wiki_to_alias_shelf.get(wiki)
+            if not article and alias_shelf is not None:
+                alias = alias_shelf.get(title)
                 if alias:
                     article = shelf.get(alias)
+                if lookups is not None:
+                    lookups["alias_store.hits" if alias else "alias_store.misses"] += 1
+            if lookups is not None:
+                lookups["article_store.hits" if article else "article_store.misses"] += 1
 
             if article:
                 row_dict[f"{wiki}_title"] = article.title
@@ -384,6 +782,89 @@ def _row_dict_from_line(
     return row_dict
 
 
+global _pool_wiki_to_article_shelf
+global _pool_wiki_to_alias_shelf
+global _pool_parent_finder
+global _pool_whitelisted_wikis
+global _pool_csv_format_params
+global _pool_return_rows
+global _pool_hash_shards
+
+
+def _init_write_csv_pool(
+    wiki_to_article_shelf,
+    wiki_to_alias_shelf,
+    parent_finder,
+    whitelisted_wikis,
+    csv_format_params,
+    return_rows=False,
+    hash_shards=None,
+):
+    global _pool_wiki_to_article_shelf
+    global _pool_wiki_to_alias_shelf
+    global _pool_parent_finder
+    global _pool_whitelisted_wikis
+    global _pool_csv_format_params
+    global _pool_return_rows
+    global _pool_hash_shards
+
+    _pool_wiki_to_article_shelf = wiki_to_article_shelf
+    _pool_wiki_to_alias_shelf = wiki_to_alias_shelf
+    _pool_parent_finder = parent_finder
+    _pool_whitelisted_wikis = whitelisted_wikis
+    _pool_csv_format_params = csv_format_params
+    _pool_return_rows = return_rows
+    _pool_hash_shards = hash_shards
+
+
+def _write_csv_chunk_func(lines):
+    # Returns per-shard text and row counts; one shard unless hash sharding
+    num_shards = _pool_hash_shards or 1
+    bufs = [io.StringIO() for _ in range(num_shards)]
+    writers = [csv.DictWriter(buf, **_pool_csv_format_params) for buf in bufs]
+    counts = [0] * num_shards
+    rows = [] if _pool_return_rows else None
+    lookups = Counter()
+    start = time.perf_counter()
+    for line in lines:
+        lookups["lines"] += 1
+        row_dict = _row_dict_from_line(
+            line,
+            _pool_wiki_to_article_shelf,
+            _pool_wiki_to_alias_shelf,
+            _pool_parent_finder,
+            whitelisted_wikis=_pool_whitelisted_wikis,
+            lookups=lookups,
+        )
+
+        if row_dict:
+            shard = (
+                shard_for_concept(row_dict["concept_id"], num_shards)
+                if _pool_hash_shards
+                else 0
+            )
+            writers[shard].writerow(row_dict)
+            counts[shard] += 1
+            if rows is not None:
+                rows.append(row_dict)
+
+    lookups["rows"] = sum(counts)
+    metrics.add(lookups, prefix="join.")
+    metrics.observe("join.worker.busy", time.perf_counter() - start)
+    return [buf.getvalue() for buf in bufs], counts, rows
+
+
+def _bounded(iterable, semaphore, stopped):
+    # Pool.imap drains its input eagerly; cap how far reading runs ahead.
+    # stopped lets the pool's feeder thread exit if the consumer bails out,
+    # otherwise terminating the pool waits on it forever.
+    for item in iterable:
+        while not semaphore.acquire(timeout=1):
+            if stopped.is_set():
+                return
+        yield item
+
+
 def write_csv(
     wikidata_path,
     output_path,
@@ -393,60 +874,206 @@ def write_csv(
     whitelisted_wikis=None,
     limit=None,
     concurrency=None,
+    chunk_lines=512,
+    columnar_path=None,
+    num_shards=1,
+    shard_by=SHARD_BY_ORDER,
+    checkpoint_dir=None,
+    checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL,
+    bufsize_mb=100,
+    sample_rate=None,
 ):
+    # With num_shards > 1, output_path is a directory of TSV shards plus a
+    # manifest; "order" shards round-robin over input chunks, "hash" by concept.
+    # With checkpoint_dir, a restarted run seeks to the last checkpoint and
+    # appends to the partial output. With sample_rate only concepts in the
+    # hash sample are written.
     wikis = set(wiki_to_article_shelf.keys())
     if whitelisted_wikis:
         wikis &= set(whitelisted_wikis)
 
-    if set(wiki_to_alias_shelf.keys()) != wikis:
-        raise RuntimeError("Missing or additional alias shelf")
-
-    logger.info(f"Writing CSVs for {wikis}")
-
-    with open(output_path, "w") as output:
-        writer = csv.DictWriter(
-            output,
-            delimiter="\t",
-            quotechar='"',
-            quoting=csv.QUOTE_MINIMAL,
-            fieldnames=(
-                [
-                    "concept_id",
-                    "sample_label",
-                    "coord_latitude",
-                    "coord_longitude",
-                    "coord_altitude",
-                    "coord_precision",
-                    "country_of_origin",
-                    "publication_date",
-                ]
-                + list(
-                    itertools.chain.from_iterable(
-                        (f"{wiki}_title", f"{wiki}_pagerank") for wiki in wikis
-                    )
-                )
-                + [
-                    "direct_instance_of",
-                    "recursive_instance_of",
-                    "direct_subclass_of",
-                    "recursive_subclass_of",
-                ]
-            ),
-        )
+    # Article stores may be shelves, shelf paths or ArticleSummaries; the
+    # latter resolve aliases themselves and need no alias shelf
+    wiki_to_alias_shelf = wiki_to_alias_shelf or {}
+    for wiki in wikis:
+        if wiki not in wiki_to_alias_shelf and not isinstance(
+            wiki_to_article_shelf[wiki], ArticleSummaries
+        ):
+            raise RuntimeError(f"Missing alias shelf for {wiki}")
+
+    wikis = sorted(wikis)
+    wiki_to_article_shelf = {
+        wiki: ReadOnlyShelf(wiki_to_article_shelf[wiki])
+        if isinstance(wiki_to_article_shelf[wiki], (str, Path))
+        else wiki_to_article_shelf[wiki]
+        for wiki in wikis
+    }
+    wiki_to_alias_shelf = {
+        wiki: ReadOnlyShelf(wiki_to_alias_shelf[wiki])
+        if isinstance(wiki_to_alias_shelf[wiki], (str, Path))
+        else wiki_to_alias_shelf[wiki]
+        for wiki in wikis
+        if wiki in wiki_to_alias_shelf
+    }
+    concurrency = concurrency or multiprocessing.cpu_count()
+    start = time.perf_counter()
+
+    logger.info(f"Writing CSVs for {wikis} with {concurrency} processes")
+
+    schema = _columnar_schema(wikis)
+    csv_params = dict(delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    hash_shards = num_shards if num_shards > 1 and shard_by == SHARD_BY_HASH else None
+    initargs = [
+        wiki_to_article_shelf,
+        wiki_to_alias_shelf,
+        parent_finder,
+        whitelisted_wikis,
+        dict(fieldnames=[name for name, _ in schema], **csv_params),
+        columnar_path is not None,
+        hash_shards,
+    ]
+    columnar_writer = (
+        ColumnarWriter(columnar_path, schema) if columnar_path is not None else None
+    )
 
-        writer.writeheader()
+    checkpointer = None
+    state = None
+    checkpoint_params = {
+        "wikis": wikis,
+        "whitelisted_wikis": sorted(whitelisted_wikis) if whitelisted_wikis else None,
+        "limit": limit,
+        "chunk_lines": chunk_lines,
+        "num_shards": num_shards,
+        "shard_by": shard_by,
+        "sample_rate": sample_rate,
+    }
+    if checkpoint_dir is not None:
+        if columnar_writer is not None:
+            raise RuntimeError("Checkpointing is not supported with columnar output")
+        checkpointer = Checkpointer(
+            checkpoint_dir, wikidata_path, interval=checkpoint_interval
+        )
+        state = checkpointer.load(**checkpoint_params)
+
+    with open_tsv_writer(
+        output_path,
+        schema,
+        num_shards=num_shards,
+        shard_by=shard_by,
+        resume=state and state["output"],
+        **csv_params,
+    ) as output:
+        first_chunk = state["chunks"] if state else 0
+        chunk_counter = itertools.count(first_chunk)
+        # Chunks handed to the pool so far, for the in-flight gauge
+        chunks_read = [0]
+        reader, line_iter, marks = _checkpointed_input(
+            wikidata_path,
+            checkpointer,
+            state,
+            limit,
+            bufsize_mb=bufsize_mb,
+            sample_rate=sample_rate,
+        )
 
-        for line in itertools.islice(buffered_lines_with_progress(wikidata_path), limit):
-            row_dict = _row_dict_from_line(
-                line, wiki_to_article_shelf, wiki_to_alias_shelf, parent_finder, whitelisted_wikis=whitelisted_wikis,
+        def write_chunk(result):
+            texts, counts, rows = result
+            chunk_idx = next(chunk_counter)
+            metrics.gauge(
+                "join.chunks_in_flight", chunks_read[0] - (chunk_idx + 1 - first_chunk)
             )
+            for shard, (text, count) in enumerate(zip(texts, counts)):
+                output.write(
+                    shard if hash_shards else chunk_idx % num_shards, text, count
+                )
+            if columnar_writer is not None:
+                for row_dict in rows:
+                    columnar_writer.append(row_dict)
+
+            if checkpointer is not None:
+                lines_read, input_offset = marks.popleft()
+                if checkpointer.due():
+                    checkpointer.save(
+                        reader,
+                        checkpoint_params,
+                        input_offset,
+                        lines_read,
+                        chunks=chunk_idx + 1,
+                        output=output.checkpoint(),
+                    )
 
-            if not row_dict:
-                continue
-
-            writer.writerow(row_dict)
+        def chunks_with_marks():
+            # Chunks are written in input order, so each one's end position
+            # is popped from marks as its result is written
+            for chunk in grouper(chunk_lines, line_iter):
+                if reader is not None:
+                    marks.append((reader.lines_read, reader.offset))
+                chunks_read[0] += 1
+                yield chunk
+
+        chunks = chunks_with_marks()
+
+        if concurrency == 1:
+            _init_write_csv_pool(*initargs)
+            for result in map(_write_csv_chunk_func, chunks):
+                write_chunk(result)
+        else:
+            pending = threading.BoundedSemaphore(concurrency * 4)
+            stopped = threading.Event()
+            with _frozen_gc(), multiprocessing.Pool(
+                concurrency, initializer=_init_write_csv_pool, initargs=initargs
+            ) as pool:
+                try:
+                    # imap keeps results in input order
+                    for result in pool.imap(
+                        _write_csv_chunk_func, _bounded(chunks, pending, stopped)
+                    ):
+                        pending.release()
+                        write_chunk(result)
+                finally:
+                    stopped.set()
+
+    if columnar_writer is not None:
+        columnar_writer.close()
+    if checkpointer is not None:
+        checkpointer.clear()
+    metrics.observe("join.seconds", time.perf_counter() - start)
+    metrics.flush()
+
+
+def _columnar_schema(wikis):
+    return (
+        [
+            ("concept_id", columnar.STRING),
+            ("sample_label", columnar.STRING),
+            ("coord_latitude", columnar.FLOAT64),
+            ("coord_longitude", columnar.FLOAT64),
+            ("coord_altitude", columnar.FLOAT64),
+            ("coord_precision", columnar.FLOAT64),
+            ("country_of_origin", columnar.CATEGORY),
+            ("publication_date", columnar.FLOAT64),
+        ]
+        + list(
+            itertools.chain.from_iterable(
+                ((f"{wiki}_title", columnar.STRING), (f"{wiki}_pagerank", columnar.FLOAT64))
+                for wiki in wikis
+            )
+        )
+        # Direct classes repeat across rows; the other lists are nearly unique
+        # per row, so a category table would only add codes
+        + [
+            ("direct_instance_of", columnar.CATEGORY),
+            ("recursive_instance_of", columnar.STRING),
+            ("direct_subclass_of", columnar.STRING),
+            ("recursive_subclass_of", columnar.STRING),
+        ]
+    )
 
 
-def wikidata_inheritance_graph(input_path, limit=None):
-    stream = buffered_lines_with_progress(input_path)
-    return WikiDataParser.inheritance_graph(stream, limit=limit)
\ No newline at end of file
+def wikidata_inheritance_graph(
+    input_path, limit=None, bufsize_mb=100, sample_rate=None
+):
+    stream = buffered_lines_with_progress(input_path, bufsize_mb=bufsize_mb)
+    return WikiDataParser.inheritance_graph(
+        stream, limit=limit, sample_rate=sample_rate
+    )
\ No newline at end of file
@@ -0,0 +1,97 @@
+import cProfile
+import glob
+import logging
+import os
+import pstats
+import signal
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing import util
+
+logger = logging.getLogger(__name__)
+
+
+class _Profiling:
+    # One per process. Forked children (pool workers, scheduler jobs) start
+    # their own profiler for whatever stage their parent was in, and dump it
+    # on exit, including the SIGTERM a Pool sends its workers on exit.
+    def __init__(self, profile_dir):
+        self.profile_dir = profile_dir
+        self.stage = None
+        self.profiler = None
+
+    def start(self, stage):
+        self.stage = stage
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        self.profiler.dump_stats(
+            os.path.join(self.profile_dir, f"{self.stage}.{os.getpid()}.prof")
+        )
+        self.profiler = None
+
+    def _after_fork(self):
+        if self.profiler is not None:
+            # The parent's profiler is inherited still switched on
+            self.profiler.disable()
+            self.profiler = None
+        if self.stage is None:
+            return
+        self.start(self.stage)
+        util.Finalize(self, self.stop, exitpriority=100)
+        # Chain to whatever else wants to flush on SIGTERM, e.g. metrics
+        self._previous_sigterm = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def _on_sigterm(self, signum, frame):
+        self.stop()
+        if callable(self._previous_sigterm):
+            self._previous_sigterm(signum, frame)
+        os._exit(0)
+
+
+_profiling = None
+
+
+def enable(profile_dir):
+    global _profiling
+    os.makedirs(profile_dir, exist_ok=True)
+    _profiling = _Profiling(profile_dir)
+    util.register_after_fork(_profiling, _Profiling._after_fork)
+
+
+@contextmanager
+def profiled(stage):
+    # A no-op unless enable() has been called
+    if _profiling is None:
+        yield
+        return
+    _profiling.start(stage)
+    try:
+        yield
+    finally:
+        _profiling.stop()
+        _profiling.stage = None
+
+
+def merge(profile_dir, top=40):
+    # Combines each stage's per-process dumps into <stage>.prof plus a
+    # cumulative-time summary in <stage>.txt
+    by_stage = defaultdict(list)
+    for path in glob.glob(os.path.join(profile_dir, "*.*.prof")):
+        stage, pid, _ = os.path.basename(path).rsplit(".", 2)
+        by_stage[stage].append(path)
+
+    for stage, paths in sorted(by_stage.items()):
+        stats = pstats.Stats(*paths)
+        stats.dump_stats(os.path.join(profile_dir, f"{stage}.prof"))
+        with open(os.path.join(profile_dir, f"{stage}.txt"), "w") as f:
+            f.write(f"{stage}: merged from {len(paths)} processes\n")
+            pstats.Stats(*paths, stream=f).sort_stats("cumulative").print_stats(top)
+        for path in paths:
+            os.remove(path)
+        logger.info(f"Profile for {stage} in {profile_dir}/{stage}.prof")
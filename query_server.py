@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import functools
+import logging
+import socket
+import threading
+import time
+import ujson
+import numpy as np
+import pandas as pd
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import pandas_helper
+
+logger = logging.getLogger(__name__)
+
+# A local server that loads the dataset once and answers the accessor's
+# queries as newline-delimited JSON over TCP:
+#   {"id": 1, "method": "top_ranked", "params": {"wiki": "jawiki", "n": 10}}
+# answered with
+#   {"id": 1, "result": [...], "cached": false, "latency_ms": 3.2}
+# or {"id": 1, "error": "..."}. {"method": "stats"} returns latencies and
+# cache hits per method.
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 1024
+# Latencies kept per method, for percentiles
+LATENCY_WINDOW = 1000
+
+
+class QueryError(Exception):
+    pass
+
+
+def _jsonable(value):
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, np.generic):
+        return _jsonable(value.item())
+    return value
+
+
+def _records(frame):
+    return [
+        {k: _jsonable(v) for k, v in row.items()}
+        for row in frame.reset_index().to_dict(orient="records")
+    ]
+
+
+class QueryEngine:
+    # The queries, run on request threads. Every index is built before
+    # serving or under a lock, so requests only read shared state.
+    def __init__(self, df):
+        self.df = df
+        self._lock = threading.Lock()
+        self._ranked = {}
+        self._spatial = None
+
+    @classmethod
+    def load(cls, datapath, **load_kwargs):
+        # Through load_data's snapshot, so numeric columns are memory-mapped
+        started = time.time()
+        engine = cls(pandas_helper.load_data(datapath, class_matrix=True, **load_kwargs))
+        engine.warm()
+        logger.info(
+            f"Loaded {len(engine.df)} rows from {datapath} "
+            f"in {time.time() - started:.1f}s"
+        )
+        return engine
+
+    def warm(self):
+        if "coord_latitude" in self.df.columns:
+            self._spatial_index()
+        for direct in (True, False):
+            if pandas_helper._instance_key(self.df.columns, direct) in self.df.columns:
+                self.df.wl.class_matrix(direct=direct).column_index()
+        self._labels("sample_label", folded=False)
+
+    def _cached(self, cache, key, build):
+        with self._lock:
+            if key not in cache:
+                cache[key] = build()
+            return cache[key]
+
+    def _labels(self, col, folded):
+        if col != "sample_label" and not col.endswith("_title"):
+            raise QueryError(f"Can't resolve by {col}")
+        if col not in self.df.columns:
+            raise QueryError(f"No column {col}")
+        with self._lock:
+            return self.df.wl.label_index(col, folded)
+
+    def _spatial_index(self):
+        # Held here and queried directly: the accessor's cached index
+        # rechecks the coordinates on every call
+        with self._lock:
+            if self._spatial is None:
+                if "coord_latitude" not in self.df.columns:
+                    raise QueryError("No coordinates")
+                self._spatial = self.df.wl.spatial_index()
+            return self._spatial
+
+    def _ranked_rows(self, wiki):
+        # Positions of the rows with a title, by descending pagerank; ties
+        # keep row order, like nlargest
+        def build():
+            pagerank = self.df[f"{wiki}_pagerank"].values
+            rows = np.flatnonzero(
+                self.df[f"{wiki}_title"].notna().values & ~np.isnan(pagerank)
+            )
+            return rows[np.argsort(-pagerank[rows], kind="stable")]
+
+        if f"{wiki}_pagerank" not in self.df.columns:
+            raise QueryError(f"No wiki {wiki}")
+        return self._cached(self._ranked, wiki, build)
+
+    def resolve(self, label_name, col="sample_label", folded=False):
+        positions = self._labels(col, folded).positions(label_name)
+        if len(positions) != 1:
+            found = ", ".join(map(str, self.df.index[positions[:10]]))
+            raise QueryError(f"Too many or few rows found ({len(positions)}) {found}")
+        return _records(self.df.iloc[positions])
+
+    def resolve_labels(self, labels, col="sample_label", folded=False):
+        return _records(self._labels(col, folded).resolve(labels))
+
+    def top_ranked(self, wiki, n=200, desc=True, instance_of=None, country=None):
+        if not desc:
+            return _records(
+                self.df.wl.top_ranked(wiki, n, desc, instance_of, country)
+            )
+        ranked = self._ranked_rows(wiki)
+        if instance_of is not None or country is not None:
+            mask = np.ones(len(self.df), dtype=bool)
+            if instance_of is not None:
+                mask &= self.df.wl.is_instance_of(instance_of).values
+            if country is not None:
+                mask &= self.df.wl.is_country_of_origin(country).values
+            ranked = ranked[mask[ranked]]
+        ret = self.df.iloc[ranked[:n]][["sample_label", f"{wiki}_pagerank"]]
+        ret[f"{wiki}_relative_to_max"] = (
+            ret[f"{wiki}_pagerank"] / ret[f"{wiki}_pagerank"].max()
+        )
+        return _records(ret)
+
+    def within_radius(self, radius_km=50, concept_id=None, lat=None, lng=None):
+        # Around a concept or a point, nearest first
+        if concept_id is not None:
+            if concept_id not in self.df.index:
+                raise QueryError(f"No concept {concept_id}")
+            lat, lng = self.df.loc[concept_id, ["coord_latitude", "coord_longitude"]]
+            if pd.isna(lat) or pd.isna(lng):
+                raise QueryError(f"{concept_id} has no coordinates")
+        if lat is None or lng is None:
+            raise QueryError("Need a concept_id or lat and lng")
+        near = self._spatial_index().within_radius(
+            [lat], [lng], np.zeros(1, dtype=np.int64), radius_km
+        )
+        near = near.droplevel("center")
+        ret = self.df.loc[near.index, ["sample_label", "coord_latitude", "coord_longitude"]]
+        ret["distance_km"] = near["distance_km"].values
+        return _records(ret)
+
+    def kl_divergence(
+        self, base_wiki, target_wiki, n=200, marginals=True, importance_weight=1
+    ):
+        # The n most divergent rows
+        ret = self.df.wl.kl_divergence(
+            base_wiki,
+            target_wiki,
+            marginals=marginals,
+            importance_weight=importance_weight,
+        ).nlargest(n, "kl_divergence")
+        return _records(
+            ret[
+                [
+                    "sample_label",
+                    f"{base_wiki}_pagerank",
+                    f"{target_wiki}_pagerank",
+                    "kl_divergence",
+                    "odds_ratio",
+                    "kl_relative_to_max",
+                ]
+            ]
+        )
+
+
+class QueryServer:
+    METHODS = (
+        "resolve",
+        "resolve_labels",
+        "top_ranked",
+        "within_radius",
+        "kl_divergence",
+    )
+
+    def __init__(self, engine, workers=4, cache_size=DEFAULT_CACHE_SIZE):
+        self.engine = engine
+        self.executor = ThreadPoolExecutor(workers)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        # Identical queries already running, which new requests wait on
+        self.inflight = {}
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.counts = defaultdict(Counter)
+
+    def _finished(self, key, future):
+        self.inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.cache[key] = future.result()
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    async def answer(self, method, params):
+        # (result, cached)
+        if method not in self.METHODS:
+            raise QueryError(f"Unknown method {method}")
+        key = ujson.dumps([method, params], sort_keys=True)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key], True
+
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(getattr(self.engine, method), **params)
+            )
+            self.inflight[key] = future
+            future.add_done_callback(functools.partial(self._finished, key))
+        return await asyncio.shield(future), False
+
+    async def respond(self, line):
+        started = time.perf_counter()
+        request = {}
+        try:
+            request = ujson.loads(line)
+            method = request.get("method")
+            if method == "stats":
+                return {"id": request.get("id"), "result": self.stats()}
+            params = request.get("params") or {}
+            result, cached = await self.answer(method, params)
+            response = {"id": request.get("id"), "result": result, "cached": cached}
+        except Exception as e:
+            # Bad requests, and failed queries, are answered with the error
+            if not isinstance(request, dict):
+                request = {}
+            method = request.get("method")
+            cached = False
+            response = {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+
+        seconds = time.perf_counter() - started
+        self.latencies[method].append(seconds)
+        self.counts[method]["requests"] += 1
+        self.counts[method]["cache_hits"] += cached
+        self.counts[method]["errors"] += "error" in response
+        metrics.observe(f"query.{method}.latency", seconds)
+        metrics.inc(f"query.cache.{'hits' if cached else 'misses'}")
+        response["latency_ms"] = seconds * 1000
+        return response
+
+    def stats(self):
+        stats = {}
+        for method, latencies in self.latencies.items():
+            ms = np.array(latencies) * 1000
+            stats[str(method)] = {
+                **self.counts[method],
+                "mean_ms": float(ms.mean()),
+                "p50_ms": float(np.percentile(ms, 50)),
+                "p95_ms": float(np.percentile(ms, 95)),
+                "max_ms": float(ms.max()),
+            }
+        return {"methods": stats, "cached_results": len(self.cache)}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                response = await self.respond(line)
+                writer.write(ujson.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle, host, port, limit=2 ** 20)
+        logger.info(f"Serving queries on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+class QueryClient:
+    # Blocking client, e.g. for notebooks:
+    #   QueryClient().call("top_ranked", wiki="jawiki", n=10)
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.f = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def request(self, method, **params):
+        self.next_id += 1
+        request = {"id": self.next_id, "method": method, "params": params}
+        self.f.write(ujson.dumps(request).encode("utf-8") + b"\n")
+        self.f.flush()
+        return ujson.loads(self.f.readline())
+
+    def call(self, method, **params):
+        response = self.request(method, **params)
+        if "error" in response:
+            raise QueryError(response["error"])
+        return response["result"]
+
+    def frame(self, method, **params):
+        return pd.DataFrame(self.call(method, **params))
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve wikilanguage queries over a dataset loaded once"
+    )
+    parser.add_argument("datapath", help="TSV from write_csv or a columnar dataset")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=4, help="query threads")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    engine = QueryEngine.load(args.datapath)
+    server = QueryServer(engine, workers=args.workers, cache_size=args.cache_size)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import logging
+import os
+import re
+import ujson
+import zlib
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# A sampled run keeps the concepts whose Q-id hashes below the sample rate,
+# and the Wikipedia pages their sitelinks point at, so every stage works on
+# the same slice of the data. Unlike a limit, which takes a prefix of each
+# dump, this picks old and new concepts alike and the slices still join.
+
+# Salted so sampling is independent of crc32 hash sharding
+_SALT = b"wikilanguage-sample:"
+# Entity lines start {"type":"item","id":"Q42",... so the id is found without
+# decoding the line
+_ID_RE = re.compile(rb'"id":\s*"([QP]\d+)"')
+_ID_SEARCH_BYTES = 256
+
+
+def in_sample(concept_id, sample_rate):
+    if isinstance(concept_id, str):
+        concept_id = concept_id.encode("utf-8")
+    return zlib.crc32(_SALT + concept_id) < sample_rate * (1 << 32)
+
+
+def line_concept_id(line):
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    match = _ID_RE.search(line, 0, _ID_SEARCH_BYTES)
+    if match is not None:
+        return match.group(1)
+    if not line.startswith(b"{"):
+        return None
+    return ujson.loads(line.rstrip(b",\r\n"))["id"].encode("utf-8")
+
+
+def line_in_sample(line, sample_rate):
+    # The enclosing "[" and "]" lines are kept; parsers skip them anyway
+    concept_id = line_concept_id(line)
+    return concept_id is None or in_sample(concept_id, sample_rate)
+
+
+def sample_lines(lines, sample_rate):
+    if sample_rate is None:
+        return lines
+    return (line for line in lines if line_in_sample(line, sample_rate))
+
+
+def sampled_sitelink_titles(lines, sample_rate, wikis=None):
+    # Pre-pass over the Wikidata dump: the titles each wiki's sampled pages
+    # have, which the Wikipedia parse keeps
+    titles = defaultdict(set)
+    for line in sample_lines(lines, sample_rate):
+        if not line.startswith(b"{"):
+            continue
+        loaded = ujson.loads(line.rstrip(b",\r\n"))
+        for wiki, sitelink in loaded.get("sitelinks", {}).items():
+            if wikis is None or wiki in wikis:
+                titles[wiki].add(sitelink["title"])
+    return titles
+
+
+def write_sampled_titles(titles, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    for wiki, wiki_titles in titles.items():
+        with open(os.path.join(output_dir, f"{wiki}.txt"), "w", encoding="utf-8") as f:
+            for title in sorted(wiki_titles):
+                f.write(f"{title}\n")
+    logger.info(
+        f"Sampled {sum(len(t) for t in titles.values())} titles "
+        f"across {len(titles)} wikis"
+    )
+
+
+def read_sampled_titles(output_dir, wiki):
+    # A wiki without sampled titles keeps no pages
+    path = os.path.join(output_dir, f"{wiki}.txt")
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f}
@@ -0,0 +1,147 @@
+import logging
+import math
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Rough peak RSS per byte of compressed pages-articles dump. Streaming
+# pagerank re-reads the canonical collection from disk, in-memory pagerank
+# holds it alongside the graph.
+STREAMING_RANK_BYTES_PER_DUMP_BYTE = 4
+IN_MEMORY_RANK_BYTES_PER_DUMP_BYTE = 7
+# Rank in memory only when that fits in this share of the slot's budget
+IN_MEMORY_RANK_BUDGET_FRACTION = 0.5
+DEFAULT_MEMORY_BUDGET_FRACTION = 0.8
+
+
+def physical_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def default_memory_budget():
+    return int(physical_memory() * DEFAULT_MEMORY_BUDGET_FRACTION)
+
+
+def estimate_peak_memory(dump_size, rank_in_memory):
+    per_byte = (
+        IN_MEMORY_RANK_BYTES_PER_DUMP_BYTE
+        if rank_in_memory
+        else STREAMING_RANK_BYTES_PER_DUMP_BYTE
+    )
+    return int(dump_size * per_byte)
+
+
+@dataclass
+class BuildJob:
+    name: str
+    dump_size: int
+    rank_in_memory: bool
+    estimated_peak_bytes: int
+    cores: int
+    args: tuple = ()
+    dedicated: bool = False
+
+
+def plan_jobs(named_sizes, memory_budget, cores, dedicated_name="enwiki"):
+    # named_sizes: list of (name, dump_size, args) for the jobs that need to run
+    total_size = sum(size for _, size, _ in named_sizes) or 1
+    dedicated_size = sum(
+        size for name, size, _ in named_sizes if name == dedicated_name
+    )
+    jobs = []
+    for name, size, args in named_sizes:
+        dedicated = name == dedicated_name
+        # The dedicated slot is sized by its own share of the budget; shared
+        # jobs may use whatever the dedicated slot leaves
+        slot_budget = (
+            memory_budget * size / total_size
+            if dedicated
+            else memory_budget
+            - estimate_peak_memory(dedicated_size, rank_in_memory=False)
+        )
+        rank_in_memory = (
+            estimate_peak_memory(size, rank_in_memory=True)
+            <= slot_budget * IN_MEMORY_RANK_BUDGET_FRACTION
+        )
+        jobs.append(
+            BuildJob(
+                name=name,
+                dump_size=size,
+                rank_in_memory=rank_in_memory,
+                estimated_peak_bytes=estimate_peak_memory(size, rank_in_memory),
+                cores=max(1, min(cores, math.ceil(cores * size / total_size))),
+                args=args,
+                dedicated=dedicated,
+            )
+        )
+
+    jobs.sort(key=lambda j: j.dump_size, reverse=True)
+    return jobs
+
+
+@dataclass
+class _Running:
+    job: BuildJob
+    process: multiprocessing.Process
+    started: float
+
+
+def run_jobs(jobs, target, memory_budget=None, cores=None, poll_interval=1.0):
+    # Runs target(job, *job.args) in a non-daemon process per job (the builds
+    # spawn their own worker processes). Dedicated jobs start straight away;
+    # the rest are admitted largest first while their estimated peak memory
+    # and cores fit in what is left of the budget.
+    memory_budget = memory_budget or default_memory_budget()
+    cores = cores or multiprocessing.cpu_count()
+    pending = [j for j in jobs if not j.dedicated]
+    running = []
+
+    def start(job):
+        logger.info(
+            f"Scheduler: starting {job.name} (peak ~{job.estimated_peak_bytes / 1e9:.1f}GB, "
+            f"{job.cores} cores, rank_in_memory={job.rank_in_memory})"
+        )
+        p = multiprocessing.Process(target=target, args=(job, *job.args), name=job.name)
+        p.start()
+        running.append(_Running(job, p, time.time()))
+
+    try:
+        for job in jobs:
+            if job.dedicated:
+                start(job)
+
+        while pending or running:
+            for r in list(running):
+                if r.process.exitcode is None:
+                    continue
+                running.remove(r)
+                if r.process.exitcode != 0:
+                    raise RuntimeError(
+                        f"Build of {r.job.name} failed with exit code {r.process.exitcode}"
+                    )
+                logger.info(
+                    f"Scheduler: finished {r.job.name} in {time.time() - r.started:.0f}s"
+                )
+
+            memory_used = sum(r.job.estimated_peak_bytes for r in running)
+            cores_used = sum(r.job.cores for r in running)
+            for job in list(pending):
+                fits = (
+                    memory_used + job.estimated_peak_bytes <= memory_budget
+                    and cores_used + job.cores <= cores
+                )
+                # A job too large for the whole budget still runs, on its own
+                if fits or (not running and job is pending[0]):
+                    pending.remove(job)
+                    start(job)
+                    memory_used += job.estimated_peak_bytes
+                    cores_used += job.cores
+
+            time.sleep(poll_interval)
+    except BaseException:
+        for r in running:
+            r.process.terminate()
+        raise
@@ -0,0 +1,159 @@
+import csv
+import os
+import zlib
+import ujson
+from pathlib import Path
+from checkpoint import sync, truncate
+
+MANIFEST_NAME = "manifest.json"
+FORMAT = "wikilanguage-tsv-shards-v1"
+SHARD_BY_ORDER = "order"
+SHARD_BY_HASH = "hash"
+
+
+def is_sharded(path):
+    manifest_path = Path(path) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return False
+    with open(manifest_path) as f:
+        return ujson.load(f).get("format") == FORMAT
+
+
+def shard_name(shard, num_shards):
+    return f"part-{shard:05d}-of-{num_shards:05d}.tsv"
+
+
+def shard_for_concept(concept_id, num_shards):
+    # crc32 rather than hash() so shards are stable across processes and runs
+    return zlib.crc32(concept_id.encode("utf-8")) % num_shards
+
+
+def _open_for_append(path, fieldnames, resume_offset, **csv_params):
+    # Resumed writes truncate whatever followed the last checkpoint
+    if resume_offset is None:
+        f = open(path, "w")
+        csv.DictWriter(f, fieldnames=fieldnames, **csv_params).writeheader()
+        return f
+    truncate(path, resume_offset)
+    return open(path, "a")
+
+
+class SingleTSVWriter:
+    # The unsharded case: one plain TSV at path, no manifest
+    def __init__(self, path, columns, resume=None, **csv_params):
+        self.num_shards = 1
+        self.shard_by = SHARD_BY_ORDER
+        fieldnames = [name for name, _ in columns]
+        self.f = _open_for_append(
+            path, fieldnames, resume and resume["offsets"][0], **csv_params
+        )
+
+    def write(self, shard, text, num_rows):
+        self.f.write(text)
+
+    def checkpoint(self):
+        return {"offsets": [sync(self.f)]}
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_tsv_writer(
+    path, columns, num_shards=1, shard_by=SHARD_BY_ORDER, resume=None, **csv_params
+):
+    # resume is a previous writer's checkpoint() to continue appending from
+    if num_shards == 1:
+        return SingleTSVWriter(path, columns, resume=resume, **csv_params)
+    return ShardedTSVWriter(
+        path, columns, num_shards, shard_by=shard_by, resume=resume, **csv_params
+    )
+
+
+class ShardedTSVWriter:
+    def __init__(
+        self, path, columns, num_shards, shard_by=SHARD_BY_ORDER, resume=None, **csv_params
+    ):
+        # columns is a list of (name, type) pairs recorded in the manifest
+        if shard_by not in (SHARD_BY_ORDER, SHARD_BY_HASH):
+            raise RuntimeError(f"Unknown shard_by {shard_by}")
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.path / MANIFEST_NAME
+        if manifest_path.exists():
+            os.remove(manifest_path)
+
+        self.columns = columns
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        self.row_counts = list(resume["rows"]) if resume else [0] * num_shards
+        fieldnames = [name for name, _ in columns]
+        self.files = [
+            _open_for_append(
+                self.path / shard_name(i, num_shards),
+                fieldnames,
+                resume and resume["offsets"][i],
+                **csv_params,
+            )
+            for i in range(num_shards)
+        ]
+
+    def write(self, shard, text, num_rows):
+        self.files[shard].write(text)
+        self.row_counts[shard] += num_rows
+
+    def checkpoint(self):
+        return {
+            "offsets": [sync(f) for f in self.files],
+            "rows": list(self.row_counts),
+        }
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+        manifest = {
+            "format": FORMAT,
+            "shard_by": self.shard_by,
+            "columns": [{"name": name, "type": kind} for name, kind in self.columns],
+            "rows": sum(self.row_counts),
+            "shards": [
+                {"path": shard_name(i, self.num_shards), "rows": rows}
+                for i, rows in enumerate(self.row_counts)
+            ],
+        }
+        tmp_path = self.path / f"{MANIFEST_NAME}.tmp"
+        with open(tmp_path, "w") as f:
+            ujson.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path / MANIFEST_NAME)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files:
+                f.close()
+
+
+def read_manifest(path):
+    with open(Path(path) / MANIFEST_NAME) as f:
+        manifest = ujson.load(f)
+
+    if manifest.get("format") != FORMAT:
+        raise RuntimeError(f"{path} is not a sharded wikilanguage dataset")
+
+    return manifest
+
+
+def shard_paths(path, manifest=None):
+    manifest = manifest or read_manifest(path)
+    return [str(Path(path) / shard["path"]) for shard in manifest["shards"]]
@@ -0,0 +1,235 @@
+import hashlib
+import logging
+import os
+import resource
+import shutil
+import threading
+import time
+import ujson
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+METADATA_NAME = "stage.json"
+# How often a building stage's process tree is sampled for peak RSS
+RSS_POLL_SECONDS = 0.5
+
+
+@dataclass
+class InputFile:
+    path: str
+
+    def key(self):
+        # Dumps are far too large to hash by content; path, size and mtime
+        # identify a given download
+        stat = os.stat(self.path)
+        return _digest(
+            {
+                "path": os.path.abspath(self.path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+        )
+
+    def output(self, working_dir):
+        return str(self.path)
+
+
+@dataclass
+class Stage:
+    # build(output_path, input_paths, **params, **options) writes the stage's
+    # artifact to output_path. params and version are part of the cache key;
+    # options (concurrency, in-memory switches) only change how work is done.
+    name: str
+    build: Callable
+    inputs: List = field(default_factory=list)
+    params: Dict = field(default_factory=dict)
+    options: Dict = field(default_factory=dict)
+    filename: str = "artifact"
+    version: int = 1
+    # Resumable builds checkpoint inside their partial directory, which is
+    # then kept across restarts instead of being cleared
+    resumable: bool = False
+
+    def key(self):
+        return _digest(
+            {
+                "name": self.name,
+                "version": self.version,
+                "params": self.params,
+                "inputs": [i.key() for i in self.inputs],
+            }
+        )
+
+    def artifact_dir(self, working_dir):
+        return Path(working_dir) / f"{self.name}-{self.key()[:16]}"
+
+    def output(self, working_dir):
+        return str(self.artifact_dir(working_dir) / self.filename)
+
+    def is_complete(self, working_dir):
+        # Artifact directories only appear through an atomic rename
+        return self.artifact_dir(working_dir).is_dir()
+
+
+def _digest(obj):
+    return hashlib.sha256(ujson.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _peak_rss_bytes():
+    # ru_maxrss is in KB on Linux; children only count once they have exited.
+    # Both are maxima over the process's lifetime.
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def _rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _descendants(pid):
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is parenthesized and may contain spaces
+        children[int(stat[stat.rindex(")") + 2 :].split()[1])].append(int(entry))
+    found = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+
+class _StagePeakRss:
+    # The largest RSS of this process or any of its descendants while a stage
+    # builds, polled from /proc since ru_maxrss only covers the whole process
+    # lifetime. Without /proc it falls back to that lifetime maximum.
+    def __init__(self, interval=RSS_POLL_SECONDS):
+        self.interval = interval
+        self.peak_bytes = 0
+        self.polling = os.path.isdir("/proc")
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+
+    def sample(self):
+        pid = os.getpid()
+        for p in [pid] + _descendants(pid):
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes(p))
+
+    def _poll(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if self.polling:
+            self.sample()
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.polling:
+            self._stopped.set()
+            self._thread.join()
+            self.sample()
+        else:
+            self.peak_bytes = _peak_rss_bytes()
+
+
+def read_metadata(stage, working_dir):
+    path = stage.artifact_dir(working_dir) / METADATA_NAME
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return ujson.load(f)
+
+
+def topological_order(targets):
+    order = []
+    seen = set()
+
+    def visit(node):
+        if id(node) in seen or not isinstance(node, Stage):
+            return
+        seen.add(id(node))
+        for i in node.inputs:
+            visit(i)
+        order.append(node)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def plan(targets, working_dir):
+    return [
+        (stage, stage.is_complete(working_dir), stage.artifact_dir(working_dir))
+        for stage in topological_order(targets)
+    ]
+
+
+def format_plan(targets, working_dir):
+    lines = []
+    for stage, complete, artifact_dir in plan(targets, working_dir):
+        status = "cached" if complete else "RUN"
+        lines.append(f"{status:>6}  {stage.name:<24} {artifact_dir}")
+    return "\n".join(lines)
+
+
+def run_stage(stage, working_dir):
+    if stage.is_complete(working_dir):
+        return stage.output(working_dir)
+
+    input_paths = [
+        run_stage(i, working_dir) if isinstance(i, Stage) else i.output(working_dir)
+        for i in stage.inputs
+    ]
+
+    artifact_dir = stage.artifact_dir(working_dir)
+    partial_dir = Path(f"{artifact_dir}.partial")
+    if partial_dir.exists() and not stage.resumable:
+        shutil.rmtree(partial_dir)
+    partial_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Stage {stage.name}: building {artifact_dir}")
+    start = time.time()
+    with _StagePeakRss() as rss:
+        stage.build(
+            str(partial_dir / stage.filename),
+            input_paths,
+            **stage.params,
+            **stage.options,
+        )
+    with open(partial_dir / METADATA_NAME, "w") as f:
+        ujson.dump(
+            {
+                "name": stage.name,
+                "key": stage.key(),
+                "version": stage.version,
+                "params": stage.params,
+                "inputs": input_paths,
+                "seconds": time.time() - start,
+                "peak_rss_bytes": rss.peak_bytes,
+            },
+            f,
+            indent=2,
+        )
+    os.replace(partial_dir, artifact_dir)
+    logger.info(f"Stage {stage.name}: done in {time.time() - start:.0f}s")
+    return stage.output(working_dir)
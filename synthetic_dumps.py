@@ -0,0 +1,363 @@
+import argparse
+import bz2
+import gzip
+import logging
+import os
+import ujson
+import numpy as np
+import dataclasses
+from dataclasses import dataclass
+from xml.sax.saxutils import escape, quoteattr
+from wikidata_parser import WikiDataProperties
+
+logger = logging.getLogger(__name__)
+
+# Deterministic stand-ins for Wikipedia pages-articles XML dumps and the
+# Wikidata JSON dump, small enough to benchmark against offline. Titles are
+# shared between the two so sitelinks resolve against the generated wikis.
+
+
+@dataclass
+class WikipediaDumpSpec:
+    num_pages: int = 10000
+    # Links per page are drawn from a lognormal with this mean; targets are
+    # drawn with Zipf-like popularity so a few pages collect most inlinks
+    mean_links: float = 20.0
+    link_sigma: float = 1.0
+    popularity_exponent: float = 1.1
+    # Share of extra redirect pages, relative to articles, and the longest
+    # redirect -> redirect -> article chain
+    redirect_fraction: float = 0.2
+    max_redirect_chain: int = 3
+    # Share of redirects that are broken or circular
+    bad_redirect_fraction: float = 0.02
+    words_per_link: int = 8
+    seed: int = 0
+
+
+@dataclass
+class WikidataDumpSpec:
+    num_items: int = 20000
+    num_classes: int = 500
+    subclass_depth: int = 6
+    max_superclasses: int = 2
+    max_instance_of: int = 2
+    # Chance an item has a sitelink to a given wiki
+    sitelink_coverage: float = 0.5
+    # Share of sitelinks that name a redirect rather than the article
+    sitelink_redirect_fraction: float = 0.05
+    coordinate_fraction: float = 0.2
+    country_fraction: float = 0.1
+    publication_date_fraction: float = 0.1
+    num_properties: int = 10
+    seed: int = 0
+
+
+GREGORIAN_CALENDAR = "http://www.wikidata.org/entity/Q1985727"
+
+
+def article_title(i):
+    return f"Article {i}"
+
+
+def redirect_title(i):
+    return f"Redirect {i}"
+
+
+def _open_output(path):
+    # gzip with mtime=0 so the same spec always gives the same bytes
+    path = str(path)
+    if path.endswith(".gz"):
+        return gzip.GzipFile(path, mode="wb", mtime=0)
+    elif path.endswith(".bz2"):
+        return bz2.BZ2File(path, mode="wb")
+    return open(path, "wb")
+
+
+def _zipf_choice(rng, n, exponent, size):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def _link_title(spec, t):
+    if t < spec.num_pages:
+        return article_title(t)
+    return redirect_title(t - spec.num_pages)
+
+
+def _redirect_targets(spec, rng):
+    # Redirect i points at an article, or at an earlier redirect to build
+    # chains; a few point nowhere or at themselves
+    num_redirects = int(spec.num_pages * spec.redirect_fraction)
+    targets = []
+    depth = np.zeros(num_redirects, dtype=np.int64)
+    for i in range(num_redirects):
+        r = rng.random_sample()
+        if r < spec.bad_redirect_fraction / 2:
+            targets.append(f"Missing {i}")
+        elif r < spec.bad_redirect_fraction:
+            targets.append(redirect_title(i))
+        elif i > 0 and spec.max_redirect_chain > 1 and r < 0.5:
+            j = rng.randint(i)
+            if depth[j] + 1 < spec.max_redirect_chain:
+                depth[i] = depth[j] + 1
+                targets.append(redirect_title(j))
+            else:
+                targets.append(article_title(rng.randint(spec.num_pages)))
+        else:
+            targets.append(article_title(rng.randint(spec.num_pages)))
+    return targets
+
+
+def _page_xml(page_id, title, text=None, redirect=None):
+    redirect_xml = f"    <redirect title={quoteattr(redirect)} />\n" if redirect else ""
+    return (
+        "  <page>\n"
+        f"    <title>{escape(title)}</title>\n"
+        "    <ns>0</ns>\n"
+        f"    <id>{page_id}</id>\n"
+        f"{redirect_xml}"
+        "    <revision>\n"
+        f"      <id>{page_id + 1000000000}</id>\n"
+        f'      <text xml:space="preserve">{escape(text or "")}</text>\n'
+        "    </revision>\n"
+        "  </page>\n"
+    )
+
+
+def write_wikipedia_dump(path, spec=WikipediaDumpSpec()):
+    rng = np.random.RandomState(spec.seed)
+    redirects = _redirect_targets(spec, rng)
+    num_titles = spec.num_pages + len(redirects)
+    num_links = np.rint(
+        rng.lognormal(
+            np.log(max(spec.mean_links, 1e-9)) - spec.link_sigma ** 2 / 2,
+            spec.link_sigma,
+            size=spec.num_pages,
+        )
+    ).astype(np.int64)
+    all_targets = _zipf_choice(
+        rng, num_titles, spec.popularity_exponent, int(num_links.sum())
+    )
+    lowercase = rng.random_sample(len(all_targets)) < 0.1
+    link_ends = np.cumsum(num_links)
+    filler = " ".join(["lorem"] * spec.words_per_link)
+
+    with _open_output(path) as f:
+        f.write(b'<mediawiki xml:lang="en">\n')
+        for i in range(spec.num_pages):
+            parts = []
+            for j in range(link_ends[i] - num_links[i], link_ends[i]):
+                title = _link_title(spec, all_targets[j])
+                # Some links use a lower case first letter, as editors do
+                if lowercase[j]:
+                    title = title[0].lower() + title[1:]
+                parts.append(
+                    f"[[{title}|{filler}]]" if j % 3 else f"[[{title}]] {filler}"
+                )
+            page = _page_xml(i + 1, article_title(i), text=" ".join(parts))
+            f.write(page.encode("utf-8"))
+
+        for i, target in enumerate(redirects):
+            page = _page_xml(
+                spec.num_pages + i + 1,
+                redirect_title(i),
+                text=f"#REDIRECT [[{target}]]",
+                redirect=target,
+            )
+            f.write(page.encode("utf-8"))
+        f.write(b"</mediawiki>\n")
+
+
+def _entity_claim(qid):
+    return {
+        "mainsnak": {
+            "snaktype": "value",
+            "datavalue": {
+                "type": "wikibase-entityid",
+                "value": {"entity-type": "item", "numeric-id": int(qid[1:]), "id": qid},
+            },
+        }
+    }
+
+
+def _class_levels(spec):
+    # Classes are Q1..Q{num_classes}, split into subclass_depth levels; each
+    # class below the root level subclasses classes on the level above
+    depth = max(1, spec.subclass_depth)
+    bounds = np.linspace(0, spec.num_classes, depth + 1).astype(np.int64)
+    bounds[1] = max(bounds[1], 1)
+    return [
+        (bounds[i], bounds[i + 1]) for i in range(depth) if bounds[i] < bounds[i + 1]
+    ]
+
+
+def write_wikidata_dump(
+    path, wikis=("enwiki",), wiki_spec=WikipediaDumpSpec(), spec=WikidataDumpSpec()
+):
+    rng = np.random.RandomState(spec.seed)
+    levels = _class_levels(spec)
+    num_redirects = int(wiki_spec.num_pages * wiki_spec.redirect_fraction)
+    countries = [f"Q{spec.num_classes + i + 1}" for i in range(20)]
+
+    with _open_output(path) as f:
+        f.write(b"[\n")
+        for p in range(spec.num_properties):
+            entity = {"type": "property", "id": f"P{p + 1}", "claims": {}}
+            f.write(ujson.dumps(entity).encode("utf-8") + b",\n")
+
+        for i in range(spec.num_items):
+            qid = f"Q{i + 1}"
+            claims = {}
+            level = next((l for l, (lo, hi) in enumerate(levels) if lo <= i < hi), None)
+            if level:
+                lo, hi = levels[level - 1]
+                num_parents = rng.randint(1, spec.max_superclasses + 1)
+                parents = rng.randint(lo, hi, size=num_parents)
+                claims[WikiDataProperties.SUBCLASS_OF] = [
+                    _entity_claim(f"Q{p + 1}") for p in sorted(set(parents))
+                ]
+            elif level is None and spec.num_classes:
+                classes = rng.randint(
+                    spec.num_classes, size=rng.randint(1, spec.max_instance_of + 1)
+                )
+                claims[WikiDataProperties.INSTANCE_OF] = [
+                    _entity_claim(f"Q{c + 1}") for c in sorted(set(classes))
+                ]
+
+            if rng.random_sample() < spec.coordinate_fraction:
+                claims[WikiDataProperties.COORDINATE_LOCATION] = [
+                    {
+                        "mainsnak": {
+                            "snaktype": "value",
+                            "datavalue": {
+                                "type": "globecoordinate",
+                                "value": {
+                                    "latitude": float(rng.uniform(-90, 90)),
+                                    "longitude": float(rng.uniform(-180, 180)),
+                                    "altitude": None,
+                                    "precision": 0.0001,
+                                },
+                            },
+                        }
+                    }
+                ]
+            if rng.random_sample() < spec.country_fraction:
+                claims[WikiDataProperties.COUNTRY_OF_ORIGIN] = [
+                    _entity_claim(countries[rng.randint(len(countries))])
+                ]
+            if rng.random_sample() < spec.publication_date_fraction:
+                year = 1800 + rng.randint(220)
+                claims[WikiDataProperties.PUBLICATION_DATE] = [
+                    {
+                        "mainsnak": {
+                            "snaktype": "value",
+                            "datavalue": {
+                                "type": "time",
+                                "value": {
+                                    "time": f"+{year}-01-01T00:00:00Z",
+                                    "precision": 9,
+                                    "calendarmodel": GREGORIAN_CALENDAR,
+                                },
+                            },
+                        }
+                    }
+                ]
+
+            # Item i is described by Article i on every wiki that links it
+            sitelinks = {}
+            if i < wiki_spec.num_pages:
+                for wiki in wikis:
+                    if rng.random_sample() >= spec.sitelink_coverage:
+                        continue
+                    title = article_title(i)
+                    r = rng.random_sample()
+                    if num_redirects and r < spec.sitelink_redirect_fraction:
+                        title = redirect_title(rng.randint(num_redirects))
+                    sitelinks[wiki] = {"site": wiki, "title": title, "badges": []}
+
+            entity = {
+                "type": "item",
+                "id": qid,
+                "labels": {"en": {"language": "en", "value": f"Label {i + 1}"}},
+                "claims": claims,
+                "sitelinks": sitelinks,
+            }
+            f.write(ujson.dumps(entity).encode("utf-8") + b",\n")
+        f.write(b"]\n")
+
+
+def wikipedia_dump_name(wiki):
+    return f"{wiki}-20200701-pages-articles.xml.bz2"
+
+
+WIKIDATA_DUMP_NAME = "wikidata-20200706-all.json.gz"
+
+
+def write_dumps(
+    output_dir, wikis=("enwiki",), wiki_spec=WikipediaDumpSpec(), spec=WikidataDumpSpec()
+):
+    # Lays dumps out the way wikilanguage.py expects to find them in --data-dir
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for i, wiki in enumerate(wikis):
+        paths[wiki] = os.path.join(output_dir, wikipedia_dump_name(wiki))
+        logger.info(f"Writing {paths[wiki]}")
+        # Each wiki gets its own link structure over the same titles
+        write_wikipedia_dump(
+            paths[wiki], dataclasses.replace(wiki_spec, seed=wiki_spec.seed + i)
+        )
+    paths["wikidata"] = os.path.join(output_dir, WIKIDATA_DUMP_NAME)
+    logger.info(f"Writing {paths['wikidata']}")
+    write_wikidata_dump(paths["wikidata"], wikis=wikis, wiki_spec=wiki_spec, spec=spec)
+    return paths
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Write deterministic synthetic dumps")
+    parser.add_argument("output_dir")
+    parser.add_argument("--wikis", default="enwiki,jawiki")
+    wiki_defaults = WikipediaDumpSpec()
+    wikidata_defaults = WikidataDumpSpec()
+    parser.add_argument("--pages", type=int, default=wiki_defaults.num_pages)
+    parser.add_argument("--mean-links", type=float, default=wiki_defaults.mean_links)
+    parser.add_argument(
+        "--redirect-fraction", type=float, default=wiki_defaults.redirect_fraction
+    )
+    parser.add_argument(
+        "--max-redirect-chain", type=int, default=wiki_defaults.max_redirect_chain
+    )
+    parser.add_argument("--items", type=int, default=wikidata_defaults.num_items)
+    parser.add_argument("--classes", type=int, default=wikidata_defaults.num_classes)
+    parser.add_argument(
+        "--subclass-depth", type=int, default=wikidata_defaults.subclass_depth
+    )
+    parser.add_argument(
+        "--sitelink-coverage", type=float, default=wikidata_defaults.sitelink_coverage
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    write_dumps(
+        args.output_dir,
+        wikis=args.wikis.split(","),
+        wiki_spec=WikipediaDumpSpec(
+            num_pages=args.pages,
+            mean_links=args.mean_links,
+            redirect_fraction=args.redirect_fraction,
+            max_redirect_chain=args.max_redirect_chain,
+            seed=args.seed,
+        ),
+        spec=WikidataDumpSpec(
+            num_items=args.items,
+            num_classes=args.classes,
+            subclass_depth=args.subclass_depth,
+            sitelink_coverage=args.sitelink_coverage,
+            seed=args.seed,
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pandas_helper  # noqa: F401, registers the wl accessor
+
+NAN = float("nan")
+
+
+def _frame(coords):
+    return pd.DataFrame(
+        {
+            "coord_latitude": [lat for lat, _ in coords],
+            "coord_longitude": [lng for _, lng in coords],
+        },
+        index=pd.Index([f"Q{i}" for i in range(len(coords))], name="concept_id"),
+    )
+
+
+def test_is_within_radius_without_coordinates():
+    df = _frame([(35.68, 139.69), (NAN, NAN)])
+    assert not df.wl.is_within_radius(NAN, NAN).any()
+    assert list(df.wl.is_within_radius(35.68, 139.69)) == [True, False]
+
+
+def test_within_radius_of_row_without_coordinates():
+    df = _frame([(35.68, 139.69), (35.69, 139.70)])
+    center = _frame([(NAN, NAN)])
+    assert center.wl.within_radius(df).empty
+    assert df.wl.within_radius(center).empty
+
+
+def test_near_each_skips_centers_without_coordinates():
+    df = _frame([(35.68, 139.69), (NAN, NAN), (35.69, 139.70)])
+    near = df.wl.near_each(df, radius_km=5)
+    assert set(near.index.get_level_values("center")) == {"Q0", "Q2"}
+    assert len(near) == 4
+
+
+def test_nearest_each_skips_centers_without_coordinates():
+    df = _frame([(35.68, 139.69), (NAN, NAN), (35.69, 139.70)])
+    nearest = df.wl.nearest_each(df, k=5)
+    assert list(nearest.index.get_level_values("center")) == ["Q0", "Q0", "Q2", "Q2"]
+    assert np.all(nearest["distance_km"].values >= 0)
+
+
+def test_frame_without_coordinated_rows():
+    df = _frame([(NAN, NAN), (NAN, NAN)])
+    assert df.wl.near_each([(35.68, 139.69)]).empty
+    assert df.wl.nearest_each([(35.68, 139.69)], k=3).empty
+    assert not df.wl.is_within_radius(35.68, 139.69).any()
+
+
+def test_nearest_with_k_zero():
+    df = _frame([(35.68, 139.69)])
+    assert df.wl.nearest_each([(35.68, 139.69)], k=0).empty
+
+
+def test_divergence_matches_kl_divergence_with_missing_pageranks():
+    df = pd.DataFrame(
+        {
+            "enwiki_title": ["a", "b", "c", "d", None, "f"],
+            "enwiki_pagerank": [0.4, 0.1, NAN, 0.2, 0.3, 0.5],
+            "dewiki_title": ["A", "B", "C", None, "E", "F"],
+            "dewiki_pagerank": [0.2, 0.3, 0.6, 0.1, 0.4, NAN],
+        },
+        index=pd.Index([f"Q{i}" for i in range(6)], name="concept_id"),
+    )
+    matrix = df.wl.divergence_matrix(block_rows=4)
+    top = df.wl.top_divergent(k=10, block_rows=4)
+    for base, target in [("enwiki", "dewiki"), ("dewiki", "enwiki")]:
+        expected = df.wl.kl_divergence(base, target)
+        pair = matrix.loc[(base, target)]
+        assert pair["matching_rows"] == len(expected) == 4
+        assert np.isclose(pair["kl_divergence"], expected["kl_divergence"].sum())
+        ranked = expected["kl_divergence"].dropna().sort_values(ascending=False)
+        found = top.loc[(base, target)]
+        assert list(found.index) == list(ranked.index)
+        assert np.allclose(found["kl_divergence"], ranked)
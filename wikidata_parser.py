@@ -1,14 +1,21 @@
 from bidict import bidict
 import ujson as json
+import numpy as np
 import time
+import logging
+import metrics
+from sampling import line_in_sample
 import pickle
 from itertools import zip_longest
 import datetime
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 import graph_tool
 import graph_tool.search
 from graph_tool import GraphView
 from typing import Iterator
+from array_store import read_arrays, write_arrays, encode_strings, StringTable
+
+logger = logging.getLogger(__name__)
 
 GlobeCoordinate = namedtuple(
     "GlobeCoordinate", ["latitude", "longitude", "altitude", "precision"]
@@ -55,6 +62,251 @@ class ParentFinder:
         return the_set
 
 
+def qid_to_int(the_id):
+    if not the_id.startswith("Q"):
+        raise RuntimeError(f"Expected a Q-id, got {the_id}")
+    return int(the_id[1:])
+
+
+def int_to_qid(q):
+    return f"Q{q}"
+
+
+def _csr(rows, cols, n):
+    # Deduplicated adjacency in CSR form, sorted by (row, col)
+    pairs = np.unique(rows.astype(np.int64) * n + cols.astype(np.int64))
+    rows, cols = pairs // n, pairs % n
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32)
+
+
+def _csr_gather(indptr, indices, rows):
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(len(offsets))]
+
+
+class CompactParentFinder:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def all_parents(self, the_id, add_to_set=None):
+        the_set = set() if add_to_set is None else add_to_set
+        if the_id in the_set:
+            return the_set
+
+        the_set.add(the_id)
+        if not self.graph.has_id(the_id):
+            return the_set
+
+        indptr = self.graph.parent_indptr
+        indices = self.graph.parent_indices
+        stack = [self.graph.idx_for_id(the_id)]
+        while stack:
+            idx = stack.pop()
+            for p in indices[indptr[idx] : indptr[idx + 1]].tolist():
+                parent_id = self.graph.id_for_idx(p)
+                if parent_id not in the_set:
+                    the_set.add(parent_id)
+                    stack.append(p)
+
+        return the_set
+
+
+class CompactInheritanceGraph:
+    FORMAT = "wikidata-inheritance-v1"
+
+    def __init__(self, arrays):
+        # Vertices are numbered in Q-id order, so qids is sorted
+        self.qids = arrays["qids"]
+        self.labels = StringTable(arrays["label_offsets"], arrays["label_data"])
+        self.parent_indptr = arrays["parent_indptr"]
+        self.parent_indices = arrays["parent_indices"]
+        self.child_indptr = arrays["child_indptr"]
+        self.child_indices = arrays["child_indices"]
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_arrays(path)
+        if meta.get("format") != cls.FORMAT:
+            raise RuntimeError(f"{path} is not a compact inheritance graph")
+        graph = cls(arrays)
+        graph.path = str(path)
+        return graph
+
+    def __reduce__(self):
+        # Workers re-map the file rather than receiving a pickled copy
+        return (self.__class__.load, (self.path,))
+
+    def __len__(self):
+        return len(self.qids)
+
+    def parent_finder(self):
+        return CompactParentFinder(self)
+
+    def has_id(self, the_id):
+        try:
+            self.idx_for_id(the_id)
+        except KeyError:
+            return False
+        return True
+
+    def idx_for_id(self, the_id):
+        q = qid_to_int(the_id)
+        idx = int(np.searchsorted(self.qids, q))
+        if idx >= len(self.qids) or self.qids[idx] != q:
+            raise KeyError(the_id)
+        return idx
+
+    def idxs_for_ids(self, ids):
+        # Vectorized lookup of integer Q-ids; -1 for ids not in the graph
+        qs = np.asarray(ids, dtype=np.int64)
+        idxs = np.searchsorted(self.qids, qs)
+        idxs[idxs >= len(self.qids)] = 0
+        found = len(self.qids) > 0 and self.qids[idxs] == qs
+        return np.where(found, idxs, -1)
+
+    def id_for_idx(self, idx):
+        return int_to_qid(self.qids[idx])
+
+    def label_for_idx(self, idx):
+        return self.labels[idx]
+
+    def label_for_id(self, the_id):
+        return self.label_for_idx(self.idx_for_id(the_id))
+
+    def parent_idxs(self, idx):
+        return self.parent_indices[self.parent_indptr[idx] : self.parent_indptr[idx + 1]]
+
+    def child_idxs(self, idx):
+        return self.child_indices[self.child_indptr[idx] : self.child_indptr[idx + 1]]
+
+    def descendent_mask(self, idx, include_self=True):
+        # Level-synchronous BFS over the child CSR, one numpy gather per level
+        seen = np.zeros(len(self.qids), dtype=bool)
+        seen[idx] = True
+        frontier = np.array([idx], dtype=np.int64)
+        while len(frontier):
+            children = _csr_gather(self.child_indptr, self.child_indices, frontier)
+            children = np.unique(children[~seen[children]])
+            seen[children] = True
+            frontier = children
+
+        if not include_self:
+            seen[idx] = False
+        return seen
+
+    def descendent_idxs(self, idx):
+        return np.flatnonzero(self.descendent_mask(idx, include_self=False))
+
+    def descendent_ids(self, vertex_id):
+        for idx in self.descendent_idxs(self.idx_for_id(vertex_id)):
+            yield self.id_for_idx(idx)
+
+
+class ReachabilityIndex:
+    FORMAT = "wikidata-reachability-v1"
+
+    def __init__(self, graph, class_qids, bits, cache_size=16):
+        # bits[v, k // 8] has bit (7 - k % 8) set when vertex v is a (reflexive,
+        # transitive) subclass of the k-th indexed class
+        self.graph = graph
+        self.class_qids = class_qids
+        self.bits = bits
+        self.cache_size = cache_size
+        self._class_to_column = {int(q): k for k, q in enumerate(class_qids)}
+        self._packed_masks = OrderedDict()
+
+    @classmethod
+    def build(cls, graph, classes=(), top_k=64):
+        # Popular classes are approximated by the number of direct subclasses
+        class_idxs = [graph.idx_for_id(c) for c in classes if graph.has_id(c)]
+        by_degree = np.argsort(-np.diff(graph.child_indptr), kind="stable")
+        for idx in by_degree[: top_k + len(class_idxs)].tolist():
+            if len(class_idxs) >= top_k:
+                break
+            if idx not in class_idxs:
+                class_idxs.append(idx)
+
+        bits = np.zeros((len(graph), (len(class_idxs) + 7) // 8), dtype=np.uint8)
+        for k, idx in enumerate(class_idxs):
+            bits[graph.descendent_mask(idx), k // 8] |= np.uint8(1 << (7 - k % 8))
+
+        return cls(graph, graph.qids[class_idxs], bits)
+
+    @classmethod
+    def load(cls, path, graph):
+        arrays, meta = read_arrays(path)
+        if meta.get("format") != cls.FORMAT:
+            raise RuntimeError(f"{path} is not a reachability index")
+        return cls(graph, arrays["class_qids"], arrays["bits"])
+
+    def dump(self, path):
+        write_arrays(
+            path,
+            {"class_qids": np.asarray(self.class_qids), "bits": self.bits},
+            meta={"format": self.FORMAT},
+        )
+
+    def _packed_mask(self, class_idx):
+        if class_idx in self._packed_masks:
+            self._packed_masks.move_to_end(class_idx)
+            metrics.inc("reachability.mask_cache.hits")
+        else:
+            metrics.inc("reachability.mask_cache.misses")
+            self._packed_masks[class_idx] = np.packbits(
+                self.graph.descendent_mask(class_idx)
+            )
+            if len(self._packed_masks) > self.cache_size:
+                self._packed_masks.popitem(last=False)
+
+        return self._packed_masks[class_idx]
+
+    def _member_idxs(self, idxs, class_id):
+        idxs = np.asarray(idxs, dtype=np.int64)
+        known = idxs >= 0
+        safe_idxs = np.where(known, idxs, 0)
+        q = qid_to_int(class_id)
+        if q in self._class_to_column:
+            metrics.inc("reachability.indexed_class.hits")
+            k = self._class_to_column[q]
+            hits = self.bits[safe_idxs, k // 8] & np.uint8(1 << (7 - k % 8))
+        elif self.graph.has_id(class_id):
+            metrics.inc("reachability.indexed_class.misses")
+            packed = self._packed_mask(self.graph.idx_for_id(class_id))
+            hits = packed[safe_idxs >> 3] & (1 << (7 - (safe_idxs & 7))).astype(
+                np.uint8
+            )
+        else:
+            return np.zeros(len(idxs), dtype=bool)
+
+        return known & (hits != 0)
+
+    def is_subclass_of(self, concept_ids, class_id):
+        # Accepts one Q-id string, a list of Q-id strings or an array of
+        # integer Q-ids; reflexive, so a class is a subclass of itself
+        if isinstance(concept_ids, str):
+            return bool(self.is_subclass_of([qid_to_int(concept_ids)], class_id)[0])
+
+        qs = np.asarray(
+            [qid_to_int(c) if isinstance(c, str) else c for c in concept_ids]
+            if isinstance(concept_ids, list)
+            else concept_ids,
+            dtype=np.int64,
+        )
+        return self._member_idxs(self.graph.idxs_for_ids(qs), class_id)
+
+    def any_subclass_of(self, indptr, class_qids, class_id):
+        # Row i of a CSR list (indptr, class_qids) matches if any of its
+        # classes is a subclass of class_id, e.g. "instance of" queries
+        hits = np.zeros(len(class_qids) + 1, dtype=np.int64)
+        np.cumsum(self.is_subclass_of(class_qids, class_id), out=hits[1:])
+        indptr = np.asarray(indptr, dtype=np.int64)
+        return hits[indptr[1:]] > hits[indptr[:-1]]
+
+
 class WikiDataInheritanceGraph:
     def __init__(self, line_id_to_idx, line_id_to_label, graph):
         self.line_id_to_idx = line_id_to_idx
@@ -128,6 +380,56 @@ class WikiDataInheritanceGraph:
         with open(path, "wb") as f:
             pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+    def dump_compact(self, path):
+        n = len(self.line_id_to_idx)
+        qids = np.empty(n, dtype=np.int64)
+        for the_id, idx in self.line_id_to_idx.items():
+            qids[idx] = qid_to_int(the_id)
+
+        # Renumber vertices in Q-id order so lookups are a binary search
+        order = np.argsort(qids, kind="stable")
+        remap = np.empty(n, dtype=np.int64)
+        remap[order] = np.arange(n)
+
+        label_offsets, label_data = encode_strings(
+            [
+                self.line_id_to_label.get(self.id_for_idx(int(idx)), "<UNKNOWN>")
+                for idx in order
+            ]
+        )
+
+        edges = self.graph.get_edges()
+        superclasses = remap[edges[:, 0].astype(np.int64)]
+        subclasses = remap[edges[:, 1].astype(np.int64)]
+        parent_indptr, parent_indices = _csr(subclasses, superclasses, n)
+        child_indptr, child_indices = _csr(superclasses, subclasses, n)
+
+        write_arrays(
+            path,
+            {
+                "qids": qids[order],
+                "label_offsets": label_offsets,
+                "label_data": label_data,
+                "parent_indptr": parent_indptr,
+                "parent_indices": parent_indices,
+                "child_indptr": child_indptr,
+                "child_indices": child_indices,
+            },
+            meta={"format": CompactInheritanceGraph.FORMAT},
+        )
+
+
+def load_dump_line(line):
+    # Dump lines are str or bytes (ujson decodes either); returns None for
+    # the enclosing "[" and "]" lines
+    if isinstance(line, bytes):
+        if not line.startswith(b"{"):
+            return None
+        return json.loads(line.rstrip(b",\r\n"))
+    if not line.startswith("{"):
+        return None
+    return json.loads(line.rstrip(",\r\n"))
+
 
 def grouper(n, iterable, padvalue=None):
     "grouper(3, 'abcdefg', 'x') --> ('a','b','c'), ('d','e','f'), ('g','x','x')"
@@ -317,7 +619,11 @@ class WikiDataParser:
         return int(min_date.timestamp()) if min_date else None
 
     @classmethod
-    def inheritance_graph(cls, input_stream, limit=None):
+    def inheritance_graph(cls, input_stream, limit=None, sample_rate=None):
+        # A sampled graph keeps every line with a subclass-of claim, so the
+        # class hierarchy stays whole, plus the sampled concepts
+        subclass_of = f'"{WikiDataProperties.SUBCLASS_OF}"'
+        subclass_of_bytes = subclass_of.encode("utf-8")
         g = graph_tool.Graph()
         line_id_to_idx = bidict()
         line_id_to_label = {}
@@ -326,22 +632,41 @@ class WikiDataParser:
             current_property_idx = 0
             num_edges = 0
             start = time.time()
+            # Counts already reported to metrics
+            reported = [0, 0]
 
+            def report(num_lines):
+                metrics.add(
+                    {"lines": num_lines - reported[0], "edges": num_edges - reported[1]},
+                    prefix="inheritance.",
+                )
+                metrics.gauge("inheritance.items", len(line_id_to_idx))
+                reported[:] = [num_lines, num_edges]
+
+            num_lines = 0
             for i, line in enumerate(input_stream):
                 if limit and i >= limit:
                     break
+                num_lines = i + 1
 
-                if i % 10000 == 0:
+                if i % 10000 == 0 and i > 0:
+                    report(i)
                     delta = time.time() - start
-                    print(
-                        f"Reached line {i} with {len(line_id_to_idx)} properties and {num_edges} edges"
-                        f" @ {delta}s ({i / delta} LPS)"
+                    logger.info(
+                        f"Reached line {i} with {len(line_id_to_idx)} properties and "
+                        f"{num_edges} edges @ {delta:.0f}s ({i / delta:.0f} lines/s)"
                     )
 
-                if not line.startswith("{"):
+                if sample_rate is not None and not (
+                    (subclass_of_bytes if isinstance(line, bytes) else subclass_of)
+                    in line
+                    or line_in_sample(line, sample_rate)
+                ):
                     continue
 
-                loaded = json.loads(line.rstrip(",\n"))
+                loaded = load_dump_line(line)
+                if loaded is None:
+                    continue
 
                 line_type = loaded["type"]
                 line_id = loaded["id"]
@@ -386,16 +711,18 @@ class WikiDataParser:
                         yield (line_id_to_idx[superclass_id], line_id_to_idx[line_id])
                         num_edges += 1
 
+            report(num_lines)
+            metrics.observe("inheritance.seconds", time.time() - start)
+
         g.add_edge_list(edge_yielder())
         return WikiDataInheritanceGraph(line_id_to_idx, line_id_to_label, g)
 
     @classmethod
     def parse_dump_line(cls, line, whitelisted_wikis=None):
-        if not line.startswith("{"):
+        loaded = load_dump_line(line)
+        if loaded is None:
             return None
 
-        loaded = json.loads(line.rstrip(",\n"))
-
         line_type = loaded["type"]
         line_id = loaded["id"]
 
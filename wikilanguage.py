@@ -1,149 +1,506 @@
+import argparse
 import tempfile
 import pipelines
+import metrics
+import pandas_helper
+import profiling
+import sampling
+import scheduler
+import stages
 import os
-from wikidata_parser import WikiDataInheritanceGraph
-import glob
+import sys
+import time
+import ujson
+import shutil
+from stages import Stage, InputFile
+from wikidata_parser import CompactInheritanceGraph, ReachabilityIndex
+from wikipedia_parser import ArticleSummaries
 import shelve
 import logging
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_DATA_DIR = "/mnt/evo/projects/wikilanguage/data/20200701"
+DEFAULT_WIKIDATA_NAME = "wikidata-20200706-all.json.gz"
+DEFAULT_WORKING_DIR = "working-dir-20200701/"
+WIKI_STAGES = ["parse", "resolve", "pagerank", "aliases"]
+GLOBAL_STAGES = ["inheritance", "reachability", "join", "views"]
 
-def main():
+
+def _wiki_name(wiki_path):
+    return os.path.basename(str(wiki_path)).split("-")[0]
+
+
+def _sample_stage(output_path, input_paths, sample_rate, wikis, bufsize_mb=100):
+    (wikidata_path,) = input_paths
+    lines = pipelines.buffered_lines_with_progress(wikidata_path, bufsize_mb=bufsize_mb)
+    sampling.write_sampled_titles(
+        sampling.sampled_sitelink_titles(lines, sample_rate, wikis=set(wikis)),
+        output_path,
+    )
+
+
+def _parse_stage(
+    output_path,
+    input_paths,
+    limit=None,
+    sample_rate=None,
+    concurrency=None,
+    bufsize_mb=100,
+):
+    wiki_path, *sampled_titles_path = input_paths
+    titles = None
+    if sample_rate is not None:
+        titles = sampling.read_sampled_titles(
+            sampled_titles_path[0], _wiki_name(wiki_path)
+        )
+    pipelines.store_parsed_pages(
+        wiki_path,
+        output_path,
+        limit=limit,
+        concurrency=concurrency,
+        bufsize_mb=bufsize_mb,
+        titles=titles,
+    )
+
+
+def _resolve_stage(output_path, input_paths):
+    (parsed_path,) = input_paths
+    pipelines.store_resolved_pages(parsed_path, output_path)
+
+
+def _pagerank_stage(output_path, input_paths, rank_in_memory=True):
+    (canonical_path,) = input_paths
+    with shelve.open(output_path) as shelf:
+        pipelines.write_ranked_articles_to_shelf(
+            shelf, canonical_path, rank_in_memory=rank_in_memory
+        )
+
+
+def _alias_index_stage(output_path, input_paths):
+    (shelf_path,) = input_paths
+    with shelve.open(shelf_path, flag="r") as shelf:
+        pipelines.write_article_summaries(shelf, output_path)
+
+
+def _inheritance_stage(
+    output_path, input_paths, limit=None, sample_rate=None, bufsize_mb=100
+):
+    (wikidata_path,) = input_paths
+    inheritance_graph = pipelines.wikidata_inheritance_graph(
+        wikidata_path, limit=limit, bufsize_mb=bufsize_mb, sample_rate=sample_rate
+    )
+    inheritance_graph.dump_compact(output_path)
+
+
+def _reachability_stage(output_path, input_paths):
+    (inheritance_path,) = input_paths
+    ReachabilityIndex.build(CompactInheritanceGraph.load(inheritance_path)).dump(
+        output_path
+    )
+
+
+def _join_stage(
+    output_path,
+    input_paths,
+    wikis,
+    limit=None,
+    whitelisted_wikis=None,
+    sample_rate=None,
+    concurrency=None,
+    bufsize_mb=100,
+):
+    wikidata_path, inheritance_path, *summaries_paths = input_paths
+    pipelines.write_csv(
+        wikidata_path,
+        output_path,
+        {
+            wiki: ArticleSummaries(path)
+            for wiki, path in zip(wikis, summaries_paths)
+        },
+        None,
+        CompactInheritanceGraph.load(inheritance_path).parent_finder(),
+        limit=limit,
+        whitelisted_wikis=whitelisted_wikis,
+        concurrency=concurrency,
+        checkpoint_dir=f"{output_path}.checkpoint",
+        bufsize_mb=bufsize_mb,
+        sample_rate=sample_rate,
+    )
+
+
+def _views_stage(output_path, input_paths, k=200, num_classes=500, num_countries=100):
+    (joined_path,) = input_paths
+    df = pandas_helper.load_data(joined_path, cache=False)
+    pandas_helper.TopViews.build(
+        df, k=k, num_classes=num_classes, num_countries=num_countries
+    ).save(output_path)
+
+
+def _sampled_params(params, sample_rate):
+    # Unsampled runs keep their original stage keys
+    if sample_rate is not None:
+        params["sample_rate"] = sample_rate
+    return params
+
+
+def wiki_stages(wikiname, wiki_path, limit=None, options=None, sample=None):
+    # sample is the sampled titles stage of a sampled run
+    options = options or {}
+    parse = Stage(
+        f"parse_{wikiname}",
+        _parse_stage,
+        [InputFile(str(wiki_path))] + ([sample] if sample else []),
+        params=_sampled_params(
+            {"limit": limit}, sample.params["sample_rate"] if sample else None
+        ),
+        options=dict(options.get("parse", {})),
+        filename="pages.msgpack",
+    )
+    resolve = Stage(
+        f"resolve_{wikiname}", _resolve_stage, [parse], filename="canonical.msgpack"
+    )
+    pagerank = Stage(f"pagerank_{wikiname}", _pagerank_stage, [resolve], filename="shelf")
+    aliases = Stage(
+        f"alias_index_{wikiname}",
+        _alias_index_stage,
+        [pagerank],
+        filename="summaries.wlsum",
+    )
+    return {"parse": parse, "resolve": resolve, "pagerank": pagerank, "aliases": aliases}
+
+
+def pipeline_stages(
+    wikidata_path,
+    wiki_paths,
+    limit=None,
+    whitelisted_wikis=None,
+    options=None,
+    sample_rate=None,
+):
+    # options maps stage kinds to build options, which don't affect artifacts.
+    # With sample_rate, every stage works on the same hash sample of concepts.
+    options = options or {}
+    wikidata_input = InputFile(str(wikidata_path))
+    wiki_paths = [
+        p
+        for p in wiki_paths
+        if whitelisted_wikis is None or _wiki_name(p) in whitelisted_wikis
+    ]
+    sample = None
+    if sample_rate is not None:
+        sample = Stage(
+            "sample",
+            _sample_stage,
+            [wikidata_input],
+            params={
+                "sample_rate": sample_rate,
+                "wikis": sorted(_wiki_name(p) for p in wiki_paths),
+            },
+            options=dict(options.get("sample", {})),
+            filename="titles",
+        )
+
+    per_wiki = {}
+    for wiki_path in wiki_paths:
+        wikiname = _wiki_name(wiki_path)
+        per_wiki[wikiname] = (
+            wiki_path,
+            wiki_stages(wikiname, wiki_path, limit=limit, options=options, sample=sample),
+        )
+
+    inheritance = Stage(
+        "inheritance_graph",
+        _inheritance_stage,
+        [wikidata_input],
+        params=_sampled_params({"limit": limit}, sample_rate),
+        options=dict(options.get("inheritance", {})),
+        filename="inheritance.wlgraph",
+    )
+    reachability = Stage(
+        "reachability", _reachability_stage, [inheritance], filename="reachability.wlidx"
+    )
+    wikis = sorted(per_wiki)
+    join = Stage(
+        "join",
+        _join_stage,
+        [wikidata_input, inheritance] + [per_wiki[wiki][1]["aliases"] for wiki in wikis],
+        params=_sampled_params(
+            {
+                "wikis": wikis,
+                "limit": limit,
+                "whitelisted_wikis": sorted(whitelisted_wikis)
+                if whitelisted_wikis is not None
+                else None,
+            },
+            sample_rate,
+        ),
+        options=dict(options.get("join", {})),
+        filename="wikilanguage.tsv",
+        resumable=True,
+    )
+    # Not part of a run; built on request for pandas_helper.load_data(top_views=)
+    views = Stage("views", _views_stage, [join], filename="top_views.npz")
+    global_stages = {
+        "inheritance": inheritance,
+        "reachability": reachability,
+        "join": join,
+        "views": views,
+    }
+    if sample is not None:
+        global_stages["sample"] = sample
+    return per_wiki, global_stages
+
+
+def _profiled_build(stage):
+    build = stage.build
+
+    def run(*args, **kwargs):
+        with profiling.profiled(stage.name):
+            return build(*args, **kwargs)
+
+    return run
+
+
+def build_wiki(job, aliases_stage, working_dir):
+    # Runs in its own process under the scheduler
     logging.basicConfig(level=logging.INFO)
+    stages.run_stage(aliases_stage, working_dir)
 
-    data_dir = Path("/mnt/evo/projects/wikilanguage/data/20200701")
-    wikidata_path = data_dir / "wikidata-20200706-all.json.gz"
-    wiki_paths = list(data_dir.glob("*-pages-articles*"))
-    wiki_paths.sort(key=lambda p: os.stat(p).st_size, reverse=True)
 
-    limit = None
-    output_path = data_dir / "wikilanguage.tsv"
-    whitelisted_wikis = None
-    working_dir = "working-dir-20200701/"
+def plan_wikis(per_wiki, working_dir, memory_budget, cores, parse_workers=None):
+    # Sets each unbuilt wiki's parse workers and in-memory ranking from the
+    # scheduler's plan, so they fit the memory budget
+    named_sizes = []
+    for wikiname, (wiki_path, wiki) in per_wiki.items():
+        if wiki["aliases"].is_complete(working_dir):
+            continue
+        named_sizes.append(
+            (wikiname, os.stat(wiki_path).st_size, (wiki["aliases"], working_dir))
+        )
 
-    logging.info(f"Wiki paths: {wiki_paths}")
+    jobs = scheduler.plan_jobs(named_sizes, memory_budget, cores)
+    for job in jobs:
+        wiki = per_wiki[job.name][1]
+        wiki["parse"].options["concurrency"] = parse_workers or job.cores
+        wiki["pagerank"].options["rank_in_memory"] = job.rank_in_memory
+    return jobs
+
+
+def build_wikis(per_wiki, working_dir, memory_budget, cores, parse_workers=None):
+    jobs = plan_wikis(per_wiki, working_dir, memory_budget, cores, parse_workers)
+    scheduler.run_jobs(jobs, build_wiki, memory_budget=memory_budget, cores=cores)
+
+
+def link_output(joined_path, output_path):
+    logger.info(f"Linking {joined_path} to {output_path}")
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    try:
+        os.link(joined_path, output_path)
+    except OSError:
+        shutil.copyfile(joined_path, output_path)
 
-    # limit = 10000
-    # output_path = "data/test.tsv"
-    # whitelisted_wikis = {"enwiki", "jawiki"}
-    # working_dir = "working-test/"
+
+def write_bench_report(path, targets, working_dir, cached, total_seconds):
+    report = {
+        "command": sys.argv,
+        "working_dir": str(working_dir),
+        "total_seconds": total_seconds,
+        "stages": [],
+    }
+    for stage in stages.topological_order(targets):
+        metadata = stages.read_metadata(stage, working_dir) or {}
+        report["stages"].append(
+            {
+                "name": stage.name,
+                "cached": cached[stage.name],
+                "complete": stage.is_complete(working_dir),
+                "seconds": metadata.get("seconds"),
+                "peak_rss_bytes": metadata.get("peak_rss_bytes"),
+                "options": stage.options,
+            }
+        )
+    with open(path, "w") as f:
+        ujson.dump(report, f, indent=2)
+    logger.info(f"Wrote timing report to {path}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the wikilanguage dataset from Wikipedia and Wikidata dumps"
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "plan"] + WIKI_STAGES + GLOBAL_STAGES,
+        help="run builds everything, plan shows which stages would run, "
+        "anything else builds that stage and whatever it depends on",
+    )
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument(
+        "--wikidata", help=f"Wikidata JSON dump (default DATA_DIR/{DEFAULT_WIKIDATA_NAME})"
+    )
+    parser.add_argument("--wiki-glob", default="*-pages-articles*")
+    parser.add_argument("--output", help="default DATA_DIR/wikilanguage.tsv")
+    parser.add_argument(
+        "--working-dir",
+        default=DEFAULT_WORKING_DIR,
+        help="stage cache; pass an empty string for a throwaway temp dir",
+    )
+    parser.add_argument("--limit", type=int)
+    parser.add_argument(
+        "--sample",
+        type=float,
+        help="keep this fraction of concepts, chosen by a hash of the Q-id, "
+        "and their pages in every stage, e.g. 0.01",
+    )
+    parser.add_argument("--wikis", help="comma separated allowlist, e.g. enwiki,jawiki")
+    parser.add_argument(
+        "--parse-workers", type=int, help="processes per wiki parse (default: scheduled)"
+    )
+    parser.add_argument("--join-workers", type=int, help="processes for the join")
+    parser.add_argument("--bufsize-mb", type=int, default=100)
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        help="memory the wiki builds may use together (default 80%% of RAM)",
+    )
+    parser.add_argument("--cores", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--profile", metavar="DIR", help="write per-stage cProfile output across all processes"
+    )
+    parser.add_argument("--bench", metavar="PATH", help="write a JSON timing report")
+    parser.add_argument(
+        "--metrics",
+        metavar="DIR",
+        help="collect counters, rates and RSS from all processes into DIR/report.json",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=30.0,
+        help="seconds between metrics snapshots appended to DIR/snapshots.jsonl",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+
+    data_dir = Path(args.data_dir)
+    wikidata_path = Path(args.wikidata or data_dir / DEFAULT_WIKIDATA_NAME)
+    output_path = Path(args.output or data_dir / "wikilanguage.tsv")
+    wiki_paths = list(data_dir.glob(args.wiki_glob))
+    wiki_paths.sort(key=lambda p: os.stat(p).st_size, reverse=True)
+    whitelisted_wikis = set(args.wikis.split(",")) if args.wikis else None
+    memory_budget = (
+        int(args.memory_budget_gb * 1e9)
+        if args.memory_budget_gb
+        else scheduler.default_memory_budget()
+    )
+
+    logging.info(f"Wiki paths: {wiki_paths}")
 
     if not os.path.exists(wikidata_path):
         raise RuntimeError(f"{wikidata_path} not found!")
 
-    wiki_shelves = {}
-    alias_shelves = {}
-    temps = []
+    working_dir = args.working_dir
+    temp_dir = None
+    if not working_dir:
+        temp_dir = tempfile.mkdtemp()
+        working_dir = temp_dir
+
+    options = {
+        "parse": {"bufsize_mb": args.bufsize_mb},
+        "sample": {"bufsize_mb": args.bufsize_mb},
+        "inheritance": {"bufsize_mb": args.bufsize_mb},
+        "join": {"bufsize_mb": args.bufsize_mb, "concurrency": args.join_workers},
+    }
+    if args.parse_workers:
+        options["parse"]["concurrency"] = args.parse_workers
+
     try:
-        for wiki_path in wiki_paths:
-            wikiname = os.path.basename(str(wiki_path)).split("-")[0]
-            if whitelisted_wikis is not None and wikiname not in whitelisted_wikis:
-                continue
-
-            alias_shelf_working_path = (
-                os.path.join(working_dir, f"aliases_{wikiname}") if working_dir else None
-            )
-            wiki_shelf_working_path = (
-                os.path.join(working_dir, f"{wikiname}") if working_dir else None
-            )
-
-            # Build main wiki shelf
-            if wiki_shelf_working_path and glob.glob(f"{wiki_shelf_working_path}*"):
-                logger.info(f"Reading shelf from {wiki_shelf_working_path}")
-                shelf = shelve.open(wiki_shelf_working_path)
-            else:
-                temp = tempfile.NamedTemporaryFile(delete=False)
-                temp.close()
-                os.remove(temp.name)
-                in_memory = wikiname != "enwiki"
-                logger.info(
-                    f"Main: starting write {wikiname} to {temp.name} (in_memory={in_memory})"
-                )
-                temps.append(temp)
-                shelf = shelve.open(temp.name)
-                pipelines.write_articles_to_shelf(
-                    shelf, str(wiki_path), rank_in_memory=in_memory, limit=limit
+        per_wiki, global_stages = pipeline_stages(
+            wikidata_path,
+            wiki_paths,
+            limit=args.limit,
+            sample_rate=args.sample,
+            whitelisted_wikis=whitelisted_wikis,
+            options=options,
+        )
+        if args.command in ("run", "plan"):
+            targets = [global_stages["join"], global_stages["reachability"]]
+        elif args.command in WIKI_STAGES:
+            targets = [wiki[args.command] for _, wiki in per_wiki.values()]
+        else:
+            targets = [global_stages[args.command]]
+
+        logger.info(f"Plan:\n{stages.format_plan(targets, working_dir)}")
+        if args.command == "plan":
+            return
+
+        if args.metrics:
+            metrics.enable(args.metrics, args.metrics_interval, snapshots=True)
+        if args.profile:
+            profiling.enable(args.profile)
+            for stage in stages.topological_order(targets):
+                stage.build = _profiled_build(stage)
+
+        cached = {
+            stage.name: stage.is_complete(working_dir)
+            for stage in stages.topological_order(targets)
+        }
+        start = time.time()
+        try:
+            if args.command == "run":
+                if "sample" in global_stages:
+                    # Before the wiki builds, which all depend on it
+                    stages.run_stage(global_stages["sample"], working_dir)
+                build_wikis(
+                    per_wiki,
+                    working_dir,
+                    memory_budget,
+                    args.cores,
+                    parse_workers=args.parse_workers,
                 )
-                if wiki_shelf_working_path:
-                    for desc in glob.glob(f"{temp.name}*"):
-                        _, ext = os.path.splitext(desc)
-                        logger.info(
-                            f"Copying shelf {desc} to {wiki_shelf_working_path}{ext}"
-                        )
-                        os.rename(f"{desc}", f"{wiki_shelf_working_path}{ext}")
-                    shelf = shelve.open(wiki_shelf_working_path)
-
-            wiki_shelves[wikiname] = shelf
-
-            # Build alias shelves
-            if alias_shelf_working_path and glob.glob(f"{alias_shelf_working_path}*"):
-                logger.info(f"Reading alias shelf from {alias_shelf_working_path}")
-                alias_shelf = shelve.open(alias_shelf_working_path)
+                logger.info(f"Done wiki writes, building inheritance graph and join")
+                stages.run_stage(global_stages["reachability"], working_dir)
+                link_output(stages.run_stage(global_stages["join"], working_dir), output_path)
+                logger.info(f"Done write to {output_path}!")
             else:
-                logger.info(
-                    f"Writing alias shelf for {wikiname}"
+                # The wikis the targets depend on build one at a time here,
+                # with the options a run would give them
+                needed = {id(stage) for stage in stages.topological_order(targets)}
+                plan_wikis(
+                    {
+                        name: (path, wiki)
+                        for name, (path, wiki) in per_wiki.items()
+                        if any(id(stage) in needed for stage in wiki.values())
+                    },
+                    working_dir,
+                    memory_budget,
+                    args.cores,
+                    parse_workers=args.parse_workers,
                 )
-                temp = tempfile.NamedTemporaryFile(delete=False)
-                temp.close()
-                os.remove(temp.name)
-                temps.append(temp)
-                alias_shelf = shelve.open(temp.name)
-                pipelines.write_aliases_to_shelf(shelf.items(), alias_shelf)
-                
-                if alias_shelf_working_path:
-                    for desc in glob.glob(f"{temp.name}*"):
-                        _, ext = os.path.splitext(desc)
-                        logger.info(
-                            f"Copying alias shelf {desc} to {alias_shelf_working_path}{ext}"
-                        )
-                        os.rename(f"{desc}", f"{alias_shelf_working_path}{ext}")
-                    alias_shelf = shelve.open(alias_shelf_working_path)
-
-            alias_shelves[wikiname] = alias_shelf
-
-        logger.info(f"Done wiki writes, loading inheritance graph")
-
-        inheritance_working_path = (
-            os.path.join(working_dir, f"inheritance.pickle") if working_dir else None
-        )
-        if inheritance_working_path and os.path.exists(inheritance_working_path):
-            logger.info(f"Loading inheritance graph from {inheritance_working_path}")
-            inheritance_graph = WikiDataInheritanceGraph.load(inheritance_working_path)
-        else:
-            inheritance_graph = pipelines.wikidata_inheritance_graph(
-                str(wikidata_path), limit=limit
-            )
-            logger.info(f"Loaded inheritance graph!")
-            if inheritance_working_path:
-                logger.info(f"Dumping to {inheritance_working_path}")
-                inheritance_graph.dump(inheritance_working_path)
-
-        parent_finder = inheritance_graph.parent_finder()
-        del inheritance_graph
-        logger.info(f"Writing wikidata to {output_path}")
-        pipelines.write_csv(
-            str(wikidata_path),
-            str(output_path),
-            wiki_shelves,
-            alias_shelves,
-            parent_finder,
-            limit=limit,
-            whitelisted_wikis=whitelisted_wikis,
-        )
-        logger.info(f"Done write to {output_path}!")
+                for stage in targets:
+                    logger.info(f"Built {stages.run_stage(stage, working_dir)}")
+        finally:
+            if args.profile:
+                profiling.merge(args.profile)
+            if args.bench:
+                write_bench_report(
+                    args.bench, targets, working_dir, cached, time.time() - start
+                )
+            if args.metrics:
+                metrics.write_report(os.path.join(args.metrics, "report.json"))
 
     finally:
-        for shelf in wiki_shelves.values():
-            shelf.close()
-
-        for temp in temps:
-            for desc in glob.glob(f"{temp.name}*"):
-                try:
-                    os.remove(desc)
-                except FileNotFoundError:
-                    pass
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
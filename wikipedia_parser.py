@@ -9,8 +9,24 @@ import queue
 from collections import namedtuple, Counter
 from typing import Set, Optional
 import signal
+import math
+import logging
+import numpy as np
+import metrics
+from array_store import (
+    read_arrays,
+    write_arrays,
+    encode_strings,
+    StringTable,
+    FrozenKeyIndex,
+)
 
 UnparsedRawPage = namedtuple("UnparsedRawPage", ["id", "title", "redirect", "text"])
+ArticleSummary = namedtuple(
+    "ArticleSummary", ["title", "pagerank", "pagerank_percentile"]
+)
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -44,7 +60,7 @@ class ParsedRawPage:
 
     def to_msgpack(self):
         return msgpack.packb(
-            (self.id, self.title, self.redirect, self.text), use_bin_type=True
+            (self.id, self.title, self.redirect, dict(self.links)), use_bin_type=True
         )
 
 
@@ -123,11 +139,94 @@ class WikipediaCanonicalPage:
         )
 
 
+class ArticleSummaries:
+    # Memory-mapped title/alias -> (canonical title, pagerank) lookup, the part
+    # of a wiki shelf the multi-wiki join needs, shared by all pool workers
+    FORMAT = "article-summaries-v1"
+
+    def __init__(self, path):
+        arrays, meta = read_arrays(path)
+        if meta.get("format") != self.FORMAT:
+            raise RuntimeError(f"{path} is not an article summary file")
+
+        self.path = str(path)
+        self.index = FrozenKeyIndex(
+            arrays["hashes"], StringTable(arrays["key_offsets"], arrays["key_data"])
+        )
+        self.key_articles = arrays["key_articles"]
+        self.titles = StringTable(arrays["title_offsets"], arrays["title_data"])
+        self.pageranks = arrays["pageranks"]
+        self.pagerank_percentiles = arrays["pagerank_percentiles"]
+
+    @classmethod
+    def write(cls, articles, path):
+        titles = []
+        pageranks = []
+        pagerank_percentiles = []
+        alias_keys = {}
+        for article in articles:
+            for alias in article.aliases:
+                alias_keys[alias] = len(titles)
+            titles.append(article.title)
+            pageranks.append(article.pagerank)
+            pagerank_percentiles.append(article.pagerank_percentile)
+
+        # Canonical titles win over aliases, as in a shelf lookup before the
+        # alias shelf
+        key_to_article = alias_keys
+        key_to_article.update((title, i) for i, title in enumerate(titles))
+        keys = list(key_to_article)
+        order, hashes = FrozenKeyIndex.sort_order(keys)
+        key_offsets, key_data = encode_strings([keys[i] for i in order])
+        title_offsets, title_data = encode_strings(titles)
+        write_arrays(
+            path,
+            {
+                "hashes": hashes,
+                "key_offsets": key_offsets,
+                "key_data": key_data,
+                "key_articles": np.array(
+                    [key_to_article[keys[i]] for i in order], dtype=np.int64
+                ),
+                "title_offsets": title_offsets,
+                "title_data": title_data,
+                "pageranks": np.array(pageranks, dtype=np.float64),
+                "pagerank_percentiles": np.array(
+                    pagerank_percentiles, dtype=np.float64
+                ),
+            },
+            meta={"format": cls.FORMAT},
+        )
+
+    def __reduce__(self):
+        return (self.__class__, (self.path,))
+
+    def get(self, title, default=None):
+        pos = self.index.position(title)
+        if pos < 0:
+            return default
+
+        idx = self.key_articles[pos]
+        pagerank = float(self.pageranks[idx])
+        pagerank_percentile = float(self.pagerank_percentiles[idx])
+        return ArticleSummary(
+            self.titles[idx],
+            None if math.isnan(pagerank) else pagerank,
+            None if math.isnan(pagerank_percentile) else pagerank_percentile,
+        )
+
+    def __len__(self):
+        return len(self.titles)
+
+
 class WikiXMLHandler(xml.sax.ContentHandler):
-    def __init__(self, queue, limit=None):
+    def __init__(self, queue, limit=None, titles=None):
         super().__init__()
 
         self.queue = queue
+        # With titles, only those pages and redirects to them are kept
+        self.titles = titles
+        self.keep_page = True
         self.element_count = 0
         self.page_count = 0
         self.in_page = False
@@ -144,6 +243,7 @@ class WikiXMLHandler(xml.sax.ContentHandler):
         self.seen_page_revision = False
         self.in_revision = False
         self.in_revision_text = False
+        self.page_truncated = False
 
         self.in_id = False
         self.id_buffer = None
@@ -194,6 +294,13 @@ class WikiXMLHandler(xml.sax.ContentHandler):
 
                 self.in_revision = True
             elif self.in_revision and name == "text":
+                # Title and redirect come before the text, which is only
+                # buffered for pages we keep
+                self.keep_page = (
+                    self.titles is None
+                    or self.page_title in self.titles
+                    or self.page_redirect in self.titles
+                )
                 self.in_revision_text = True
                 self.revision_text_buffer = io.StringIO()
                 self.revision_text_length = 0
@@ -235,10 +342,11 @@ class WikiXMLHandler(xml.sax.ContentHandler):
         if self.in_title:
             self.title_buffer.write(data)
         elif self.in_revision_text:
+            if not self.keep_page:
+                return
             if self.revision_text_length > self.revision_text_limit:
-                print(
-                    f"Hit revision text limit for {self.title_buffer.getvalue()}! Skipping"
-                )
+                # Counted once per page, in handle_page
+                self.page_truncated = True
                 return
 
             self.revision_text_length += len(data)
@@ -247,6 +355,13 @@ class WikiXMLHandler(xml.sax.ContentHandler):
             self.id_buffer.write(data)
 
     def handle_page(self):
+        if self.page_truncated:
+            metrics.inc("parse.truncated_pages")
+            self.page_truncated = False
+        if not self.keep_page:
+            metrics.inc("parse.skipped_pages")
+            self.keep_page = True
+            return
         self.page_count += 1
 
         self.queue.put(
@@ -254,13 +369,16 @@ class WikiXMLHandler(xml.sax.ContentHandler):
                 self.page_id, self.page_title, self.page_redirect, self.page_text
             )
         )
+        metrics.inc("parse.pages")
 
         if self.limit and self.page_count >= self.limit:
             raise StopIteration("Stopping")
         elif self.page_count % 10000 == 0:
+            metrics.gauge("parse.reader_queue_depth", self.queue.qsize())
             delta = time.time() - self.start_time
-            print(
-                f"Made it to {self.page_title} ({self.page_count}) in {delta}s ({self.page_count / delta})pps"
+            logger.info(
+                f"Made it to {self.page_title} ({self.page_count}) in {delta:.0f}s "
+                f"({self.page_count / delta:.0f} pages/s)"
             )
 
 
@@ -285,23 +403,27 @@ class timeout:
 
 class WikipediaDumpParser:
     @classmethod
-    def parsed_wikipedia_pages(cls, stream, limit=None, concurrency=None):
+    def parsed_wikipedia_pages(cls, stream, limit=None, concurrency=None, titles=None):
         concurrency = concurrency or multiprocessing.cpu_count()
 
         def unparsed2parsed_worker(reader_queue, writer_queue):
             while True:
                 unparsed_page = reader_queue.get()
                 if unparsed_page is None:
+                    metrics.flush()
                     return
 
+                start = time.perf_counter()
                 try:
                     # Certain inputs cause infinite spinning while parsing
                     with timeout(seconds=60):
                         parsed = wtp.parse(unparsed_page.text)
                 except TimeoutError:
-                    print(
-                        f"Wikipedia Dump Worker: timed out while parsing '{unparsed_page.title}' ({unparsed_page.id}) of length {len(unparsed_page.text)}"
+                    logger.warning(
+                        f"Timed out while parsing '{unparsed_page.title}' "
+                        f"({unparsed_page.id}) of length {len(unparsed_page.text)}"
                     )
+                    metrics.inc("parse.timeouts")
                     continue
                 page = ParsedRawPage(
                     id=unparsed_page.id,
@@ -310,10 +432,12 @@ class WikipediaDumpParser:
                     links=Counter(e.title.strip() for e in parsed.wikilinks),
                 )
                 writer_queue.put(page)
+                metrics.observe("parse.worker.busy", time.perf_counter() - start)
 
         reader_queue = multiprocessing.Queue(concurrency * 10)
         writer_queue = multiprocessing.Queue()
         processes = []
+        start = time.perf_counter()
         try:
             for i in range(concurrency):
                 p = multiprocessing.Process(
@@ -324,7 +448,7 @@ class WikipediaDumpParser:
                 p.start()
                 processes.append(p)
 
-            handler = WikiXMLHandler(reader_queue, limit=limit)
+            handler = WikiXMLHandler(reader_queue, limit=limit, titles=titles)
             try:
                 xml.sax.parse(stream, handler)
             except StopIteration:
@@ -343,9 +467,10 @@ class WikipediaDumpParser:
                     else:
                         break
 
+            metrics.observe("parse.seconds", time.perf_counter() - start)
             return pages
         except Exception:
-            print("Exception raised, terminating subprocesses")
+            logger.error("Exception raised, terminating subprocesses")
             for p in processes:
                 p.terminate()
             raise
@@ -356,7 +481,8 @@ class WikipediaCanonicalPageResolver:
     def resolve_parsed_pages(cls, parsed_pages):
         title_to_wikipedia_page = {}
         redirects = {}
-        print("Parsing pages")
+        start = time.perf_counter()
+        logger.info("Parsing pages")
         for p in parsed_pages:
             if p.redirect:
                 redirects[p.title] = p.redirect
@@ -371,8 +497,13 @@ class WikipediaCanonicalPageResolver:
                     pagerank_percentile=None,
                 )
 
+        metrics.add(
+            {"pages": len(title_to_wikipedia_page), "redirects": len(redirects)},
+            prefix="resolve.",
+        )
+
         # Making redirect chainer
-        print("Creating aliases")
+        logger.info("Creating aliases")
         circle_count = 0
         unresolvable_count = 0
         resolved_count = 0
@@ -403,14 +534,22 @@ class WikipediaCanonicalPageResolver:
 
         t = circle_count + unresolvable_count + resolved_count
         assert t == len(redirects), "Not tautology with all redirects"
+        metrics.add(
+            {
+                "redirects_resolved": resolved_count,
+                "redirect_cycles": circle_count,
+                "redirects_unresolvable": unresolvable_count,
+            },
+            prefix="resolve.",
+        )
         if t > 0:
-            print(
-                f"Resolved {resolved_count} ({resolved_count / t}) redirects"
-                f"with {circle_count} ({circle_count / t}) cycles and"
-                f"{unresolvable_count} ({unresolvable_count / t}) unresolvables"
+            logger.info(
+                f"Resolved {resolved_count} ({resolved_count / t:.3f}) redirects "
+                f"with {circle_count} ({circle_count / t:.3f}) cycles and "
+                f"{unresolvable_count} ({unresolvable_count / t:.3f}) unresolvables"
             )
 
-        print("Resolving deepest links")
+        logger.info("Resolving deepest links")
         bad_link_count = 0
         good_link_count = 0
         file_count = 0
@@ -443,8 +582,9 @@ class WikipediaCanonicalPageResolver:
                     else:
                         bad_link_count += count
                         if bad_link_count % 100000 == 0:
-                            print(
-                                f"Sample bad link: '{p.title}' contains unresolved link '{link}'"
+                            logger.debug(
+                                f"Sample bad link: '{p.title}' contains "
+                                f"unresolved link '{link}'"
                             )
                     continue
                 else:
@@ -454,11 +594,20 @@ class WikipediaCanonicalPageResolver:
             p.links.update(resolved_links)
 
         t = good_link_count + bad_link_count
+        metrics.add(
+            {
+                "good_links": good_link_count,
+                "bad_links": bad_link_count,
+                "file_links": file_count,
+            },
+            prefix="resolve.",
+        )
+        metrics.observe("resolve.seconds", time.perf_counter() - start)
         if t > 0:
-            print(
-                f"Found {good_link_count} ({good_link_count / t}) good links "
-                f"and {bad_link_count} ({bad_link_count / t}) bad links "
-                f"and {file_count} ({file_count / t}) file links"
+            logger.info(
+                f"Found {good_link_count} ({good_link_count / t:.3f}) good links "
+                f"and {bad_link_count} ({bad_link_count / t:.3f}) bad links "
+                f"and {file_count} ({file_count / t:.3f}) file links"
             )
 
         while True: